@@ -1,16 +1,208 @@
+import itertools
+
+from flask import current_app
+
+from app import metrics
+from app.algorithm.bloom_filter import get_bloom_filters
+from app.algorithm.description_log import log_descriptions
+from app.algorithm.in_memory import update_mappings_in_memory
+from app.algorithm.match_cache import get_match_cache, MatchCache
+from app.algorithm.normaliser import normalise_description, normalise_descriptions
 from app.algorithm.sql_statements import (
+    _field_to_mapping_table,
+    copy_to_tmp_table,
     get_match_ids,
     json_to_tmp_table,
+    match_ids_statement,
     update_mappings,
 )
+from app.db import db_utils
+
+_fields = [field for field, _ in _field_to_mapping_table]
 
 
 class Matcher:
     def match(self, json_data, update=True, match=True, dnb_match=False):
-        json_to_tmp_table(json_data)
-        if update:
-            update_mappings()
-        if match or dnb_match:
-            return get_match_ids(dnb_match=dnb_match)
-        else:
-            return []
+        cache = get_match_cache()
+        bloom_filters = get_bloom_filters()
+        if not update and (cache or _probed(bloom_filters)):
+            return self._match_only(cache, _probed(bloom_filters), list(json_data), dnb_match)
+        with db_utils.pipeline() as pipeline:
+            changed = self._load_and_update(pipeline, json_data, update, bloom_filters)
+            if match or dnb_match:
+                with metrics.timed('match_ids'):
+                    matches = get_match_ids(pipeline, dnb_match=dnb_match)
+            else:
+                matches = []
+        # only once the update is committed, see match_cache.py
+        if cache and changed:
+            cache.bump_generation()
+        return matches
+
+    def match_stream(self, json_data, update=True, match=True, dnb_match=False, batch_size=10000):
+        """
+        Like match(), except that json_data is consumed lazily and that the matches are
+        fetched in batches once the update is committed
+
+        :return: generator of matches, holding a database connection until it is
+            exhausted or closed
+        """
+        cache = get_match_cache()
+        bloom_filters = get_bloom_filters()
+        if not update and (cache or _probed(bloom_filters)):
+            # a request of up to one batch is answered like match(), larger ones are
+            # matched in the database so that they don't have to be held in memory
+            json_data = iter(json_data)
+            first = list(itertools.islice(json_data, batch_size))
+            if len(first) < batch_size:
+                return _generate(self._match_only(cache, _probed(bloom_filters), first, dnb_match))
+            json_data = itertools.chain(first, json_data)
+        changed = False
+
+        def work(pipeline):
+            nonlocal changed
+            changed = self._load_and_update(pipeline, json_data, update, bloom_filters)
+            return match_ids_statement(dnb_match) if match or dnb_match else None
+
+        matches = db_utils.held_query(work, batch_size=batch_size)
+        next(matches)
+        if cache and changed:
+            cache.bump_generation()
+        return matches
+
+    def _load_and_update(self, pipeline, json_data, update, bloom_filters):
+        """
+        :return: True if the update might have changed match_ids
+        """
+        log = update and current_app.config['matching']['description_log']
+        self._load(pipeline, json_data, keep_raw=log)
+        if not update:
+            return False
+        if log:
+            # before the mapping tables are locked, see description_log.py
+            log_descriptions(pipeline)
+        with metrics.timed('update_mappings'):
+            if current_app.config['matching']['engine'] == 'memory':
+                changed = update_mappings_in_memory(pipeline)
+            else:
+                changed = update_mappings(pipeline)
+            if metrics.enabled():
+                pipeline.flush()
+        # before the update commits, see bloom_filter.py
+        if bloom_filters:
+            _add_loaded_values(pipeline, bloom_filters)
+        return changed
+
+    def _match_only(self, cache, bloom_filters, descriptions, dnb_match):
+        results = [None] * len(descriptions)
+        if cache:
+            keys = [MatchCache.key(d, dnb_match) for d in descriptions]
+            generation, results = cache.get_many(keys)
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            self._match_in_db(bloom_filters, descriptions, misses, results, dnb_match)
+            if cache:
+                cache.set_many(generation, [(keys[i], results[i]) for i in misses])
+        matches = [(d['id'],) + result for d, result in zip(descriptions, results)]
+        if dnb_match:
+            # one match per id, like the distinct on (id) of get_match_ids
+            matches = list({match[0]: match for match in reversed(matches)}.values())
+        return sorted(matches, key=lambda match: match[0])
+
+    def _match_in_db(self, bloom_filters, descriptions, positions, results, dnb_match):
+        """
+        Fills results at positions with (match_id or duns_number, similarity)
+        """
+        # descriptions are matched under their position so that results can be mapped back
+        to_match = {str(i): dict(descriptions[i], id=str(i)) for i in positions}
+        known = None
+        if bloom_filters:
+            normalised = {i: normalise_description(d) for i, d in to_match.items()}
+            known = bloom_filters.known_values(_values_by_field(normalised.values()))
+        if known is not None:
+            for i, d in list(to_match.items()):
+                unknown = [f for f in _fields if normalised[i][f] not in known[f]]
+                if len(unknown) == len(_fields):
+                    duns_number = normalised[i]['duns_number'] if dnb_match else None
+                    results[int(i)] = (duns_number, '0' * len(_fields))
+                    del to_match[i]
+                else:
+                    # with dnb_match the duns_number is also part of the answer
+                    d.update({f: None for f in unknown if not (dnb_match and f == 'duns_number')})
+        if to_match:
+            with db_utils.pipeline() as pipeline:
+                self._load(pipeline, to_match.values())
+                with metrics.timed('match_ids'):
+                    rows = get_match_ids(pipeline, dnb_match=dnb_match)
+                for i, *result in rows:
+                    results[int(i)] = tuple(result)
+
+    def _load(self, pipeline, json_data, keep_raw=False):
+        config = current_app.config['matching']
+        normalise_in_db = config['normalisation'] == 'db'
+        if not normalise_in_db:
+            if keep_raw:
+                json_data = ((d, normalise_description(d)) for d in json_data)
+            else:
+                json_data = normalise_descriptions(json_data)
+        with metrics.timed('load'):
+            if config['tmp_table_loader'] == 'copy':
+                copy_to_tmp_table(
+                    pipeline,
+                    json_data,
+                    copy_format=config['copy_format'],
+                    normalise_in_db=normalise_in_db,
+                    keep_raw=keep_raw,
+                )
+            else:
+                json_to_tmp_table(
+                    pipeline,
+                    list(json_data),
+                    normalise_in_db=normalise_in_db,
+                    keep_raw=keep_raw,
+                )
+            if metrics.enabled():
+                # otherwise the statements queued by the loader are timed with the next stage
+                pipeline.flush()
+
+
+def _generate(matches):
+    yield from matches
+
+
+def _values_by_field(normalised_descriptions):
+    values = {field: set() for field in _fields}
+    for d in normalised_descriptions:
+        _add_values(values, d)
+    return values
+
+
+def _probed(bloom_filters):
+    """
+    :return: bloom_filters if they can be probed with values normalised in python, that is if
+        the mapping tables are written with python normalisation, otherwise None
+    """
+    if current_app.config['matching']['normalisation'] == 'db':
+        # postgres could store a value python normalises differently, missing it would be a
+        # false negative
+        return None
+    return bloom_filters
+
+
+def _add_loaded_values(pipeline, bloom_filters):
+    """
+    Adds the values of tmp, as the mapping tables store them, to the filters
+    """
+    for rows in pipeline.stream(f"select {', '.join(_fields)} from tmp"):
+        bloom_filters.add(
+            {
+                field: {row[i] for row in rows if row[i] is not None}
+                for i, field in enumerate(_fields)
+            }
+        )
+
+
+def _add_values(values, normalised):
+    for field in _fields:
+        if normalised[field] is not None:
+            values[field].add(normalised[field])
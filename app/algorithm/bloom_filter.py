@@ -0,0 +1,137 @@
+"""
+Bloom filters of the values of each mapping table, stored as redis bitmaps so that all
+workers share them
+
+A value that is not in the filter of its field is certainly not in the mapping table, so it
+can be left out of the lookup and a description without any possibly known value can be
+answered without querying the database.
+
+The mapping tables only ever grow, which keeps the filters simple:
+
+    * bits of new values are set before the update that inserts them commits, a rolled
+      back update only leaves false positives behind
+    * a filter is built into a separate key and OR-ed into the live one, so values added
+      by updates running while it is built aren't lost
+    * values are added as the mapping tables store them, they are only probed with values
+      normalised in python if the mapping tables are written with python normalisation
+    * a filter is only used once it has been built, see `flask dev bloom_filters --build`
+"""
+
+import hashlib
+import logging
+import math
+
+import redis
+from flask import current_app
+
+from app.algorithm.sql_statements import _field_to_mapping_table
+
+KEY_PREFIX = 'cms:bloom_filter:'
+
+
+def get_bloom_filters():
+    """
+    :return: BloomFilters as configured for the app, None if disabled
+    """
+    config = current_app.config['bloom_filter']
+    if not config['enabled']:
+        return None
+    return BloomFilters(current_app.cache, config['capacity'], float(config['error_rate']))
+
+
+class BloomFilters:
+    def __init__(self, client, capacity, error_rate):
+        """
+        :param
+            client: redis client
+            capacity: expected number of values per field
+            error_rate: false positive rate at capacity
+        """
+        self.client = client
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if self.size >= 2**32:
+            raise ValueError('bloom filter too large for a redis bitmap')
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+
+    def key(self, field):
+        # the key depends on the size so that resized filters are rebuilt from scratch
+        return f'{KEY_PREFIX}{field}:{self.size}:{self.hash_count}'
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big')
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def known_values(self, values_by_field):
+        """
+        :param values_by_field: dict of field to set of normalised values
+        :return: dict of field to the subset of values that might be in its mapping table,
+            or None if the filters can't be used
+        """
+        known = {field: set() for field in values_by_field}
+        fields = [field for field, values in values_by_field.items() if values]
+        if not fields:
+            return known
+        values_by_field = {field: list(values_by_field[field]) for field in fields}
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.mget([self.key(field) + ':ready' for field in fields])
+            for field in fields:
+                args = []
+                for value in values_by_field[field]:
+                    for position in self.positions(value):
+                        args.extend(('GET', 'u1', position))
+                pipe.execute_command('BITFIELD', self.key(field), *args)
+            ready, *bits = pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to read bloom filters: {str(e)}')
+            return None
+        for field, field_ready, field_bits in zip(fields, ready, bits):
+            values = values_by_field[field]
+            if not field_ready:
+                known[field] = set(values)
+                continue
+            for i, value in enumerate(values):
+                if all(field_bits[i * self.hash_count : (i + 1) * self.hash_count]):
+                    known[field].add(value)
+        return known
+
+    def add(self, values_by_field, key_suffix=''):
+        """
+        Sets the bits of the values. Errors are raised, a missing value would make
+        the filter answer wrongly.
+
+        :param values_by_field: dict of field to iterable of normalised values
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for field, values in values_by_field.items():
+            args = []
+            for value in values:
+                for position in self.positions(value):
+                    args.extend(('SET', 'u1', position, 1))
+            if args:
+                pipe.execute_command('BITFIELD', self.key(field) + key_suffix, *args)
+        pipe.execute()
+
+    def build(self, pipeline, batch_size=10000):
+        """
+        Builds the filters from the mapping tables and marks them as ready
+        """
+        for field, mt in _field_to_mapping_table:
+            key = self.key(field)
+            self.client.delete(key + ':building')
+            for rows in pipeline.stream(f'select {field} from {mt}', batch_size=batch_size):
+                self.add({field: (row[0] for row in rows)}, key_suffix=':building')
+            pipe = self.client.pipeline(transaction=True)
+            pipe.bitop('OR', key, key, key + ':building')
+            pipe.delete(key + ':building')
+            pipe.set(key + ':ready', 1)
+            pipe.execute()
+
+    def ready(self):
+        """
+        :return: dict of field to True if its filter has been built
+        """
+        fields = [field for field, _ in _field_to_mapping_table]
+        ready = self.client.mget([self.key(field) + ':ready' for field in fields])
+        return {field: bool(field_ready) for field, field_ready in zip(fields, ready)}
@@ -0,0 +1,102 @@
+"""
+Append-only log of the descriptions of every update, see `flask dev rebuild`
+
+Descriptions are logged as received, before normalisation, so that a rebuild picks up changes
+to the normalisation. Each update is logged as one batch, numbered from
+description_log_batch_seq in the order the updates ran, with the position of each description
+in the batch. Ids are left out, they only pair descriptions with their matches.
+
+The log is partitioned by month of logged_at, a missing partition is created in its own
+transaction. Creating a partition waits for the transactions writing to the log, so it has to
+happen before the logging transaction holds any lock these could wait for: updates log their
+descriptions before updating the mapping tables.
+"""
+
+from datetime import datetime, timezone
+
+from app.algorithm.sql_statements import _description_columns
+from app.db.models import DescriptionLog, sql_alchemy
+
+LOGGED_COLUMNS = [column for column in _description_columns if column != 'id']
+
+_MAX_BATCH_SIZE = 2**63 - 1
+
+
+def log_descriptions(pipeline):
+    """
+    Logs the descriptions of an update, staged in tmp_raw by the loaders with keep_raw, as one
+    batch
+    """
+    logged_at = _utc_now()
+    partition_exists = pipeline.query(
+        'select to_regclass(:partition) is not null', {'partition': _partition(logged_at)}
+    )[0][0]
+    if not partition_exists:
+        ensure_partition(logged_at)
+    log_staged(pipeline, 'tmp_raw', None, logged_at)
+
+
+def log_staged(pipeline, table, batch_size, logged_at):
+    """
+    Logs the raw descriptions staged in table, with a text position column and the
+    LOGGED_COLUMNS, as batches of batch_size descriptions in position order
+
+    :param
+        batch_size: None logs the whole table as one batch
+        logged_at: as returned by ensure_partition()
+    """
+    if batch_size is None:
+        batch_size = _MAX_BATCH_SIZE
+    stmt = f"""
+        insert into {DescriptionLog.__tablename__}
+            (batch_id, logged_at, position, {', '.join(LOGGED_COLUMNS)})
+        select
+            b.batch_id,
+            :logged_at,
+            mod(r.position::bigint, :batch_size),
+            {', '.join(
+                f'r.{column}::timestamp' if column == 'datetime' else f'r.{column}'
+                for column in LOGGED_COLUMNS
+            )}
+        from {table} r join (
+            select row_number() over (order by batch_id) - 1 as batch, batch_id
+            from (
+                select nextval('description_log_batch_seq') as batch_id
+                from generate_series(1, (
+                    select ceil(count(*)::numeric / :batch_size)::int from {table}
+                ))
+            ) ids
+        ) b on b.batch = r.position::bigint / :batch_size;
+    """
+    pipeline.execute(stmt, {'batch_size': batch_size, 'logged_at': logged_at})
+
+
+def ensure_partition(logged_at=None):
+    """
+    Creates the partition of the month of logged_at, now if None, unless it exists
+
+    :return: logged_at
+    """
+    logged_at = logged_at or _utc_now()
+    start = logged_at.date().replace(day=1)
+    end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    with sql_alchemy.engine.begin() as conn:
+        # concurrent CREATE TABLE IF NOT EXISTS can still collide
+        conn.exec_driver_sql(
+            f"select pg_advisory_xact_lock(hashtext('{DescriptionLog.__tablename__}'))"
+        )
+        conn.exec_driver_sql(
+            f"""
+            CREATE TABLE IF NOT EXISTS {_partition(logged_at)}
+            PARTITION OF {DescriptionLog.__tablename__} FOR VALUES FROM ('{start}') TO ('{end}')
+            """
+        )
+    return logged_at
+
+
+def _partition(logged_at):
+    return f'{DescriptionLog.__tablename__}_{logged_at:%Y_%m}'
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,294 @@
+"""
+Approximate matching of company names, for the fuzzy_name mode of the match endpoint
+
+company_name_mapping only matches simplified names that are equal. Near duplicates, such as
+'acmeholdingsuk' and 'acmeholdinguk', are found with a MinHash LSH index of the character
+trigrams of the simplified names, kept in memory by each process:
+
+    * each name gets a signature of NUM_PERM minimum hashes of its trigrams, one per hash
+      function, so that two signatures agree on a hash with a probability equal to the
+      Jaccard similarity of the trigram sets
+    * the signature is cut into BANDS bands, names sharing any band are candidates of each
+      other, which finds names with a similarity of 0.7 with a probability of about 0.96 and
+      names with a similarity of 0.3 with a probability of about 0.2
+    * candidates are scored with the exact Jaccard similarity of their trigrams
+
+pg_trgm would do the same in the database, it isn't available on all our databases.
+
+The index only holds names, their current match_ids are looked up when candidates are
+returned. Signatures cost about 0.2ms per name, 10s per 50,000 names, so the index is built
+once by `flask dev fuzzy_names --build`, e.g. from cron, and stored in redis. Each process
+loads it in a background thread the first time it is needed and checks for a newer one once
+older than refresh_interval, names added since the build aren't candidates yet.
+"""
+
+import logging
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+import orjson
+from flask import current_app
+from psycopg2.errors import QueryCanceled
+from sqlalchemy.exc import OperationalError
+
+from app.algorithm.normaliser import normalise_description
+from app.db import db_utils
+from app.db.models import CompanyNameMapping
+
+KEY = 'cms:fuzzy_name:index'
+
+NUM_PERM = 24
+BANDS = 8
+
+# candidates scored per name at most, bands of very common trigrams can be large
+MAX_SCORED = 1000
+
+_PRIME = (1 << 61) - 1
+_rnd = random.Random(0)
+_PERMUTATIONS = [(_rnd.randrange(1, _PRIME), _rnd.randrange(_PRIME)) for _ in range(NUM_PERM)]
+_ROWS = NUM_PERM // BANDS
+
+
+def trigrams(name):
+    """
+    :return: set of the character trigrams of name, padded so that short names have one
+    """
+    padded = f'^{name}$'
+    return {padded[i : i + 3] for i in range(max(1, len(padded) - 2))}
+
+
+def similarity(a, b):
+    """
+    :return: Jaccard similarity of two sets of trigrams
+    """
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class NameIndex:
+    def __init__(self, names=()):
+        self._names = []
+        self._buckets = [{} for _ in range(BANDS)]
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        position = len(self._names)
+        self._names.append(name)
+        for buckets, key in zip(self._buckets, _band_keys(trigrams(name))):
+            buckets.setdefault(key, []).append(position)
+
+    def dumps(self):
+        """
+        :return: the index serialised, see loads()
+        """
+        state = {'names': self._names, 'buckets': [list(b.items()) for b in self._buckets]}
+        return zlib.compress(orjson.dumps(state), 1)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        :return: the NameIndex serialised by dumps(), without computing any signature
+        """
+        state = orjson.loads(zlib.decompress(data))
+        index = cls()
+        index._names = state['names']
+        index._buckets = [dict(buckets) for buckets in state['buckets']]
+        return index
+
+    def candidates(self, name, threshold=0.5, limit=5, deadline=None):
+        """
+        :param deadline: time.perf_counter() value after which no more candidates are scored
+        :return: list of (name, similarity) of at most limit indexed names with a similarity
+            of at least threshold, most similar first, None if the deadline passed first
+        """
+        grams = trigrams(name)
+        positions = set()
+        for buckets, key in zip(self._buckets, _band_keys(grams)):
+            for position in buckets.get(key, ()):
+                if len(positions) >= MAX_SCORED:
+                    break
+                positions.add(position)
+        scored = []
+        for i, position in enumerate(positions):
+            if deadline is not None and i % 100 == 0 and time.perf_counter() > deadline:
+                return None
+            candidate = self._names[position]
+            score = similarity(grams, trigrams(candidate))
+            if score >= threshold:
+                scored.append((candidate, score))
+        scored.sort(key=lambda c: (-c[1], c[0]))
+        return scored[:limit]
+
+
+def _band_keys(grams):
+    hashes = [zlib.crc32(gram.encode('utf-8')) for gram in grams]
+    signature = [min([(a * h + b) % _PRIME for h in hashes]) for a, b in _PERMUTATIONS]
+    return [hash(tuple(signature[i : i + _ROWS])) for i in range(0, NUM_PERM, _ROWS)]
+
+
+class FuzzyNames:
+    """
+    The NameIndex of the process, loaded in the background
+    """
+
+    def __init__(self):
+        self.index = None
+        self.checked_at = None
+        self._version = None
+        self._loading = False
+        self._lock = threading.Lock()
+
+    def current(self, refresh_interval):
+        """
+        :return: the NameIndex, None until the first one is loaded, starting to load it in the
+            background if there is none yet or it was checked more than refresh_interval
+            seconds ago
+        """
+        with self._lock:
+            stale = self.index is None or time.monotonic() - self.checked_at > refresh_interval
+            if stale and not self._loading:
+                self._loading = True
+                app = current_app._get_current_object()
+                threading.Thread(target=self._load_in_background, args=(app,), daemon=True).start()
+        return self.index
+
+    def build(self):
+        """
+        Builds the NameIndex from company_name_mapping and stores it for all processes
+
+        :return: the number of names
+        """
+        start = time.perf_counter()
+        index = NameIndex()
+        with db_utils.pipeline() as pipeline:
+            stmt = f'select company_name from {CompanyNameMapping.__tablename__}'
+            for rows in pipeline.stream(stmt):
+                for (name,) in rows:
+                    index.add(name)
+        version = orjson.dumps({'names': len(index), 'built_at': datetime.now(timezone.utc)})
+        pipe = current_app.cache.pipeline()
+        pipe.set(KEY, index.dumps())
+        pipe.set(f'{KEY}:version', version)
+        pipe.execute()
+        logging.info(
+            f'fuzzy name index of {len(index)} names built in {time.perf_counter() - start:.1f}s'
+        )
+        return len(index)
+
+    def status(self):
+        """
+        :return: dict with the number of names of the stored index and when it was built,
+            None if it wasn't built yet
+        """
+        version = current_app.cache.get(f'{KEY}:version')
+        return None if version is None else orjson.loads(version)
+
+    def refresh(self):
+        """
+        Loads the stored NameIndex and swaps it in, unless it is the one already loaded
+        """
+        version = current_app.cache.get(f'{KEY}:version')
+        if version is not None and version != self._version:
+            data = current_app.cache.get(KEY)
+            self._version, self.index = version, NameIndex.loads(data)
+        self.checked_at = time.monotonic()
+
+    def candidates(self, descriptions):
+        """
+        Candidate match_ids of the company names of descriptions, looked up in request order
+        until budget_ms of the fuzzy_name config is spent
+
+        :return: dict of description id to list of (match_id, similarity), most similar first,
+            or to None if the index wasn't built yet or the budget was spent, which includes
+            looking up the match_ids of the candidates
+        """
+        config = current_app.config['fuzzy_name']
+        deadline = time.perf_counter() + float(config['budget_ms']) / 1000
+        index = self.current(float(config['refresh_interval']))
+        found = {}
+        for d in descriptions:
+            if index is None or time.perf_counter() > deadline:
+                found[d['id']] = None
+                continue
+            name = normalise_description(d)['company_name']
+            found[d['id']] = (
+                index.candidates(
+                    name,
+                    threshold=float(config['threshold']),
+                    limit=int(config['max_candidates']),
+                    deadline=deadline,
+                )
+                if name
+                else []
+            )
+        names = {name for candidates in found.values() if candidates for name, _ in candidates}
+        match_ids = {}
+        if names:
+            match_ids = self._match_ids(names, deadline)
+            if match_ids is None:
+                # candidates without match_ids are as good as not looked up
+                found = {id_: candidates and None for id_, candidates in found.items()}
+        return {
+            id_: None if candidates is None else _by_match_id(candidates, match_ids)
+            for id_, candidates in found.items()
+        }
+
+    def _match_ids(self, names, deadline):
+        """
+        :return: dict of name to match_id, None if the deadline passed first
+        """
+        remaining_ms = int((deadline - time.perf_counter()) * 1000)
+        if remaining_ms <= 0:
+            return None
+        stmt = f"""
+            select company_name, match_id from {CompanyNameMapping.__tablename__}
+            where company_name = any(:names)
+        """
+        try:
+            with db_utils.pipeline() as pipeline:
+                pipeline.queue(f"SET LOCAL statement_timeout TO '{remaining_ms}ms';")
+                return dict(pipeline.query(stmt, {'names': list(names)}))
+        except OperationalError as e:
+            if not isinstance(e.orig, QueryCanceled):
+                raise
+            return None
+
+    def _load_in_background(self, app):
+        try:
+            with app.app_context():
+                self.refresh()
+        except Exception:
+            logging.exception('loading the fuzzy name index failed')
+        finally:
+            self._loading = False
+
+
+fuzzy_names = FuzzyNames()
+
+
+def get_fuzzy_names():
+    """
+    :return: FuzzyNames of the process, None if disabled
+    """
+    if not current_app.config['fuzzy_name']['enabled']:
+        return None
+    return fuzzy_names
+
+
+def _by_match_id(candidates, match_ids):
+    # names of the same group are one candidate, candidates are sorted by similarity
+    best = {}
+    for name, score in candidates:
+        match_id = match_ids.get(name)
+        if match_id is not None and match_id not in best:
+            best[match_id] = round(score, 3)
+    return list(best.items())
@@ -0,0 +1,345 @@
+"""
+In-memory alternative to sql_statements.update_mappings
+
+The six field passes are replayed in python over the rows of the mapping tables that the
+batch can affect, applying the same rules as the SQL passes:
+
+    * within a pass, the rows sharing a value of the current field form one group
+    * the match_id of a priority field is taken from the most recent row of the group where
+      that field is not null, and priority fields are considered in _field_to_mapping_table order
+    * if no priority field has a match_id the existing match_id of the value is kept,
+      otherwise a new match_id is drawn from match_id_seq, oldest values first
+    * existing values are impacted when their match_id is linked to the batch through the
+      prev_match_ids of the fields that were already recalculated
+
+Only rows whose match_id changes are written back.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+
+from app.algorithm.sql_statements import (
+    _create_changes_table,
+    _field_to_mapping_table,
+    sync_group_tables,
+)
+
+_fields = [field for field, _ in _field_to_mapping_table]
+
+# positions in a mapping row tuple
+PREV_MATCH_ID, MATCH_ID, SOURCE, DATETIME = range(4)
+
+
+def update_mappings_in_memory(pipeline):
+    """
+    Drop-in replacement for update_mappings() reading the batch from tmp
+
+    :return: True if any mapping row changed
+    """
+    pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+    descriptions = [
+        dict(row._mapping)
+        for row in pipeline.query(f"select datetime, source, {', '.join(_fields)} from tmp")
+    ]
+    state = MappingState(loader=partial(_load_mapping_rows, pipeline))
+    InMemoryEngine(state, allocate_match_ids=partial(_allocate_match_ids, pipeline)).update(
+        descriptions
+    )
+    write_changes(pipeline, state)
+    return any(state.changed.values())
+
+
+class DisjointSet:
+    """
+    Disjoint-set forest with path compression. Each root carries a payload which is
+    combined with the payload of the other root when two sets are merged.
+    """
+
+    def __init__(self, merge):
+        self._parent = {}
+        self._payload = {}
+        self._merge = merge
+
+    def __contains__(self, item):
+        return item in self._parent
+
+    def add(self, item, payload):
+        self._parent[item] = item
+        self._payload[item] = payload
+
+    def find(self, item):
+        root = item
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[item] != root:
+            self._parent[item], item = root, self._parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self._parent[root_b] = root_a
+            self._payload[root_a] = self._merge(self._payload[root_a], self._payload.pop(root_b))
+        return root_a
+
+    def payload(self, item):
+        return self._payload[self.find(item)]
+
+
+class MappingState:
+    """
+    Mapping table rows keyed by field and value, as tuples of
+    (prev_match_id, match_id, source, datetime).
+
+    With a loader, rows are pulled from the database the first time they are needed and the
+    in-memory version of a row always wins over the database one. Without a loader the state
+    is considered complete.
+    """
+
+    def __init__(self, loader=None):
+        self.rows = {field: {} for field in _fields}
+        self.changed = {field: set() for field in _fields}
+        self._by_match_id = {field: defaultdict(set) for field in _fields}
+        self._by_prev_match_id = {field: defaultdict(set) for field in _fields}
+        self._loader = loader
+        self._loaded = {
+            (field, column): set()
+            for field in _fields
+            for column in (field, 'match_id', 'prev_match_id')
+        }
+
+    def get(self, field, value):
+        return self.rows[field].get(value)
+
+    def values_with_match_id(self, field, match_id):
+        return self._by_match_id[field].get(match_id, ())
+
+    def values_with_prev_match_id(self, field, prev_match_id):
+        return self._by_prev_match_id[field].get(prev_match_id, ())
+
+    def ensure_loaded(self, field, column, keys):
+        """
+        Make sure that all rows of the field mapping table where column is one
+        of keys are present in memory
+        """
+        if self._loader is None:
+            return
+        loaded = self._loaded[(field, column)]
+        keys = {key for key in keys if key is not None and key not in loaded}
+        if not keys:
+            return
+        for value, *row in self._loader(field, column, keys):
+            if value not in self.rows[field]:
+                self._index(field, value, tuple(row))
+        loaded.update(keys)
+
+    def set(self, field, value, row):
+        existing = self.rows[field].get(value)
+        if existing:
+            self._by_match_id[field][existing[MATCH_ID]].discard(value)
+            self._by_prev_match_id[field][existing[PREV_MATCH_ID]].discard(value)
+        self._index(field, value, row)
+        self.changed[field].add(value)
+
+    def _index(self, field, value, row):
+        self.rows[field][value] = row
+        self._by_match_id[field][row[MATCH_ID]].add(value)
+        self._by_prev_match_id[field][row[PREV_MATCH_ID]].add(value)
+
+
+class _Group:
+    """
+    Most recent values seen for a value of the current field: the (datetime, source) of
+    the current field and the (datetime, match_id) of each priority field
+    """
+
+    __slots__ = ('latest', 'priority_matches')
+
+    def __init__(self, latest, priority_matches):
+        self.latest = latest
+        self.priority_matches = priority_matches
+
+    @staticmethod
+    def merge(a, b):
+        if _more_recent(b.latest, a.latest):
+            a.latest = b.latest
+        a.priority_matches = [
+            y if _more_recent(y, x) else x for x, y in zip(a.priority_matches, b.priority_matches)
+        ]
+        return a
+
+
+def _more_recent(a, b):
+    """
+    compares (datetime, value) tuples where the tuple itself can be missing
+    """
+    if a is None:
+        return False
+    return b is None or _recency(a[0]) > _recency(b[0])
+
+
+def _recency(value):
+    # postgres sorts nulls first in descending order, i.e. a null datetime counts as most recent
+    return (value is None, value or datetime.min)
+
+
+class InMemoryEngine:
+    def __init__(self, state, allocate_match_ids):
+        self.state = state
+        self.allocate_match_ids = allocate_match_ids
+
+    def update(self, descriptions):
+        """
+        :param descriptions: list of dicts with datetime, source and normalised field values
+        """
+        for position in range(len(_fields)):
+            self._field_pass(position, descriptions)
+
+    def _field_pass(self, position, descriptions):
+        state = self.state
+        field = _fields[position]
+        priority_fields = _fields[:position]
+
+        state.ensure_loaded(field, field, {d[field] for d in descriptions})
+
+        # match_ids of existing groups linked to the batch
+        impacted_match_ids = set()
+        for d in descriptions:
+            row = state.get(field, d[field]) if d[field] is not None else None
+            if row:
+                impacted_match_ids.add(row[MATCH_ID])
+                continue
+            for f in reversed(priority_fields):
+                if d[f] is not None:
+                    impacted_match_ids.add(state.get(f, d[f])[PREV_MATCH_ID])
+                    break
+        state.ensure_loaded(field, 'match_id', impacted_match_ids)
+        for priority_field in priority_fields:
+            state.ensure_loaded(priority_field, 'prev_match_id', impacted_match_ids)
+
+        # each row of the pass is linked to the group of its value of the current field
+        groups = DisjointSet(merge=_Group.merge)
+        values = []
+
+        def add_to_group(value, node, group):
+            if ('value', value) not in groups:
+                values.append(value)
+                groups.add(('value', value), _Group(None, [None] * len(priority_fields)))
+            groups.add(node, group)
+            groups.union(('value', value), node)
+
+        for i, d in enumerate(descriptions):
+            if d[field] is None:
+                continue
+            priority_matches = [
+                (d['datetime'], state.get(f, d[f])[MATCH_ID]) if d[f] is not None else None
+                for f in priority_fields
+            ]
+            add_to_group(
+                d[field], ('description', i), _Group((d['datetime'], d['source']), priority_matches)
+            )
+        for match_id in impacted_match_ids:
+            # existing rows are joined to the priority rows whose prev_match_id is their match_id
+            priority_matches = [
+                max(
+                    (
+                        (row[DATETIME], row[MATCH_ID])
+                        for row in map(
+                            state.rows[f].get, state.values_with_prev_match_id(f, match_id)
+                        )
+                    ),
+                    key=lambda match: _recency(match[0]),
+                    default=None,
+                )
+                for f in priority_fields
+            ]
+            for value in state.values_with_match_id(field, match_id):
+                row = state.get(field, value)
+                add_to_group(
+                    value,
+                    ('existing', value),
+                    _Group((row[DATETIME], row[SOURCE]), priority_matches),
+                )
+
+        resolved = []
+        for value in values:
+            group = groups.payload(('value', value))
+            existing = state.get(field, value)
+            prev_match_id = existing[MATCH_ID] if existing else None
+            new_match_id = next(
+                (match[1] for match in group.priority_matches if match is not None),
+                prev_match_id,
+            )
+            resolved.append((value, group.latest, prev_match_id, new_match_id))
+
+        # new match_ids are handed out to the oldest values first
+        unmatched = sorted((r for r in resolved if r[3] is None), key=lambda r: _recency(r[1][0]))
+        new_match_ids = dict(
+            zip((r[0] for r in unmatched), self.allocate_match_ids(len(unmatched)))
+        )
+        for value, (latest_datetime, latest_source), prev_match_id, new_match_id in resolved:
+            if new_match_id is None:
+                new_match_id = new_match_ids[value]
+            if prev_match_id is None or prev_match_id != new_match_id:
+                state.set(
+                    field,
+                    value,
+                    (
+                        prev_match_id if prev_match_id is not None else new_match_id,
+                        new_match_id,
+                        latest_source,
+                        latest_datetime,
+                    ),
+                )
+
+
+def write_changes(pipeline, state):
+    """
+    Upserts the rows changed in memory into the mapping tables and the tables derived from them
+    """
+    pipeline.queue(_create_changes_table)
+    rows = (
+        (field, value) + tuple(None if v is None else str(v) for v in state.get(field, value))
+        for field in _fields
+        for value in state.changed[field]
+    )
+    pipeline.copy_from_rows(
+        'tmp_mapping_changes',
+        ['field', 'value', 'prev_match_id', 'match_id', 'source', 'datetime'],
+        rows,
+    )
+    stmt = ''.join(
+        f"""
+        insert into {mt}
+            select value, prev_match_id, match_id, source, datetime
+            from tmp_mapping_changes
+            where field = '{field}'
+        on conflict ({field}) do update set
+            prev_match_id=EXCLUDED.prev_match_id,
+            match_id=EXCLUDED.match_id,
+            source=EXCLUDED.source,
+            datetime=EXCLUDED.datetime;
+        """
+        for field, mt in _field_to_mapping_table
+        if state.changed[field]
+    )
+    pipeline.queue(stmt)
+    sync_group_tables(pipeline)
+
+
+def _load_mapping_rows(pipeline, field, column, keys):
+    mt = dict(_field_to_mapping_table)[field]
+    stmt = f"""
+        select {field}, prev_match_id, match_id, source, datetime
+        from {mt}
+        where {column} = any(:keys)
+    """
+    return pipeline.query(stmt, {'keys': list(keys)})
+
+
+def _allocate_match_ids(pipeline, count):
+    if not count:
+        return []
+    stmt = "select nextval('match_id_seq') from generate_series(1, :count)"
+    return sorted(row[0] for row in pipeline.query(stmt, {'count': count}))
@@ -0,0 +1,105 @@
+"""
+Read-through cache of match results, keyed on the normalised field values of a description
+
+Cached values are tagged with the generation they were computed in. Every update that changes
+match_ids bumps the generation after it commits, which retires all values cached before it:
+a value read from the database before the commit is always tagged with an older generation.
+"""
+
+import hashlib
+import json
+import logging
+
+import redis
+from flask import current_app
+
+from app.algorithm.normaliser import normalise_description
+from app.algorithm.sql_statements import _field_to_mapping_table
+
+GENERATION_KEY = 'cms:match_cache:generation'
+KEY_PREFIX = 'cms:match_cache:'
+
+
+class CacheStats:
+    """
+    Per process hit and miss counters, counted per description
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+stats = CacheStats()
+
+
+def get_match_cache():
+    """
+    :return: MatchCache as configured for the app, None if disabled
+    """
+    config = current_app.config['match_cache']
+    if not config['enabled']:
+        return None
+    return MatchCache(current_app.cache, config['ttl'])
+
+
+class MatchCache:
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(description, dnb_match=False):
+        normalised = normalise_description(description)
+        values = [normalised[field] for field, _ in _field_to_mapping_table]
+        digest = hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+        return f"{KEY_PREFIX}{'dnb_match' if dnb_match else 'match'}:{digest}"
+
+    def get_many(self, keys):
+        """
+        :return: (generation, list of cached (match_id, similarity) or None for each key)
+        """
+        try:
+            generation, *values = self.client.mget([GENERATION_KEY] + keys)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to read match cache: {str(e)}')
+            stats.misses += len(keys)
+            return None, [None] * len(keys)
+        generation = int(generation or 0)
+        results = []
+        for value in values:
+            if value is not None:
+                value_generation, result = json.loads(value)
+                value = tuple(result) if value_generation == generation else None
+            results.append(value)
+        hits = sum(1 for result in results if result is not None)
+        stats.hits += hits
+        stats.misses += len(keys) - hits
+        return generation, results
+
+    def set_many(self, generation, items):
+        """
+        :param
+            generation: generation returned by get_many before the values were computed
+            items: list of (key, (match_id, similarity))
+        """
+        if generation is None or not items:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key, result in items:
+                pipe.set(key, json.dumps([generation, list(result)]), ex=self.ttl)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to write match cache: {str(e)}')
+
+    def bump_generation(self):
+        try:
+            self.client.incr(GENERATION_KEY)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to invalidate match cache: {str(e)}')
@@ -0,0 +1,184 @@
+"""
+Python version of the normalisation applied to descriptions when they are loaded into tmp,
+see _normalised_description_columns in sql_statements.py
+
+The patterns are the ones of _ch_name_simplification and _general_name_simplification,
+translated to python's re module:
+
+    * postgres applies the pattern to the whole string, so '$' becomes '\\Z' and '.' also
+      matches new lines (re.DOTALL)
+    * '\\s' is replaced by the white space of postgres, see _SPACE, '\\d' and case-insensitive
+      matching are restricted to ASCII like in postgres (re.ASCII)
+    * postgres takes the longest matching alternative where python takes the first one,
+      wherever both could match at the same position the first one is also the longest
+
+lower() is postgres' lower(), see pg_lower(). Both follow the character classification of a
+database with a glibc UTF-8 locale, like C.UTF-8 or en_GB.UTF-8.
+"""
+
+import itertools
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from app.algorithm.sql_statements import _copy_value as _text
+
+_FLAGS = re.IGNORECASE | re.DOTALL | re.ASCII
+
+# [[:space:]] of postgres under glibc: ASCII white space and the Unicode spaces that aren't
+# no-break spaces, where python's \s would also take \x1c-\x1f, \x85, \xa0, \u2007 and \u202f
+_SPACE = '\t\n\v\f\r \u1680\u2000-\u2006\u2008-\u200a\u2028\u2029\u205f\u3000'
+
+# characters that str.lower() lowers unlike postgres, which lowers them one by one with towlower()
+_PG_LOWER = str.maketrans({'\u0130': 'i', '\u03a3': '\u03c3'})
+
+
+def _compile(pattern):
+    """
+    :return: pattern compiled with _FLAGS, its \\s replaced by _SPACE
+    """
+    translated = []
+    in_class = False
+    for token in re.findall(r'\\.|.', pattern, re.DOTALL):
+        if token == '\\s':
+            token = _SPACE if in_class else f'[{_SPACE}]'
+        elif token == '[':
+            in_class = True
+        elif token == ']':
+            in_class = False
+        translated.append(token)
+    return re.compile(''.join(translated), _FLAGS)
+
+
+_ch_name_replacements = (
+    r'^the\s|\s?:\s?|\[|\]|\(|\)|\'|\*.*\*|&|,|;|"|ltd\.?\Z|limited\.?\Z|\sllp\.?\Z|\splc\.?\Z'
+    r'|\sllc\.?\Z|\sand\s|\sco[\.|\s]|\scompany[\s|$]'
+)
+
+_ch_name_simplification = (
+    (_compile(_ch_name_replacements), ' '),
+    (_compile(r'\.|\s'), ''),
+)
+
+_general_name_simplification = (
+    (_compile(_ch_name_replacements + r'|\s+'), ' '),
+    (
+        _compile(
+            r'\s/.*|\s-(\s)?.*|(\s|\.|\(|\_)?duplic.*|\sdupilcat.*|\sdupicat.*|\sdissolved.*'
+            r'|\*?do not .*|((\s|\*)?in)?\sliquidat.*|\sceased trading.*|\strading as.*|t/a.*'
+            r'|\sacquired by.*|\splease\s.*|(do not)?(use)?(.)?(\d{5}(\d*)).*|-|\.'
+        ),
+        '',
+    ),
+    (_compile(r'\.|\s'), ''),
+)
+
+_non_digits = re.compile(r'\D', re.ASCII)
+
+_invalid_companies_house_ids = {'notregis', 'not reg', 'n/a', 'none', '0', ''}
+
+NAME_CACHE_SIZE = 2**17
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def simplify_company_name(company_name, general=True):
+    """
+    :param
+        company_name: raw company name
+        general: True for sources with free-text names (dit.* or unknown), False for
+            companies house like sources where only the legal suffixes are removed
+    :return: the simplified, lower case company name
+    """
+    if company_name is None:
+        return None
+    simplified = company_name
+    for pattern, replacement in (
+        _general_name_simplification if general else _ch_name_simplification
+    ):
+        simplified = pattern.sub(replacement, simplified)
+    return pg_lower(simplified or company_name)
+
+
+def pg_lower(value):
+    """
+    :return: value in lower case like postgres' lower()
+    """
+    return value.translate(_PG_LOWER).lower()
+
+
+def normalise_description(description):
+    """
+    :param description: dict as received by the API
+    :return: dict with the columns of tmp, normalised
+    """
+    source = _text(description.get('source'))
+    companies_house_id = _text(description.get('companies_house_id'))
+    if companies_house_id is not None:
+        companies_house_id = pg_lower(companies_house_id)
+        if companies_house_id in _invalid_companies_house_ids:
+            companies_house_id = None
+    contact_email = _text(description.get('contact_email'))
+    cdms_ref = _text(description.get('cdms_ref'))
+    postcode = _text(description.get('postcode'))
+    return {
+        'id': _text(description.get('id')),
+        'source': source,
+        'datetime': _text(description.get('datetime')),
+        'companies_house_id': companies_house_id,
+        'duns_number': _text(description.get('duns_number')),
+        'company_name': simplify_company_name(
+            _text(description.get('company_name')),
+            general=source is None or source.startswith('dit.'),
+        ),
+        'contact_email': (
+            pg_lower(_split_part(contact_email, '@', 2)) if contact_email is not None else None
+        ),
+        'cdms_ref': _non_digits.sub('', cdms_ref) if cdms_ref is not None else None,
+        'postcode': pg_lower(postcode.replace(' ', '')) if postcode is not None else None,
+    }
+
+
+def normalise_descriptions(descriptions, processes=1, chunksize=10000):
+    """
+    Lazily normalises an iterable of descriptions, keeping their order
+
+    :param
+        descriptions: iterable of dicts as received by the API
+        processes: number of worker processes, 1 normalises in the current process
+        chunksize: number of descriptions sent to a worker process at once
+    :return: iterator of normalised dicts
+    """
+    if processes <= 1:
+        yield from map(normalise_description, descriptions)
+        return
+    chunks = _chunks(descriptions, chunksize)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # keep a bounded number of chunks in flight so that memory doesn't grow with the input
+        pending = [
+            executor.submit(_normalise_chunk, chunk)
+            for chunk in itertools.islice(chunks, processes * 2)
+        ]
+        while pending:
+            result = pending.pop(0).result()
+            chunk = next(chunks, None)
+            if chunk is not None:
+                pending.append(executor.submit(_normalise_chunk, chunk))
+            yield from result
+
+
+def _normalise_chunk(chunk):
+    return [normalise_description(description) for description in chunk]
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _split_part(value, delimiter, position):
+    parts = value.split(delimiter)
+    return parts[position - 1] if len(parts) >= position else ''
@@ -0,0 +1,181 @@
+"""
+Query plans of the SQL generated for an update, see `flask dev profile`
+
+The update runs as usual except that every statement that can be explained is run with
+EXPLAIN (ANALYZE, BUFFERS), which also executes it so that later statements see its effects.
+The transaction is rolled back at the end, sequences such as match_id_seq still advance.
+"""
+
+import json
+import re
+
+from sqlalchemy import text
+
+from app.algorithm import Matcher
+from app.algorithm.sql_statements import match_ids_statement, update_mappings
+from app.db import db_utils
+from app.db.models import sql_alchemy
+
+_EXPLAINABLE = re.compile(r'(with|select|insert|update|delete)\b', re.IGNORECASE)
+_BUFFERS = [
+    'Shared Hit Blocks',
+    'Shared Read Blocks',
+    'Shared Written Blocks',
+    'Temp Read Blocks',
+    'Temp Written Blocks',
+]
+
+
+class ProfilingPipeline(db_utils.Pipeline):
+    """
+    Pipeline that runs each statement on its own and records the plans of those that can be
+    explained. execute() returns the plan instead of the rows, query() runs its statement
+    without EXPLAIN and returns its rows, which the code being profiled depends on.
+    """
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.stage = None
+        self.plans = []
+
+    def queue(self, stmt):
+        self.execute(stmt)
+
+    def execute(self, stmt, data=None):
+        result = None
+        for statement in split_statements(stmt):
+            if not _EXPLAINABLE.match(statement):
+                result = super().execute(statement, data)
+                continue
+            result = self.connection.execute(
+                text(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}'), data
+            )
+            plan = result.scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            self.plans.append(StatementPlan(self.stage, statement, plan[0]))
+        return result
+
+    def query(self, stmt, data=None):
+        return super().execute(stmt, data).fetchall()
+
+
+class StatementPlan:
+    def __init__(self, stage, statement, plan):
+        self.stage = stage
+        self.statement = statement
+        self.plan = plan
+
+    @property
+    def name(self):
+        target = re.search(r'^\s*insert\s+into\s+(\w+)', self.statement, re.I | re.M)
+        return f"{self.stage}: {target.group(1) if target else self.statement.split()[0].lower()}"
+
+    @property
+    def execution_time(self):
+        return self.plan['Execution Time']
+
+    def buffers(self):
+        return {key: self.plan['Plan'].get(key, 0) for key in _BUFFERS}
+
+    def nodes(self):
+        """
+        :return: list of (node, exclusive milliseconds, exclusive buffers), the time and
+            buffers of a node excluding those of its children
+        """
+        nodes = []
+
+        def walk(node):
+            children = node.get('Plans', [])
+            total = node['Actual Total Time'] * node['Actual Loops']
+            exclusive = total - sum(c['Actual Total Time'] * c['Actual Loops'] for c in children)
+            buffers = {
+                key: node.get(key, 0) - sum(c.get(key, 0) for c in children) for key in _BUFFERS
+            }
+            nodes.append((node, max(exclusive, 0.0), buffers))
+            for child in children:
+                walk(child)
+
+        walk(self.plan['Plan'])
+        return nodes
+
+
+def profile(descriptions, dnb_match=False):
+    """
+    Runs the update of descriptions followed by the match ids query and rolls it back
+
+    :return: list of StatementPlan in execution order
+    """
+    with sql_alchemy.engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            pipeline = ProfilingPipeline(conn)
+            pipeline.stage = 'load'
+            Matcher()._load(pipeline, descriptions)
+            pipeline.stage = 'update_mappings'
+            update_mappings(pipeline)
+            pipeline.stage = 'match_ids'
+            pipeline.execute(match_ids_statement(dnb_match))
+        finally:
+            transaction.rollback()
+    return pipeline.plans
+
+
+def report(plans, top=20):
+    """
+    :return: lines of a report of the statements and of the slowest plan nodes
+    """
+    lines = ['statements:']
+    for plan in plans:
+        buffers = plan.buffers()
+        lines.append(
+            f'  {plan.execution_time:10.1f} ms  '
+            f"hit {buffers['Shared Hit Blocks']:8}  read {buffers['Shared Read Blocks']:8}  "
+            f"temp {buffers['Temp Read Blocks'] + buffers['Temp Written Blocks']:8}  "
+            f'{plan.name}'
+        )
+    nodes = [(plan, *node) for plan in plans for node in plan.nodes()]
+    nodes.sort(key=lambda node: node[2], reverse=True)
+    lines.append('slowest plan nodes (exclusive time):')
+    for plan, node, milliseconds, buffers in nodes[:top]:
+        relation = node.get('Relation Name') or node.get('Alias') or ''
+        rows = node['Actual Rows'] * node['Actual Loops']
+        lines.append(
+            f'  {milliseconds:10.1f} ms  '
+            f"hit {buffers['Shared Hit Blocks']:8}  read {buffers['Shared Read Blocks']:8}  "
+            f'rows {rows:8}  {node["Node Type"]} {relation}'.rstrip() + f'  [{plan.name}]'
+        )
+    return lines
+
+
+def split_statements(sql):
+    """
+    Splits sql on the semicolons ending its statements, ignoring those in quotes and comments
+
+    :return: list of statements without their semicolon
+    """
+    statements = []
+    start = i = 0
+    while i < len(sql):
+        if sql[i] == "'":
+            i = sql.find("'", i + 1)
+            if i == -1:
+                break
+        elif sql.startswith('--', i):
+            i = sql.find('\n', i)
+            if i == -1:
+                break
+        elif sql.startswith('/*', i):
+            i = sql.find('*/', i) + 1
+            if i == 0:
+                break
+        elif sql[i] == ';':
+            statements.append(sql[start:i])
+            start = i + 1
+        i += 1
+    statements.append(sql[start:])
+    return [s.strip() for s in statements if _strip_comments(s).strip()]
+
+
+def _strip_comments(sql):
+    return re.sub(r'--[^\n]*|/\*.*?\*/', '', sql, flags=re.S)
@@ -1,5 +1,8 @@
 import json
+import time
+from contextlib import contextmanager
 
+from app import metrics
 from app.db import db_utils
 from app.db.models import (
     CDMSRefMapping,
@@ -7,6 +10,8 @@ from app.db.models import (
     CompanyNameMapping,
     ContactEmailMapping,
     DunsNumberMapping,
+    LatestDunsByMatchId,
+    MatchGroup,
     PostcodeMapping,
 )
 
@@ -48,59 +53,325 @@ _field_to_mapping_table = [
 ]
 
 
-def json_to_tmp_table(json_data):
-    stmt = """
-        DROP TABLE IF EXISTS tmp;
-        CREATE TEMPORARY TABLE tmp (
-            id text,
-            source text,
-            datetime timestamp,
-            companies_house_id text,
-            duns_number text,
-            company_name text,
-            contact_email text,
-            cdms_ref text,
-            postcode text
-        );
+_description_columns = [
+    'id',
+    'source',
+    'datetime',
+    'companies_house_id',
+    'duns_number',
+    'company_name',
+    'contact_email',
+    'cdms_ref',
+    'postcode',
+]
+
+_create_tmp_table = """
+    DROP TABLE IF EXISTS tmp;
+    CREATE TEMPORARY TABLE tmp (
+        id text,
+        source text,
+        datetime timestamp,
+        companies_house_id text,
+        duns_number text,
+        company_name text,
+        contact_email text,
+        cdms_ref text,
+        postcode text
+    ) ON COMMIT DROP;
+"""
+
+_normalised_description_columns = f"""
+    id,
+    source,
+    datetime::timestamp,
+    case when
+        lower(companies_house_id) = ANY('{{notregis, not reg,n/a, none, 0, ""}}'::text[])
+    then null else lower(companies_house_id) end,
+    duns_number,
+    {_general_name_simplification},
+    lower(split_part(contact_email, '@', 2)),
+    regexp_replace(cdms_ref, '\\D','','g'),
+    lower(replace(postcode, ' ', ''))
+"""  # noqa: W605, W291, E501
+
+# for descriptions already normalised by app.algorithm.normaliser
+_plain_description_columns = ', '.join(
+    'datetime::timestamp' if column == 'datetime' else column for column in _description_columns
+)
+
+
+def json_to_tmp_table(pipeline, json_data, normalise_in_db=True, keep_raw=False):
     """
-    db_utils.execute_statement(stmt)
+    :param
+        json_data: list of descriptions, already normalised unless normalise_in_db, with
+            keep_raw and normalise_in_db=False (description, normalised description) pairs
+        keep_raw: keeps the descriptions as received in tmp_raw, see copy_to_tmp_table
+    """
+    pipeline.queue(_create_tmp_table)
+    if keep_raw:
+        pipeline.queue(_create_raw_table(['position'] + _description_columns))
+        raw = json_data if normalise_in_db else [d for d, _ in json_data]
+        stmt = f"""
+            INSERT INTO tmp_raw (position, {', '.join(_description_columns)})
+            SELECT ordinality - 1, {', '.join(_description_columns)}
+            FROM json_populate_recordset(null::tmp_raw, :data) WITH ORDINALITY;
+        """
+        pipeline.execute(stmt, {"data": json.dumps(raw)})
+        if not normalise_in_db:
+            json_data = [normalised for _, normalised in json_data]
     stmt = f"""
-        INSERT INTO tmp (
-            id,
-            source,
-            datetime,
-            companies_house_id,
-            duns_number,
-            company_name,
-            contact_email,
-            cdms_ref,
-            postcode
-        )
-        SELECT
-            id,
-            source,
-            datetime,
-            case when
-                lower(companies_house_id) = ANY('{{notregis, not reg,n/a, none, 0, ""}}'::text[])
-            then null else lower(companies_house_id) end,
-            duns_number,
-            {_general_name_simplification},
-            lower(split_part(contact_email, '@', 2)),
-            regexp_replace(cdms_ref, '\\D','','g'),
-            lower(replace(postcode, ' ', ''))
+        INSERT INTO tmp ({', '.join(_description_columns)})
+        SELECT {_normalised_description_columns if normalise_in_db else _plain_description_columns}
         FROM json_populate_recordset(null::tmp, :data);
     """
-    db_utils.execute_statement(stmt, ({"data": json.dumps(json_data)},))
+    pipeline.execute(stmt, {"data": json.dumps(json_data)})
+
+
+def copy_to_tmp_table(
+    pipeline, json_data, copy_format='text', normalise_in_db=True, keep_raw=False
+):
+    """
+    Streams the descriptions into a raw staging table with COPY and
+    normalises them into tmp with a single INSERT ... SELECT, avoiding
+    the intermediate JSON document built by json_to_tmp_table
+
+    :param
+        json_data: iterable of descriptions, already normalised unless normalise_in_db, with
+            keep_raw and normalise_in_db=False (description, normalised description) pairs
+        keep_raw: keeps the descriptions as received in tmp_raw, with a text position column,
+            until the transaction ends so that they can be logged in SQL, see description_log.py
+    """
+    if not keep_raw:
+        columns = _description_columns
+        rows = (
+            tuple(_copy_value(description.get(column)) for column in _description_columns)
+            for description in json_data
+        )
+    elif normalise_in_db:
+        columns = ['position'] + _description_columns
+        rows = (
+            (str(position),)
+            + tuple(_copy_value(description.get(column)) for column in _description_columns)
+            for position, description in enumerate(json_data)
+        )
+    else:
+        # like bulk_import._stage, the normalised values are staged next to the raw ones
+        columns = (
+            ['position']
+            + _description_columns
+            + [f'normalised_{column}' for column in _description_columns]
+        )
+        rows = (
+            (str(position),)
+            + tuple(_copy_value(description.get(column)) for column in _description_columns)
+            + tuple(normalised[column] for column in _description_columns)
+            for position, (description, normalised) in enumerate(json_data)
+        )
+    pipeline.queue(_create_tmp_table + _create_raw_table(columns))
+    pipeline.copy_from_rows('tmp_raw', columns, rows, copy_format=copy_format)
+    if normalise_in_db:
+        selected = _normalised_description_columns
+    elif keep_raw:
+        selected = ', '.join(
+            f'normalised_{column}::timestamp' if column == 'datetime' else f'normalised_{column}'
+            for column in _description_columns
+        )
+    else:
+        selected = _plain_description_columns
+    stmt = f"""
+        INSERT INTO tmp ({', '.join(_description_columns)})
+        SELECT {selected}
+        FROM tmp_raw;
+    """
+    if not keep_raw:
+        stmt += 'DROP TABLE tmp_raw;'
+    pipeline.queue(stmt)
+
+
+def _create_raw_table(columns):
+    return f"""
+        DROP TABLE IF EXISTS tmp_raw;
+        CREATE TEMPORARY TABLE tmp_raw (
+            {', '.join(f'{column} text' for column in columns)}
+        ) ON COMMIT DROP;
+    """
+
+
+def _copy_value(value):
+    # mirror json_populate_recordset, which keeps the JSON text of non-string values
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+# tables written by update_mappings
+_updated_tables = [mt for _, mt in _field_to_mapping_table] + [
+    MatchGroup.__tablename__,
+    LatestDunsByMatchId.__tablename__,
+]
+
+
+def set_mapping_tables_logged(pipeline, logged=True):
+    """
+    Switching a table between logged and unlogged rewrites it and takes an exclusive lock,
+    only do this around bulk imports, see bulk_ingest()
+    """
+    pipeline.queue(
+        ''.join(
+            f"alter table {table} set {'logged' if logged else 'unlogged'};"
+            for table in _updated_tables
+        )
+    )
+
+
+def mapping_tables_logged(pipeline):
+    """
+    :return: dict of mapping table name to True if logged, False if unlogged
+    """
+    rows = pipeline.query(
+        "select relname, relpersistence from pg_class where relname = any(:tables)",
+        {'tables': _updated_tables},
+    )
+    return {relname: relpersistence == 'p' for relname, relpersistence in rows}
+
+
+@contextmanager
+def bulk_ingest():
+    """
+    Switches the mapping tables to unlogged once for a whole import job and back to logged
+    when it ends. Unlogged tables are truncated after a crash, so the import has to be rerun
+    if the database goes down in the meantime.
+    """
+    with db_utils.pipeline() as pipeline:
+        set_mapping_tables_logged(pipeline, logged=False)
+    try:
+        yield
+    finally:
+        with db_utils.pipeline() as pipeline:
+            set_mapping_tables_logged(pipeline, logged=True)
+
+
+_create_changes_table = """
+    DROP TABLE IF EXISTS tmp_mapping_changes;
+    CREATE TEMPORARY TABLE tmp_mapping_changes (
+        field text,
+        value text,
+        prev_match_id int,
+        match_id int,
+        source text,
+        datetime timestamp
+    ) ON COMMIT DROP;
+"""
+
+
+def _upsert_match_group(rows):
+    """
+    :param rows: relation with the field, value, match_id, source and datetime of mapping rows
+    """
+    return f"""
+        insert into {MatchGroup.__tablename__} (field, value, match_id, source, datetime)
+            select field, value, match_id, source, datetime from {rows}
+        on conflict (field, value) do update set
+            match_id=EXCLUDED.match_id,
+            source=EXCLUDED.source,
+            datetime=EXCLUDED.datetime
+        where ({MatchGroup.__tablename__}.match_id, {MatchGroup.__tablename__}.source,
+            {MatchGroup.__tablename__}.datetime)
+            is distinct from (EXCLUDED.match_id, EXCLUDED.source, EXCLUDED.datetime);
+    """
 
 
-def update_mappings():
-    db_utils.execute_statement("SET statement_timeout TO '10h' ")
-    to_check = []
-    for current_f2mt in _field_to_mapping_table:
-        current_field = current_f2mt[0]
-        current_mt = current_f2mt[1]
+def _refresh_latest_duns(match_ids):
+    """
+    :param match_ids: query of the match_ids whose latest duns_number may have changed
+    """
+    return f"""
+        insert into {LatestDunsByMatchId.__tablename__} (match_id, duns_number, datetime)
+            select distinct on (match_id) match_id, duns_number, datetime
+            from {DunsNumberMapping.__tablename__}
+            where match_id in ({match_ids})
+            order by match_id, datetime desc, duns_number
+        on conflict (match_id) do update set
+            duns_number=EXCLUDED.duns_number,
+            datetime=EXCLUDED.datetime
+        where ({LatestDunsByMatchId.__tablename__}.duns_number,
+            {LatestDunsByMatchId.__tablename__}.datetime)
+            is distinct from (EXCLUDED.duns_number, EXCLUDED.datetime);
+        delete from {LatestDunsByMatchId.__tablename__} ld -- groups left without a duns_number
+        where match_id in ({match_ids}) and not exists (
+            select from {DunsNumberMapping.__tablename__} dm where dm.match_id = ld.match_id
+        );
+    """
+
+
+def sync_group_tables(pipeline):
+    """
+    Applies the mapping rows changed by an update, collected in tmp_mapping_changes, to
+    match_group and latest_duns_by_match_id
+    """
+    pipeline.queue(_upsert_match_group('tmp_mapping_changes'))
+    # the groups a duns_number left, through its prev_match_id, and the groups it joined
+    changed_duns_match_ids = """
+        select prev_match_id from tmp_mapping_changes where field = 'duns_number'
+        union select match_id from tmp_mapping_changes where field = 'duns_number'
+    """
+    pipeline.queue(_refresh_latest_duns(changed_duns_match_ids))
+    pipeline.queue('DROP TABLE tmp_mapping_changes;')
+
+
+def backfill_group_tables(pipeline):
+    """
+    Fills match_group and latest_duns_by_match_id from the mapping tables, for tables created
+    before they existed or restored separately. Rows already in sync are left untouched.
+    """
+    for field, mt in _field_to_mapping_table:
+        rows = f"""(
+            select '{field}' as field, {field} as value, match_id, source, datetime from {mt}
+        ) {mt}"""
+        pipeline.queue(_upsert_match_group(rows))
         stmt = f"""
-        alter table {current_mt} set unlogged;
+            delete from {MatchGroup.__tablename__} mg
+            where mg.field = '{field}' and not exists (select from {mt} where {field} = mg.value);
+        """
+        pipeline.queue(stmt)
+    match_ids = f"""
+        select match_id from {DunsNumberMapping.__tablename__}
+        union select match_id from {LatestDunsByMatchId.__tablename__}
+    """
+    pipeline.queue(_refresh_latest_duns(match_ids))
+
+
+def update_mappings(pipeline):
+    """
+    :return: True if any mapping row changed
+    """
+    pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+    pipeline.queue(_create_changes_table)
+    measured = metrics.enabled()
+    if measured:
+        rows_in = pipeline.query(
+            f"select {', '.join(f'count({f})' for f, _ in _field_to_mapping_table)} from tmp;"
+        )[0]
+    for position, (field, _) in enumerate(_field_to_mapping_table):
+        stmt = _update_pass_statements[position]
+        if measured:
+            _measure_update_pass(pipeline, stmt, field, rows_in[position])
+        else:
+            pipeline.queue(stmt)
+    changed = pipeline.query('select exists (select from tmp_mapping_changes);')[0][0]
+    sync_group_tables(pipeline)
+    return changed
+
+
+def _update_pass_statement(position):
+    """
+    :return: the statement recalculating the match_ids of the field at position in
+        _field_to_mapping_table, once those of the fields before it are recalculated
+    """
+    current_f2mt = _field_to_mapping_table[position]
+    current_field, current_mt = current_f2mt
+    to_check = _field_to_mapping_table[:position]
+    return f"""
         with to_match as (
             -- retrieve values that need matching and their
             -- existing match_ids from mapping table if found
@@ -180,7 +451,7 @@ def update_mappings():
             ) sq
             where {current_field} is not null
             order by {current_field}, {current_field}_datetime desc
-        )
+        ), changed as (
         insert into {current_mt}
             -- if no prev_match_id exists use the current one
             select
@@ -211,19 +482,36 @@ def update_mappings():
             prev_match_id=EXCLUDED.prev_match_id,
             match_id=EXCLUDED.match_id,
             source=EXCLUDED.source,
-            datetime=EXCLUDED.datetime;
-        alter table {current_mt} set logged;
+            datetime=EXCLUDED.datetime
+        returning {current_field}, prev_match_id, match_id, source, datetime
+        )
+        insert into tmp_mapping_changes select '{current_field}', * from changed;
         """
-        to_check.append((current_field, current_mt))
-        db_utils.execute_statement(stmt)
 
 
-def get_match_ids(dnb_match=False):
-    stmt = f"""
+def _measure_update_pass(pipeline, stmt, field, rows_in):
+    labels = dict(metrics.labels(), field=field)
+    start = time.perf_counter()
+    rows_written = pipeline.execute(stmt).rowcount
+    metrics.update_pass_seconds.labels(**labels).observe(time.perf_counter() - start)
+    metrics.update_pass_rows_in.labels(**labels).observe(rows_in)
+    metrics.update_pass_rows_written.labels(**labels).observe(rows_written)
+
+
+def get_match_ids(pipeline, dnb_match=False):
+    return pipeline.query(match_ids_statement(dnb_match))
+
+
+def match_ids_statement(dnb_match=False):
+    return _match_ids_statements[dnb_match]
+
+
+def _match_ids_statement(dnb_match):
+    return f"""
     select {'distinct on (id)' if dnb_match else ''}
-                -- select most recent dnb number in match group
+                -- one match per id
         id,
-        {'coalesce(SQ.duns_number, duns_number_mapping.duns_number)'
+        {'coalesce(SQ.duns_number, ld.duns_number)'
             if dnb_match else 'aggr_match_id'},
         concat(
             {','.join(
@@ -248,7 +536,13 @@ def get_match_ids(dnb_match=False):
                 ]
             )}
     ) SQ
-    {f'''left join duns_number_mapping on duns_number_mapping.match_id = aggr_match_id
-    order by id asc, duns_number_mapping.datetime desc''' if dnb_match else 'order by id asc'}
+    {'left join latest_duns_by_match_id ld on ld.match_id = aggr_match_id' if dnb_match else ''}
+    order by id asc
     """
-    return db_utils.execute_query(stmt)
+
+
+# the statements only depend on _field_to_mapping_table, they are rendered once
+_update_pass_statements = [
+    _update_pass_statement(position) for position in range(len(_field_to_mapping_table))
+]
+_match_ids_statements = {dnb_match: _match_ids_statement(dnb_match) for dnb_match in (False, True)}
@@ -0,0 +1,87 @@
+"""
+Per worker cache of hawk credentials, so that authenticating a request doesn't query the
+database
+
+Entries expire after a TTL and the least recently used ones are evicted beyond maxsize.
+Changing a user bumps a generation counter in redis, which invalidates the entries of all
+workers. Workers read the counter at most every poll_interval seconds, so that cached
+credentials are served without a round trip to redis, and a change applies to the other
+workers within poll_interval. If redis can't be reached the TTL alone bounds how long a change
+takes to apply.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+import redis
+
+GENERATION_KEY = 'cms:hawk_users:generation'
+
+
+class CredentialsCache:
+    def __init__(self, loader, client, maxsize, ttl, poll_interval=5, clock=time.monotonic):
+        """
+        :param
+            loader: function of a client id returning (key, scope) or None
+            client: redis client holding the generation counter
+            maxsize: maximum number of cached client ids
+            ttl: seconds after which an entry is loaded again
+            poll_interval: seconds after which the generation counter is read again
+        """
+        self.loader = loader
+        self.client = client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._generation_value = None
+        self._polled_at = None
+
+    def get(self, client_id):
+        """
+        :return: (key, scope) or None for unknown clients
+        """
+        generation = self._generation()
+        entry = self._entries.get(client_id)
+        if entry is not None:
+            expires, entry_generation, credentials = entry
+            if expires > self.clock() and generation in (None, entry_generation):
+                self._entries.move_to_end(client_id)
+                return credentials
+        credentials = self.loader(client_id)
+        self._entries[client_id] = (self.clock() + self.ttl, generation, credentials)
+        self._entries.move_to_end(client_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return credentials
+
+    def invalidate(self, client_id=None):
+        """
+        Drops the entry of client_id, or all entries, in this worker and in all others
+        """
+        if client_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(client_id, None)
+        # entries loaded from now on belong to the next generation
+        self._polled_at = None
+        try:
+            self.client.incr(GENERATION_KEY)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to invalidate hawk credentials: {str(e)}')
+
+    def _generation(self):
+        now = self.clock()
+        if self._polled_at is None or now - self._polled_at >= self.poll_interval:
+            self._generation_value = self._read_generation()
+            self._polled_at = now
+        return self._generation_value
+
+    def _read_generation(self):
+        try:
+            return self.client.get(GENERATION_KEY)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to read hawk credentials generation: {str(e)}')
+            return None
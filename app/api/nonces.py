@@ -0,0 +1,73 @@
+"""
+Store of the hawk nonces already seen, to reject replayed requests
+
+A nonce is checked and recorded with a single SET NX EX, which only succeeds if the key
+doesn't exist yet. If redis can't be reached nonces are checked against a bounded in process
+window instead, so requests are still served by the worker they reach. Nonces recorded in
+that window are also checked once redis is back, until they expire.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+import redis
+
+
+class NonceStats:
+    """
+    Per process counters of redis round trips and fallbacks to the local window
+    """
+
+    def __init__(self):
+        self.redis_calls = 0
+        self.redis_seconds = 0.0
+        self.fallbacks = 0
+
+    @property
+    def mean_redis_latency(self):
+        return self.redis_seconds / self.redis_calls if self.redis_calls else 0.0
+
+
+stats = NonceStats()
+
+
+class NonceStore:
+    def __init__(self, ttl, maxsize, clock=time.monotonic):
+        """
+        :param
+            ttl: seconds a nonce is remembered for
+            maxsize: maximum number of nonces in the local window, the oldest are dropped
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._window = OrderedDict()
+
+    def seen(self, client, key):
+        """
+        Records key, returning True if it was already recorded within the ttl
+        """
+        start = time.perf_counter()
+        try:
+            added = client.set(key, 'True', ex=self.ttl, nx=True)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'failed to check nonce, using local window: {str(e)}')
+            stats.fallbacks += 1
+            return self._seen_locally(key, record=True)
+        finally:
+            stats.redis_calls += 1
+            stats.redis_seconds += time.perf_counter() - start
+        return not added or self._seen_locally(key, record=False)
+
+    def _seen_locally(self, key, record):
+        now = self.clock()
+        while self._window and next(iter(self._window.values())) <= now:
+            self._window.popitem(last=False)
+        if key in self._window:
+            return True
+        if record:
+            self._window[key] = now + self.ttl
+            while len(self._window) > self.maxsize:
+                self._window.popitem(last=False)
+        return False
@@ -1,3 +1,5 @@
+from app.api.validation import SchemaValidator
+
 COMPANY_MATCH_BODY = {
     "$schema": "http://json-schema.org/draft-07/schema#",
     "title": "Matching query",
@@ -67,3 +69,12 @@ COMPANY_UPDATE_BODY = {
     },
     "required": ["descriptions"],
 }
+
+COMPANY_MATCH_VALIDATOR = SchemaValidator(COMPANY_MATCH_BODY)
+COMPANY_MATCH_DESCRIPTION_VALIDATOR = SchemaValidator(
+    COMPANY_MATCH_BODY['properties']['descriptions']['items']
+)
+COMPANY_UPDATE_VALIDATOR = SchemaValidator(COMPANY_UPDATE_BODY)
+COMPANY_UPDATE_DESCRIPTION_VALIDATOR = SchemaValidator(
+    COMPANY_UPDATE_BODY['properties']['descriptions']['items']
+)
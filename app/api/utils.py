@@ -1,15 +1,20 @@
+import io
 import json
+import time
 
-from jsonschema import FormatChecker, validate
+import orjson
+from flask import current_app, Response
 from jsonschema.exceptions import ValidationError
 from werkzeug.exceptions import BadRequest
 
+from app import metrics
 
-def get_verified_data(request, schema):
+
+def get_verified_data(request, validator):
     """
     :param
         request: request object
-        schema: json schema to validate against
+        validator: SchemaValidator of the json schema to validate against
 
     :return: dict
         data is verified against a JSON schema and errors are raised accordingly
@@ -20,7 +25,8 @@ def get_verified_data(request, schema):
     except ValueError:
         raise BadRequest("Unable to read JSON payload")
     try:
-        validate(data, schema, format_checker=FormatChecker())
+        with metrics.timed('validation'):
+            validator.validate(data)
     except ValidationError as e:
         xcpt = BadRequest(e.message)
         xcpt.data = {"source": {"path": schema_validation_error_path(e)}}
@@ -28,6 +34,45 @@ def get_verified_data(request, schema):
     return data
 
 
+def iter_verified_descriptions(request, validator):
+    """
+    :param
+        request: request object with an application/x-ndjson body, one description per line
+        validator: SchemaValidator of the json schema of a single description
+
+    :return: generator of dicts
+        lines are decoded and verified one at a time while the generator is consumed,
+        errors are raised with the same source/pointer as for the JSON body
+    """
+    if current_app.config['access_control']['hawk_enabled']:
+        # hawk has already read the whole body to check its hash
+        stream = io.BytesIO(request.get_data())
+    else:
+        stream = request.stream
+    i = 0
+    validation_seconds = 0.0
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            description = json.loads(line.decode('utf-8'))
+        except ValueError:
+            raise BadRequest("Unable to read JSON payload")
+        start = time.perf_counter()
+        try:
+            validator.validate(description)
+        except ValidationError as e:
+            xcpt = BadRequest(e.message)
+            path = schema_validation_error_path(e)
+            xcpt.data = {"source": {"path": f"/descriptions/{i}{path if path != '/' else ''}"}}
+            raise xcpt
+        validation_seconds += time.perf_counter() - start
+        yield description
+        i += 1
+    # lines are validated while they are loaded, only the time spent validating is observed
+    metrics.observe('validation', validation_seconds)
+
+
 def schema_validation_error_path(e):
     """
     :param e: a Schema ValidationError instance
@@ -40,3 +85,33 @@ def schema_validation_error_path(e):
     while len(e.path) > 0:
         path += "/{}".format(e.path.popleft())
     return path or "/"
+
+
+def matches_response(rows, candidates=None):
+    """
+    :param
+        rows: (id, match_id, similarity) rows
+        candidates: dict of id to list of (match_id, score) or None, added to each match
+    :return: application/json response of the matches, encoded straight to bytes
+    """
+    matches = [{'id': row[0], 'match_id': row[1], 'similarity': row[2]} for row in rows]
+    if candidates is not None:
+        for match in matches:
+            found = candidates.get(match['id'])
+            match['candidates'] = (
+                None
+                if found is None
+                else [{'match_id': match_id, 'score': score} for match_id, score in found]
+            )
+    body = orjson.dumps({'matches': matches}, option=orjson.OPT_APPEND_NEWLINE)
+    return Response(body, mimetype='application/json')
+
+
+def encode_match_line(row):
+    """
+    :return: the match of a (id, match_id, similarity) row as one application/x-ndjson line
+    """
+    return orjson.dumps(
+        {'id': row[0], 'match_id': row[1], 'similarity': row[2]},
+        option=orjson.OPT_APPEND_NEWLINE,
+    )
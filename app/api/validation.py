@@ -0,0 +1,123 @@
+"""
+Request validation against the JSON schemas of schema.py, compiled once
+
+jsonschema.validate checks the schema and builds a validator on every call, then walks
+each description through every keyword. The schema is instead compiled into plain python
+checks which only answer whether an instance is valid. Invalid instances, the rare case,
+are handed to a prebuilt jsonschema validator so that errors are exactly the ones
+jsonschema.validate would raise.
+
+Only the keywords used by our schemas are supported, compiling a schema with any other
+keyword fails rather than silently ignoring it.
+"""
+
+import re
+
+from jsonschema import Draft7Validator, FormatChecker
+from jsonschema.exceptions import best_match
+
+_ANNOTATIONS = {'$schema', 'title', 'description'}
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'null': type(None),
+}
+
+
+class SchemaValidator:
+    def __init__(self, schema):
+        Draft7Validator.check_schema(schema)
+        self.schema = schema
+        self.is_valid = compile_schema(schema)
+        self._validator = Draft7Validator(schema, format_checker=FormatChecker())
+
+    def validate(self, instance):
+        """
+        :raises jsonschema.exceptions.ValidationError: the error jsonschema.validate would raise
+        """
+        if not self.is_valid(instance):
+            error = best_match(self._validator.iter_errors(instance))
+            if error is not None:
+                raise error
+
+
+def compile_schema(schema):
+    """
+    :return: function of an instance returning True if it is valid against schema
+    """
+    checks = []
+    for keyword, value in schema.items():
+        if keyword in _ANNOTATIONS:
+            continue
+        compile_keyword = _KEYWORDS.get(keyword)
+        if compile_keyword is None:
+            raise ValueError(f'unsupported schema keyword: {keyword}')
+        checks.append(compile_keyword(value))
+    if len(checks) == 1:
+        return checks[0]
+    return lambda instance: all(check(instance) for check in checks)
+
+
+def _type(value):
+    if value not in _TYPES:
+        raise ValueError(f'unsupported type: {value}')
+    python_type = _TYPES[value]
+    return lambda instance: isinstance(instance, python_type)
+
+
+def _properties(value):
+    properties = [(name, compile_schema(schema)) for name, schema in value.items()]
+
+    def check(instance):
+        if not isinstance(instance, dict):
+            return True
+        for name, is_valid in properties:
+            if name in instance and not is_valid(instance[name]):
+                return False
+        return True
+
+    return check
+
+
+def _required(value):
+    required = list(value)
+    return lambda instance: not isinstance(instance, dict) or all(
+        name in instance for name in required
+    )
+
+
+def _items(value):
+    is_valid = compile_schema(value)
+    return lambda instance: not isinstance(instance, list) or all(map(is_valid, instance))
+
+
+def _any_of(value):
+    schemas = [compile_schema(schema) for schema in value]
+    return lambda instance: any(is_valid(instance) for is_valid in schemas)
+
+
+def _min_length(value):
+    return lambda instance: not isinstance(instance, str) or len(instance) >= value
+
+
+def _max_length(value):
+    return lambda instance: not isinstance(instance, str) or len(instance) <= value
+
+
+def _pattern(value):
+    pattern = re.compile(value)
+    return lambda instance: not isinstance(instance, str) or pattern.search(instance) is not None
+
+
+_KEYWORDS = {
+    'type': _type,
+    'properties': _properties,
+    'required': _required,
+    'items': _items,
+    'anyOf': _any_of,
+    'minLength': _min_length,
+    'maxLength': _max_length,
+    'pattern': _pattern,
+}
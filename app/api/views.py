@@ -1,25 +1,40 @@
 import logging
 from functools import wraps
 
-import redis
-from flask import current_app as app, make_response, request
-from flask import jsonify
+from flask import current_app as app, g, make_response, request, Response, url_for
+from flask import jsonify, stream_with_context
 from flask.blueprints import Blueprint
 from werkzeug.exceptions import BadRequest, NotFound, Unauthorized
 
+from app import metrics
 from app.algorithm import Matcher
+from app.algorithm.fuzzy_names import get_fuzzy_names
 from app.api.access_control import AccessControl
-from app.api.schema import COMPANY_MATCH_BODY, COMPANY_UPDATE_BODY
-from app.api.utils import get_verified_data
-from app.db.models import HawkUsers
+from app.api.schema import (
+    COMPANY_MATCH_DESCRIPTION_VALIDATOR,
+    COMPANY_MATCH_VALIDATOR,
+    COMPANY_UPDATE_DESCRIPTION_VALIDATOR,
+    COMPANY_UPDATE_VALIDATOR,
+)
+from app.api.utils import (
+    encode_match_line,
+    get_verified_data,
+    iter_verified_descriptions,
+    matches_response,
+)
+from app.db.models import MatchGroup, UpdateJob
+from app.export import export_chunks, FORMATS
+from app.jobs import enqueue_update
 
 api = Blueprint(name="api", import_name=__name__)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
 ac = AccessControl()
 
 
 @ac.client_key_loader
 def get_client_key(client_id):
-    client_key = HawkUsers.get_client_key(client_id)
+    client_key, _ = _get_client_credentials(client_id)
     if client_key:
         return client_key
     else:
@@ -28,27 +43,26 @@ def get_client_key(client_id):
 
 @ac.client_scope_loader
 def get_client_scope(client_id):
-    client_scope = HawkUsers.get_client_scope(client_id)
+    _, client_scope = _get_client_credentials(client_id)
     if client_scope:
         return client_scope
     else:
         raise LookupError()
 
 
+def _get_client_credentials(client_id):
+    # key and scope are both loaded for each request, look them up once
+    cached = g.get('hawk_credentials')
+    if cached is None or cached[0] != client_id:
+        cached = (client_id, app.hawk_credentials.get(client_id) or (None, None))
+        g.hawk_credentials = cached
+    return cached[1]
+
+
 @ac.nonce_checker
 def seen_nonce(sender_id, nonce, timestamp):
     key = f'{sender_id}:{nonce}:{timestamp}'
-    try:
-        if app.cache.get(key):
-            # We have already processed this nonce + timestamp.
-            return True
-        else:
-            # Save this nonce + timestamp for later.
-            app.cache.set(key, 'True', ex=300)
-            return False
-    except redis.exceptions.ConnectionError as e:
-        logging.error(f'failed to connect to caching server: {str(e)}')
-        return True
+    return app.nonce_store.seen(app.cache, key)
 
 
 def json_error(f):
@@ -80,54 +94,194 @@ def healthcheck():
     return jsonify({"status": "OK"})
 
 
+@api.route('/metrics', methods=["GET"])
+def prometheus_metrics():
+    if not metrics.enabled():
+        raise NotFound()
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
+
 @api.route('/api/v1/company/update/', methods=['POST'])
 @json_error
 @ac.authentication_required
 @ac.authorization_required
 def update():
-    query = get_verified_data(request, COMPANY_UPDATE_BODY)
-
-    dnb_match = request.args.get('dnb_match', 'false')
-    if dnb_match not in ['true', 'false']:
-        raise BadRequest('invalid dnb_match parameter. needs to be true or false')
-    dnb_match = dnb_match == 'true'
-
-    match = request.args.get('match', 'true' if not dnb_match else 'false')
-    if match not in ['true', 'false']:
-        raise BadRequest('invalid match parameter. needs to be true or false')
-    match = match == 'true'
+    match, dnb_match = _update_parameters()
+    metrics.start_request(match, dnb_match)
+    if request.mimetype == NDJSON_MIMETYPE:
+        descriptions = iter_verified_descriptions(request, COMPANY_UPDATE_DESCRIPTION_VALIDATOR)
+        matches = Matcher().match_stream(
+            descriptions, update=True, match=match, dnb_match=dnb_match
+        )
+        if match or dnb_match:
+            return _ndjson_response(matches)
+        matches.close()
+        return '', 204
 
-    if match and dnb_match:
-        raise BadRequest('only one of match and dnb_match parameter can be true')
+    query = get_verified_data(request, COMPANY_UPDATE_VALIDATOR)
 
     matcher = Matcher()
     matches = matcher.match(query['descriptions'], update=True, match=match, dnb_match=dnb_match)
 
     if match or dnb_match:
-        result = {'matches': []}
-        for row in matches:
-            result['matches'].append({'id': row[0], 'match_id': row[1], 'similarity': row[2]})
-        return jsonify(result)
+        return matches_response(matches)
     else:
         return '', 204
 
 
+@api.route('/api/v1/company/update/async/', methods=['POST'])
+@json_error
+@ac.authentication_required
+@ac.authorization_required
+def update_async():
+    match, dnb_match = _update_parameters()
+    metrics.start_request(match, dnb_match)
+    query = get_verified_data(request, COMPANY_UPDATE_VALIDATOR)
+
+    job_id = enqueue_update(query['descriptions'], match, dnb_match)
+
+    response = jsonify({'job_id': job_id, 'status': 'queued'})
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.update_job', job_id=job_id)
+    return response
+
+
+@api.route('/api/v1/company/update/jobs/<job_id>/', methods=['GET'])
+@json_error
+@ac.authentication_required
+@ac.authorization_required
+def update_job(job_id):
+    job = UpdateJob.get_job(job_id)
+    if not job:
+        raise NotFound()
+
+    result = {
+        'job_id': job.id,
+        'status': job.status,
+        'created': job.created.isoformat(),
+        'started': job.started.isoformat() if job.started else None,
+        'finished': job.finished.isoformat() if job.finished else None,
+    }
+    if job.status == 'finished' and job.matches is not None:
+        result['matches'] = job.matches
+    return jsonify(result)
+
+
+@api.route('/api/v1/company/group/<int:match_id>/', methods=['GET'])
+@json_error
+@ac.authentication_required
+@ac.authorization_required
+def match_group(match_id):
+    members = MatchGroup.get_members(match_id)
+    if not members:
+        raise NotFound()
+
+    result = {
+        'match_id': match_id,
+        'members': [
+            {
+                'field': member.field,
+                'value': member.value,
+                'source': member.source,
+                'datetime': member.datetime.isoformat(),
+            }
+            for member in members
+        ],
+    }
+    return jsonify(result)
+
+
+@api.route('/api/v1/company/export/', methods=['GET'])
+@json_error
+@ac.authentication_required
+@ac.authorization_required
+def export():
+    export_format = request.args.get('format', 'csv')
+    try:
+        chunks = export_chunks(
+            fields=_list_parameter('fields'),
+            export_format=export_format,
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            sources=_list_parameter('source'),
+        )
+    except ValueError as e:
+        raise BadRequest(str(e))
+    return Response(stream_with_context(chunks), mimetype=FORMATS[export_format])
+
+
 @api.route('/api/v1/company/match/', methods=['POST'])
 @json_error
 @ac.authentication_required
 @ac.authorization_required
 def match():
-    query = get_verified_data(request, COMPANY_MATCH_BODY)
-
     dnb_match = request.args.get('dnb_match', 'false')
     if dnb_match not in ['true', 'false']:
         raise BadRequest('invalid dnb_match parameter. needs to be true or false')
     dnb_match = dnb_match == 'true'
+    fuzzy_name = request.args.get('fuzzy_name', 'false')
+    if fuzzy_name not in ['true', 'false']:
+        raise BadRequest('invalid fuzzy_name parameter. needs to be true or false')
+    fuzzy_name = fuzzy_name == 'true'
+    metrics.start_request(match=not dnb_match, dnb_match=dnb_match)
+
+    ndjson = request.mimetype == NDJSON_MIMETYPE
+    if fuzzy_name:
+        fuzzy_names = get_fuzzy_names()
+        if fuzzy_names is None:
+            raise BadRequest('fuzzy_name matching is not enabled')
+        if dnb_match:
+            raise BadRequest('fuzzy_name and dnb_match cannot both be true')
+        if ndjson:
+            raise BadRequest('fuzzy_name is not supported for application/x-ndjson requests')
+    if not ndjson:
+        query = get_verified_data(request, COMPANY_MATCH_VALIDATOR)
+
+    if ndjson:
+        descriptions = iter_verified_descriptions(request, COMPANY_MATCH_DESCRIPTION_VALIDATOR)
+        matches = Matcher().match_stream(descriptions, update=False, dnb_match=dnb_match)
+        return _ndjson_response(matches)
 
     matcher = Matcher()
     matches = matcher.match(query['descriptions'], update=False, dnb_match=dnb_match)
+    if fuzzy_name:
+        return matches_response(matches, fuzzy_names.candidates(query['descriptions']))
 
-    result = {'matches': []}
-    for row in matches:
-        result['matches'].append({'id': row[0], 'match_id': row[1], 'similarity': row[2]})
-    return jsonify(result)
+    return matches_response(matches)
+
+
+def _update_parameters():
+    dnb_match = request.args.get('dnb_match', 'false')
+    if dnb_match not in ['true', 'false']:
+        raise BadRequest('invalid dnb_match parameter. needs to be true or false')
+    dnb_match = dnb_match == 'true'
+
+    match = request.args.get('match', 'true' if not dnb_match else 'false')
+    if match not in ['true', 'false']:
+        raise BadRequest('invalid match parameter. needs to be true or false')
+    match = match == 'true'
+
+    if match and dnb_match:
+        raise BadRequest('only one of match and dnb_match parameter can be true')
+    return match, dnb_match
+
+
+def _list_parameter(name):
+    value = request.args.get(name)
+    return value.split(',') if value else None
+
+
+def _ndjson_response(matches):
+    """
+    Streams one match per line, the matches are only read while the response is sent
+    """
+
+    def generate():
+        try:
+            for row in matches:
+                yield encode_match_line(row)
+        finally:
+            matches.close()
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
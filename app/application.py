@@ -10,8 +10,11 @@ from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session
 
 from app import config
+from app.api.credentials import CredentialsCache
+from app.api.nonces import NonceStore
 from app.api.views import api
 from app.commands.dev import cmd_group as dev_cmd
+from app.db.models import HawkUsers
 
 sentry_sdk.init(
     dsn=os.environ.get('SENTRY_DSN'),
@@ -82,6 +85,16 @@ def _register_components(flask_app):
     flask_app.register_blueprint(api)
     redis_uri = _get_redis_url(flask_app)
     flask_app.cache = redis.from_url(redis_uri)
+    flask_app.hawk_credentials = CredentialsCache(
+        HawkUsers.get_client_credentials,
+        flask_app.cache,
+        maxsize=flask_app.config['access_control']['hawk_credentials_cache_size'],
+        ttl=flask_app.config['access_control']['hawk_credentials_cache_ttl'],
+        poll_interval=float(flask_app.config['access_control']['hawk_credentials_poll_interval']),
+    )
+    flask_app.nonce_store = NonceStore(
+        ttl=300, maxsize=flask_app.config['access_control']['hawk_nonce_fallback_size']
+    )
     return flask_app
 
 
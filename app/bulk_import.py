@@ -0,0 +1,223 @@
+"""
+Offline import of a file of company descriptions, see `flask dev import`
+
+The file is either CSV, with a header line naming the fields of the descriptions, or NDJSON,
+one description per line, with the descriptions of update request bodies. It is read in one
+pass: each description is validated, streamed into a staging table with COPY and normalised
+there like the descriptions of the update endpoint. They are logged as batches of
+batch_size descriptions, see description_log.py.
+
+The staged descriptions are read back in file order and grouped by the in-memory engine in
+batches of batch_size, as if each batch had been sent to the update endpoint in turn, on a
+single MappingState for the whole file. The mapping tables are written once at the end, only
+with the rows whose match_id changed. Which descriptions arrive together matters to the
+update rules, so the match_ids are the ones of sequential ingestion in requests of
+batch_size descriptions.
+
+Writes to the mapping tables are blocked for the duration of the import, matching is not.
+"""
+
+import csv
+import json
+import time
+from functools import partial
+
+from flask import current_app
+from jsonschema.exceptions import ValidationError
+
+from app.algorithm import _add_values, _fields
+from app.algorithm.bloom_filter import get_bloom_filters
+from app.algorithm.description_log import ensure_partition, log_staged
+from app.algorithm.in_memory import (
+    _allocate_match_ids,
+    _load_mapping_rows,
+    InMemoryEngine,
+    MappingState,
+    write_changes,
+)
+from app.algorithm.match_cache import get_match_cache
+from app.algorithm.normaliser import normalise_description
+from app.algorithm.sql_statements import (
+    _copy_value,
+    _description_columns,
+    _field_to_mapping_table,
+    _normalised_description_columns,
+    _plain_description_columns,
+)
+from app.api.schema import COMPANY_UPDATE_DESCRIPTION_VALIDATOR
+from app.db import db_utils
+
+FORMATS = ['csv', 'ndjson']
+
+# tmp_import_raw holds the descriptions as read, and their normalised values when they are
+# normalised in python
+_create_staging_tables = f"""
+    DROP TABLE IF EXISTS tmp_import_raw, tmp_import;
+    CREATE TEMPORARY TABLE tmp_import_raw (
+        position text,
+        {', '.join(f'{column} text' for column in _description_columns)},
+        {', '.join(f'normalised_{column} text' for column in _description_columns)}
+    ) ON COMMIT DROP;
+    CREATE TEMPORARY TABLE tmp_import (
+        position bigint,
+        {', '.join(
+            f"{column} {'timestamp' if column == 'datetime' else 'text'}"
+            for column in _description_columns
+        )}
+    ) ON COMMIT DROP;
+"""
+
+
+def read_descriptions(lines, file_format='csv'):
+    """
+    :param lines: iterable of the lines of the file
+    :return: generator of (line number, description), empty CSV values are left out
+    :raises ValueError: on an unknown format or a line that isn't valid JSON
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"format needs to be one of {', '.join(FORMATS)}")
+    if file_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, {k: v for k, v in row.items() if k is not None and v}
+        return
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'line {line_number}: {e}')
+
+
+def validated(descriptions):
+    """
+    :param descriptions: iterable of (line number, description)
+    :return: generator of the descriptions
+    :raises ValueError: on the first description which isn't valid in an update request
+    """
+    for line_number, description in descriptions:
+        try:
+            COMPANY_UPDATE_DESCRIPTION_VALIDATOR.validate(description)
+        except ValidationError as e:
+            raise ValueError(f'line {line_number}: {e.message}')
+        yield description
+
+
+def import_descriptions(lines, file_format='csv', batch_size=1000):
+    """
+    :param
+        lines: iterable of the lines of the file
+        batch_size: number of descriptions grouped together, as in one update request
+    :return: dict of statistics, see summary()
+    :raises ValueError: on an invalid file, nothing is imported
+    """
+    config = current_app.config['matching']
+    bloom_filters = get_bloom_filters()
+    values = {field: set() for field in _fields}
+    stats = {'descriptions': 0, 'batches': 0}
+    start = time.perf_counter()
+    log = config['description_log']
+    if log:
+        # before the mapping tables are locked, see description_log.py
+        logged_at = ensure_partition()
+    with db_utils.pipeline() as pipeline:
+        pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+        pipeline.queue(
+            f"LOCK TABLE {', '.join(mt for _, mt in _field_to_mapping_table)} IN EXCLUSIVE MODE;"
+        )
+        descriptions = validated(read_descriptions(lines, file_format))
+        _stage(pipeline, descriptions, config['normalisation'] == 'db', config['copy_format'])
+        if log:
+            log_staged(pipeline, 'tmp_import_raw', batch_size, logged_at)
+        pipeline.flush()
+        stats['staging'] = time.perf_counter() - start
+
+        # on empty tables there is nothing to load, the state starts out complete
+        loader = None if _mapping_tables_empty(pipeline) else partial(_load_mapping_rows, pipeline)
+        state = MappingState(loader=loader)
+        engine = InMemoryEngine(state, allocate_match_ids=partial(_allocate_match_ids, pipeline))
+        stmt = f"select datetime, source, {', '.join(_fields)} from tmp_import order by position"
+        for rows in pipeline.stream(stmt, batch_size=batch_size):
+            batch = [dict(row._mapping) for row in rows]
+            engine.update(batch)
+            if bloom_filters:
+                for d in batch:
+                    _add_values(values, d)
+            stats['descriptions'] += len(batch)
+            stats['batches'] += 1
+        stats['grouping'] = time.perf_counter() - start - stats['staging']
+
+        write_changes(pipeline, state)
+        pipeline.flush()
+        # before the import commits, see bloom_filter.py
+        if bloom_filters:
+            bloom_filters.add(values)
+    stats['rows_written'] = sum(len(changed) for changed in state.changed.values())
+    stats['seconds'] = time.perf_counter() - start
+    stats['writing'] = stats['seconds'] - stats['staging'] - stats['grouping']
+    cache = get_match_cache()
+    if cache and stats['rows_written']:
+        cache.bump_generation()
+    return stats
+
+
+def summary(stats):
+    """
+    :return: list of report lines
+    """
+    per_second = stats['descriptions'] / stats['seconds'] if stats['seconds'] else 0
+    return [
+        f"descriptions: {stats['descriptions']} in {stats['batches']} batches",
+        f"staging: {stats['staging']:.1f}s",
+        f"grouping: {stats['grouping']:.1f}s",
+        f"writing: {stats['writing']:.1f}s, {stats['rows_written']} mapping rows",
+        f"total: {stats['seconds']:.1f}s, {per_second:.0f} descriptions/s",
+    ]
+
+
+def _stage(pipeline, descriptions, normalise_in_db, copy_format):
+    """
+    Copies the descriptions into tmp_import_raw and normalises them into tmp_import
+    """
+    pipeline.queue(_create_staging_tables)
+    rows = (
+        (str(position),)
+        + tuple(_copy_value(d.get(column)) for column in _description_columns)
+        + (
+            (None,) * len(_description_columns)
+            if normalise_in_db
+            else tuple(normalise_description(d)[column] for column in _description_columns)
+        )
+        for position, d in enumerate(descriptions)
+    )
+    columns = (
+        ['position']
+        + _description_columns
+        + [f'normalised_{column}' for column in _description_columns]
+    )
+    pipeline.copy_from_rows('tmp_import_raw', columns, rows, copy_format=copy_format)
+    if normalise_in_db:
+        normalised = 'tmp_import_raw'
+    else:
+        normalised = f"""(
+            select position, {', '.join(
+                f'normalised_{column} as {column}' for column in _description_columns
+            )}
+            from tmp_import_raw
+        ) normalised"""
+    stmt = f"""
+        INSERT INTO tmp_import (position, {', '.join(_description_columns)})
+        SELECT
+            position::bigint,
+            {_normalised_description_columns if normalise_in_db else _plain_description_columns}
+        FROM {normalised};
+    """
+    pipeline.queue(stmt)
+
+
+def _mapping_tables_empty(pipeline):
+    stmt = 'select ' + ' and '.join(
+        f'not exists (select from {mt})' for _, mt in _field_to_mapping_table
+    )
+    return pipeline.query(stmt)[0][0]
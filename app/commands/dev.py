@@ -1,9 +1,31 @@
+import json
+
 import click
 import sqlalchemy_utils
 from flask import current_app as app
 from flask.cli import AppGroup, with_appcontext
 
-from app.db.models import HawkUsers
+from app.algorithm import profiler
+from app.algorithm.bloom_filter import get_bloom_filters
+from app.algorithm.fuzzy_names import get_fuzzy_names
+from app.algorithm.sql_statements import (
+    backfill_group_tables,
+    bulk_ingest as unlogged_mapping_tables,
+    mapping_tables_logged,
+    set_mapping_tables_logged,
+)
+from app.bulk_import import (
+    FORMATS as IMPORT_FORMATS,
+    import_descriptions,
+    summary as import_summary,
+)
+from app.db import db_utils
+from app.db.indexes import apply_indexes, index_status
+from app.db.models import HawkUsers, LatestDunsByMatchId, MatchGroup
+from app.export import export_chunks, FIELDS, FORMATS
+from app.jobs import run_worker
+from app.rebuild import rebuild_mapping_tables, REPLAY_BATCH_SIZE, summary as rebuild_summary
+from app.replay import load_requests, replay as replay_requests, summary
 
 cmd_group = AppGroup('dev', help='Commands to build database')
 
@@ -76,3 +98,262 @@ def add_hawk_user(client_id, client_key, client_scope, description):
             client_scope=client_scope_list,
             description=description,
         )
+
+
+@cmd_group.command('bulk_ingest')
+@with_appcontext
+@click.option(
+    '--start', is_flag=True, help='Switch the mapping tables to unlogged before an import job',
+)
+@click.option(
+    '--finish', is_flag=True, help='Switch the mapping tables back to logged after an import job',
+)
+def bulk_ingest(start, finish):
+    """
+    Switch the mapping tables between unlogged (bulk ingest) and logged mode.
+    Unlogged tables are truncated after a crash, finish the import job with --finish.
+    """
+    if start == finish:
+        ctx = click.get_current_context()
+        click.echo(ctx.get_help())
+    else:
+        with db_utils.pipeline() as pipeline:
+            set_mapping_tables_logged(pipeline, logged=finish)
+    with db_utils.pipeline() as pipeline:
+        for table, logged in sorted(mapping_tables_logged(pipeline).items()):
+            click.echo(f"{table}: {'logged' if logged else 'unlogged'}")
+
+
+@cmd_group.command('bloom_filters')
+@with_appcontext
+@click.option(
+    '--build', is_flag=True, help='Build the bloom filters from the mapping tables',
+)
+def bloom_filters(build):
+    """
+    Build the bloom filters of the mapping tables, they are only used once built.
+    Run again after enabling the filters or changing their size.
+    """
+    filters = get_bloom_filters()
+    if not filters:
+        click.echo('bloom filters are disabled')
+        return
+    if build:
+        with db_utils.pipeline() as pipeline:
+            filters.build(pipeline)
+    for field, ready in filters.ready().items():
+        click.echo(f"{field}: {'ready' if ready else 'not built'}")
+
+
+@cmd_group.command('fuzzy_names')
+@with_appcontext
+@click.option(
+    '--build', is_flag=True, help='Build the fuzzy name index from company_name_mapping',
+)
+def fuzzy_names(build):
+    """
+    Build the fuzzy name index, the processes load it once built. Run again, e.g. from cron,
+    for new names to become candidates.
+    """
+    names = get_fuzzy_names()
+    if not names:
+        click.echo('fuzzy name matching is disabled')
+        return
+    if build:
+        names.build()
+    status = names.status()
+    if status is None:
+        click.echo('fuzzy name index: not built')
+    else:
+        click.echo(f"fuzzy name index: {status['names']} names, built at {status['built_at']}")
+
+
+@cmd_group.command('group_tables')
+@with_appcontext
+@click.option(
+    '--backfill', is_flag=True, help='Fill the group tables from the mapping tables',
+)
+def group_tables(backfill):
+    """
+    Fill match_group and latest_duns_by_match_id from the mapping tables, once after creating
+    them on an existing database. update_mappings keeps them in sync afterwards.
+    """
+    models = [MatchGroup, LatestDunsByMatchId]
+    if backfill:
+        for model in models:
+            model.__table__.create(app.db.engine, checkfirst=True)
+        with db_utils.pipeline() as pipeline:
+            backfill_group_tables(pipeline)
+    for model in models:
+        click.echo(f'{model.__tablename__}: {model.query.count()} rows')
+
+
+@cmd_group.command('worker')
+@with_appcontext
+@click.option('--once', is_flag=True, help='Stop once there are no queued jobs left')
+def worker(once):
+    """
+    Run queued asynchronous update jobs
+    """
+    run_worker(app.config['jobs']['poll_interval'], once=once)
+
+
+@cmd_group.command('profile')
+@with_appcontext
+@click.argument('payload', type=click.File('r'))
+@click.option('--dnb_match', is_flag=True, help='Profile the dnb_match query')
+@click.option('--top', type=int, default=20, help='Number of plan nodes to report')
+@click.option('--plans', type=click.File('w'), help='Write the plans as JSON to this file')
+def profile(payload, dnb_match, top, plans):
+    """
+    Run an update of the descriptions of an update request body in PAYLOAD with
+    EXPLAIN (ANALYZE, BUFFERS) and report the slowest statements and plan nodes.
+    The update is rolled back.
+    """
+    descriptions = json.load(payload)['descriptions']
+    statement_plans = profiler.profile(descriptions, dnb_match=dnb_match)
+    for line in profiler.report(statement_plans, top=top):
+        click.echo(line)
+    if plans:
+        json.dump([{'name': p.name, 'plan': p.plan} for p in statement_plans], plans, indent=2)
+
+
+@cmd_group.command('replay')
+@click.argument('requests_file', type=click.File('r'))
+@click.option('--url', default='http://localhost:5000', help='Base url of the API')
+@click.option('--client_id', envvar='CMS_REPLAY_CLIENT_ID', help='hawk client id')
+@click.option('--client_key', envvar='CMS_REPLAY_CLIENT_KEY', help='hawk client key')
+@click.option('--concurrency', type=int, default=1, help='Number of requests sent at once')
+@click.option('--rate', type=float, help='Requests per second, as fast as possible if not set')
+@click.option('--repeat', type=int, default=1, help='Number of times the file is replayed')
+def replay(requests_file, url, client_id, client_key, concurrency, rate, repeat):
+    """
+    Replay the requests of a JSONL file against a running API, signed with hawk
+    credentials, and report latency percentiles, status codes and throughput.
+    """
+    if not all([client_id, client_key]):
+        click.echo('client_id and client_key are required')
+        ctx = click.get_current_context()
+        click.echo(ctx.get_help())
+        return
+    to_send = load_requests(requests_file) * repeat
+    elapsed, results = replay_requests(
+        url, to_send, client_id, client_key, concurrency=concurrency, rate=rate
+    )
+    for line in summary(elapsed, results):
+        click.echo(line)
+
+
+@cmd_group.command('indexes')
+@with_appcontext
+@click.option(
+    '--apply', is_flag=True, help='Create missing indexes and drop obsolete ones, concurrently',
+)
+def indexes(apply):
+    """
+    Show the status of the indexes of the mapping tables, and migrate them online with --apply
+    """
+    if apply:
+        apply_indexes(echo=click.echo)
+    for name, status in index_status().items():
+        click.echo(f'{name}: {status}')
+
+
+@cmd_group.command('export')
+@with_appcontext
+@click.argument('output', type=click.File('wb'))
+@click.option(
+    '--fields',
+    help=f"Comma separated fields whose mapping tables are exported, of {', '.join(FIELDS)}",
+)
+@click.option('--format', 'export_format', type=click.Choice(list(FORMATS)), default='csv')
+@click.option('--since', help='Only rows with a datetime from this one, YYYY-MM-DD HH:MM:SS')
+@click.option('--until', help='Only rows with a datetime before this one')
+@click.option('--source', help='Comma separated sources to export')
+def export(output, fields, export_format, since, until, source):
+    """
+    Export the mapping tables to OUTPUT as CSV or NDJSON, - for stdout
+    """
+    try:
+        chunks = export_chunks(
+            fields=fields.split(',') if fields else None,
+            export_format=export_format,
+            since=since,
+            until=until,
+            sources=source.split(',') if source else None,
+        )
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    for chunk in chunks:
+        output.write(chunk)
+
+
+@cmd_group.command('import')
+@with_appcontext
+@click.argument('input_file', type=click.File('r'))
+@click.option('--format', 'import_format', type=click.Choice(IMPORT_FORMATS), default='csv')
+@click.option(
+    '--batch_size',
+    type=click.IntRange(min=1),
+    default=1000,
+    help='Number of descriptions grouped together, as in one update request',
+)
+@click.option(
+    '--unlogged', is_flag=True, help='Switch the mapping tables to unlogged during the import',
+)
+def import_file(input_file, import_format, batch_size, unlogged):
+    """
+    Import the company descriptions of INPUT_FILE, CSV with a header line or NDJSON, - for
+    stdin. The match_ids are the ones of update requests of batch_size descriptions sent in
+    file order. Nothing is imported if any description is invalid.
+    """
+    try:
+        if unlogged:
+            with unlogged_mapping_tables():
+                stats = import_descriptions(input_file, import_format, batch_size)
+        else:
+            stats = import_descriptions(input_file, import_format, batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for line in import_summary(stats):
+        click.echo(line)
+
+
+@cmd_group.command('rebuild')
+@with_appcontext
+@click.option(
+    '--batch_size',
+    type=click.IntRange(min=1),
+    help='Replay the descriptions in datetime order in batches of this size, '
+    f'{REPLAY_BATCH_SIZE} by default',
+)
+@click.option(
+    '--as_logged',
+    is_flag=True,
+    help='Replay the logged updates in the order they ran instead',
+)
+@click.option(
+    '--in_db',
+    is_flag=True,
+    help='Group all logged descriptions at once in the database instead, '
+    'as a single update of all of them would',
+)
+@click.option('--yes', is_flag=True, help='Confirm that the live mapping tables are replaced')
+def rebuild(batch_size, as_logged, in_db, yes):
+    """
+    Rebuild the mapping tables from the description log with the current normalisation and
+    swap them in. Updates logged meanwhile are included, matching and updates only wait for
+    the swap.
+    """
+    if sum(bool(option) for option in (batch_size, as_logged, in_db)) > 1:
+        raise click.UsageError('--batch_size, --as_logged and --in_db are mutually exclusive')
+    if not yes:
+        raise click.UsageError('the live mapping tables are replaced, confirm with --yes')
+    try:
+        stats = rebuild_mapping_tables(
+            batch_size=batch_size or REPLAY_BATCH_SIZE, as_logged=as_logged, in_db=in_db
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for line in rebuild_summary(stats):
+        click.echo(line)
@@ -1,10 +1,20 @@
 import logging
+import queue
+import struct
+import threading
+from contextlib import contextmanager
 
+import psycopg2
 import sqlalchemy
 from sqlalchemy import text
 
+from app import metrics
 from app.db.models import sql_alchemy
 
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_BINARY_TRAILER = struct.pack('!h', -1)
+
 
 def execute_query(query, raise_if_fail=True):
     result_set = execute_statement(query, None, raise_if_fail)
@@ -34,3 +44,254 @@ def table_exists(schema, table_name, materialized_view=False):
      );
     """
     return list(execute_statement(query))[0][0]
+
+
+@contextmanager
+def pipeline():
+    """
+    Checks out one connection and opens one transaction for a unit of work,
+    committed when the block exits without error
+
+    :return: Pipeline
+    """
+    with _connect() as conn:
+        with conn.begin():
+            pipe = Pipeline(conn)
+            yield pipe
+            pipe.flush()
+
+
+def held_query(work, batch_size=10000):
+    """
+    Runs work(pipeline) in one transaction and keeps the rows of the query it returns in a
+    cursor WITH HOLD, which outlives the commit. The rows are then fetched in batches.
+
+    The generator has to be started with next() to run the transaction, after that it holds
+    on to the connection until it is exhausted or closed.
+
+    :param work: callable taking a Pipeline and returning a query or None
+    :return: generator of rows
+    """
+    with _connect() as conn:
+        with conn.begin():
+            pipe = Pipeline(conn)
+            stmt = work(pipe)
+            if stmt is not None:
+                pipe.queue(f'DECLARE held_rows NO SCROLL CURSOR WITH HOLD FOR {stmt};')
+            pipe.flush()
+        yield
+        if stmt is None:
+            return
+        try:
+            while True:
+                rows = conn.execute(text(f'FETCH FORWARD {batch_size} FROM held_rows')).fetchall()
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # held cursors survive the transaction, and would stay on the pooled connection
+            conn.rollback()
+            conn.execute(text('CLOSE held_rows'))
+            conn.commit()
+
+
+def copy_to_chunks(stmt, chunk_size=65536, max_chunks=16):
+    """
+    Runs stmt, a COPY ... TO STDOUT, on its own connection and yields its output as it
+    arrives, in chunks of about chunk_size bytes. COPY runs in a thread that waits once
+    max_chunks are ready, so a slow reader doesn't make the output pile up in memory.
+    Closing the generator early cancels the query.
+
+    :return: generator of bytes
+    """
+    with _connect() as conn:
+        dbapi_connection = conn.connection.dbapi_connection
+        writer = _QueueWriter(chunk_size, max_chunks)
+
+        def copy():
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.copy_expert(stmt, writer)
+                writer.flush()
+            except Exception as e:
+                writer.error = e
+            finally:
+                cursor.close()
+                writer.put(None)
+
+        thread = threading.Thread(target=copy, daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = writer.chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if thread.is_alive():
+                writer.cancelled = True
+                dbapi_connection.cancel()
+            thread.join()
+            dbapi_connection.rollback()
+        if writer.error is not None:
+            raise writer.error
+
+
+def _connect():
+    with metrics.timed('pool_checkout'):
+        return sql_alchemy.engine.connect()
+
+
+class Pipeline:
+    """
+    Runs statements on a single connection and transaction.
+
+    Statements that don't need an answer are queued and sent in the same round trip
+    as the next statement that does, or when the pipeline is flushed.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._queued = []
+
+    def queue(self, stmt):
+        self._queued.append(stmt)
+
+    def execute(self, stmt, data=None):
+        stmt = ''.join(self._queued + [stmt])
+        self._queued = []
+        try:
+            return self.connection.execute(text(stmt), data)
+        except sqlalchemy.exc.ProgrammingError as err:
+            logging.error(f'db error: {str(err)}')
+            raise err
+
+    def query(self, stmt, data=None):
+        return self.execute(stmt, data).fetchall()
+
+    def stream(self, stmt, data=None, batch_size=10000):
+        """
+        Runs a query with a server-side cursor
+
+        :return: iterator of lists of at most batch_size rows
+        """
+        self.flush()
+        stmt = text(stmt).execution_options(stream_results=True, yield_per=batch_size)
+        yield from self.connection.execute(stmt, data).partitions(batch_size)
+
+    def flush(self):
+        if self._queued:
+            self.execute('')
+
+    def copy_from_rows(self, table_name, columns, rows, copy_format='text'):
+        """
+        Streams rows into a table with COPY ... FROM STDIN
+
+        :param
+            table_name: table to copy into
+            columns: list of column names, all values are sent as text
+            rows: iterable of tuples (None for NULL), consumed lazily
+            copy_format: 'text' or 'binary'
+        """
+        if copy_format == 'text':
+            chunks = (_encode_text_row(row) for row in rows)
+        elif copy_format == 'binary':
+            chunks = _encode_binary_rows(rows)
+        else:
+            raise ValueError(f'unsupported copy format: {copy_format}')
+        self.flush()
+        stmt = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT {copy_format})"
+        cursor = self.connection.connection.cursor()
+        reader = _ChunkReader(chunks)
+        try:
+            cursor.copy_expert(stmt, reader)
+        except psycopg2.Error:
+            # psycopg2 wraps errors raised while reading, e.g. while validating the rows
+            if reader.error is not None:
+                raise reader.error
+            raise
+        finally:
+            cursor.close()
+
+
+def _encode_text_row(row):
+    return (
+        '\t'.join('\\N' if value is None else value.translate(_COPY_TEXT_ESCAPES) for value in row)
+        + '\n'
+    ).encode('utf-8')
+
+
+def _encode_binary_rows(rows):
+    yield _COPY_BINARY_HEADER
+    for row in rows:
+        chunk = [struct.pack('!h', len(row))]
+        for value in row:
+            if value is None:
+                chunk.append(struct.pack('!i', -1))
+            else:
+                value = value.encode('utf-8')
+                chunk.append(struct.pack('!i', len(value)))
+                chunk.append(value)
+        yield b''.join(chunk)
+    yield _COPY_BINARY_TRAILER
+
+
+class _QueueWriter:
+    """
+    Minimal file-like wrapper collecting the output of COPY ... TO into chunks
+    for the thread that reads them
+    """
+
+    def __init__(self, chunk_size, max_chunks):
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk_size = chunk_size
+        self.cancelled = False
+        self.error = None
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def put(self, chunk):
+        # once cancelled the output is dropped until the query stops
+        while not self.cancelled:
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+class _ChunkReader:
+    """
+    Minimal file-like wrapper so that psycopg2 can pull COPY data from
+    a generator of byte chunks without materialising the whole payload
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self.error = None
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                chunk = next(self._chunks, None)
+            except Exception as e:
+                self.error = e
+                raise
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
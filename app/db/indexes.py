@@ -0,0 +1,100 @@
+"""
+Online migration of the indexes of the mapping tables, see `flask dev indexes`
+
+update_mappings looks up the rows impacted by an update with joins on match_id and
+prev_match_id, and dnb_match looks up the latest duns_number of a match_id. These columns are
+indexed with b-trees, declared on the models. The hash indexes on the key columns are dropped,
+they duplicated the b-trees of the primary keys.
+
+Indexes are created and dropped CONCURRENTLY so that updates keep running meanwhile. A
+concurrent build that failed leaves an invalid index behind, which is dropped and rebuilt.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+from app.db.models import (
+    CDMSRefMapping,
+    CompaniesHouseIDMapping,
+    CompanyNameMapping,
+    ContactEmailMapping,
+    DunsNumberMapping,
+    PostcodeMapping,
+    sql_alchemy,
+)
+
+MAPPING_MODELS = [
+    CompaniesHouseIDMapping,
+    DunsNumberMapping,
+    CompanyNameMapping,
+    ContactEmailMapping,
+    CDMSRefMapping,
+    PostcodeMapping,
+]
+
+DROPPED_INDEXES = [
+    'companies_house_id_idx',
+    'duns_number_idx',
+    'company_name_idx',
+    'contact_email_idx',
+    'cdms_ref_idx',
+    'postcode_idx',
+]
+
+
+def declared_indexes():
+    return [index for model in MAPPING_MODELS for index in model.__table__.indexes]
+
+
+def index_status():
+    """
+    :return: dict of index name to 'valid', 'invalid', 'missing' or 'obsolete'
+    """
+    names = [index.name for index in declared_indexes()] + DROPPED_INDEXES
+    with sql_alchemy.engine.connect() as conn:
+        rows = conn.execute(
+            text(
+                """
+                select c.relname, i.indisvalid
+                from pg_index i join pg_class c on c.oid = i.indexrelid
+                where c.relname = any(:names) and pg_table_is_visible(c.oid)
+                """
+            ),
+            {'names': names},
+        ).fetchall()
+    existing = dict(rows)
+    status = {}
+    for index in declared_indexes():
+        valid = existing.get(index.name)
+        status[index.name] = 'missing' if valid is None else 'valid' if valid else 'invalid'
+    for name in DROPPED_INDEXES:
+        if name in existing:
+            status[name] = 'obsolete'
+    return status
+
+
+def apply_indexes(echo=print):
+    """
+    Creates the missing indexes and drops the obsolete ones, one statement at a time
+    """
+    status = index_status()
+    statements = []
+    for index in declared_indexes():
+        if status[index.name] == 'valid':
+            continue
+        if status[index.name] == 'invalid':
+            statements.append(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}')
+        statements.append(_create_concurrently(index))
+    for name in DROPPED_INDEXES:
+        if status.get(name) == 'obsolete':
+            statements.append(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    # CONCURRENTLY can't run in a transaction
+    with sql_alchemy.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for stmt in statements:
+            echo(stmt)
+            conn.execute(text(stmt))
+
+
+def _create_concurrently(index):
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=sql_alchemy.engine.dialect))
+    return ddl.replace('CREATE INDEX IF NOT EXISTS', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1)
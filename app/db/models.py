@@ -1,6 +1,9 @@
+from datetime import timedelta
+
 from flask import current_app as app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import DDL, Index, Sequence, text
+from sqlalchemy import and_, DDL, func, Index, or_, Sequence, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import ClauseElement
 
 db = SQLAlchemy()
@@ -12,9 +15,11 @@ _col = db.Column
 _array = db.ARRAY
 _text = db.Text
 _int = db.Integer
+_bigint = db.BigInteger
 _dt = db.DateTime
 _bool = db.Boolean
 _num = db.Numeric
+_jsonb = JSONB
 
 
 class BaseModel(db.Model):
@@ -59,7 +64,8 @@ class CompaniesHouseIDMapping(BaseModel):
     datetime = _col(_dt, nullable=False)
 
     __table_args__ = (
-        Index('companies_house_id_idx', 'companies_house_id', postgresql_using='hash'),
+        Index('companies_house_id_mapping_match_id_idx', 'match_id'),
+        Index('companies_house_id_mapping_prev_match_id_idx', 'prev_match_id'),
     )
 
 Sequence('match_id_seq', metadata=CompaniesHouseIDMapping.metadata)
@@ -75,7 +81,16 @@ class DunsNumberMapping(BaseModel):
     source = _col(_text, nullable=False)
     datetime = _col(_dt, nullable=False)
 
-    __table_args__ = (Index('duns_number_idx', 'duns_number', postgresql_using='hash'),)
+    __table_args__ = (
+        # also serves the latest duns_number of a match_id, see LatestDunsByMatchId
+        Index(
+            'duns_number_mapping_match_id_idx',
+            'match_id',
+            text('datetime desc'),
+            postgresql_include=['duns_number'],
+        ),
+        Index('duns_number_mapping_prev_match_id_idx', 'prev_match_id'),
+    )
 
 
 class CompanyNameMapping(BaseModel):
@@ -88,7 +103,10 @@ class CompanyNameMapping(BaseModel):
     source = _col(_text, nullable=False)
     datetime = _col(_dt, nullable=False)
 
-    __table_args__ = (Index('company_name_idx', 'company_name', postgresql_using='hash'),)
+    __table_args__ = (
+        Index('company_name_mapping_match_id_idx', 'match_id'),
+        Index('company_name_mapping_prev_match_id_idx', 'prev_match_id'),
+    )
 
 
 class ContactEmailMapping(BaseModel):
@@ -101,7 +119,10 @@ class ContactEmailMapping(BaseModel):
     source = _col(_text, nullable=False)
     datetime = _col(_dt, nullable=False)
 
-    __table_args__ = (Index('contact_email_idx', 'contact_email', postgresql_using='hash'),)
+    __table_args__ = (
+        Index('contact_email_mapping_match_id_idx', 'match_id'),
+        Index('contact_email_mapping_prev_match_id_idx', 'prev_match_id'),
+    )
 
 
 class CDMSRefMapping(BaseModel):
@@ -114,7 +135,10 @@ class CDMSRefMapping(BaseModel):
     source = _col(_text, nullable=False)
     datetime = _col(_dt, nullable=False)
 
-    __table_args__ = (Index('cdms_ref_idx', 'cdms_ref', postgresql_using='hash'),)
+    __table_args__ = (
+        Index('cdms_ref_mapping_match_id_idx', 'match_id'),
+        Index('cdms_ref_mapping_prev_match_id_idx', 'prev_match_id'),
+    )
 
 
 class PostcodeMapping(BaseModel):
@@ -127,7 +151,149 @@ class PostcodeMapping(BaseModel):
     source = _col(_text, nullable=False)
     datetime = _col(_dt, nullable=False)
 
-    __table_args__ = (Index('postcode_idx', 'postcode', postgresql_using='hash'),)
+    # the last field, its prev_match_id is never joined on
+    __table_args__ = (Index('postcode_mapping_match_id_idx', 'match_id'),)
+
+
+class MatchGroup(BaseModel):
+    """
+    The values of all mapping tables by match_id, kept in sync by update_mappings
+    """
+
+    __tablename__ = 'match_group'
+
+    field = _col(_text, primary_key=True)
+    value = _col(_text, primary_key=True)
+    match_id = _col(_int, nullable=False)
+    source = _col(_text, nullable=False)
+    datetime = _col(_dt, nullable=False)
+
+    __table_args__ = (Index('match_group_match_id_idx', 'match_id'),)
+
+    @classmethod
+    def get_members(cls, match_id):
+        """
+        :return: list of MatchGroup, oldest first
+        """
+        return cls.query.filter(cls.match_id == match_id).order_by(cls.datetime, cls.field).all()
+
+
+class LatestDunsByMatchId(BaseModel):
+    """
+    The most recent duns_number of each match_id, kept in sync by update_mappings for dnb_match
+    """
+
+    __tablename__ = 'latest_duns_by_match_id'
+
+    match_id = _col(_int, primary_key=True, autoincrement=False)
+    duns_number = _col(_text, nullable=False)
+    datetime = _col(_dt, nullable=False)
+
+
+class DescriptionLog(BaseModel):
+    """
+    The descriptions of every update as received, one batch per update, to rebuild the
+    mapping tables from. Partitioned by month of logged_at, see description_log.py
+    """
+
+    __tablename__ = 'description_log'
+
+    batch_id = _col(_bigint, primary_key=True)
+    position = _col(_int, primary_key=True)
+    logged_at = _col(_dt, primary_key=True)
+    source = _col(_text)
+    datetime = _col(_dt)
+    companies_house_id = _col(_text)
+    duns_number = _col(_text)
+    company_name = _col(_text)
+    contact_email = _col(_text)
+    cdms_ref = _col(_text)
+    postcode = _col(_text)
+
+    __table_args__ = {'postgresql_partition_by': 'RANGE (logged_at)'}
+
+
+Sequence('description_log_batch_seq', metadata=DescriptionLog.metadata)
+
+
+class UpdateJob(BaseModel):
+
+    __tablename__ = 'update_job'
+
+    id = _col(_text, primary_key=True)
+    status = _col(_text, nullable=False)  # queued, running, finished or failed
+    match = _col(_bool, nullable=False)
+    dnb_match = _col(_bool, nullable=False)
+    descriptions = _col(_jsonb)
+    matches = _col(_jsonb)
+    error = _col(_text)
+    attempts = _col(_int, nullable=False, default=0)
+    created = _col(_dt, nullable=False, server_default=func.now())
+    started = _col(_dt)
+    finished = _col(_dt)
+
+    __table_args__ = (Index('update_job_status_idx', 'status', 'created'),)
+
+    @classmethod
+    def add_job(cls, job_id, descriptions, match, dnb_match):
+        job = cls(
+            id=job_id, status='queued', match=match, dnb_match=dnb_match, descriptions=descriptions
+        )
+        job.save()
+        return job
+
+    @classmethod
+    def get_job(cls, job_id):
+        return _sa.session.get(cls, job_id)
+
+    @classmethod
+    def claim_next(cls, stale_after, max_attempts):
+        """
+        Marks the oldest queued job as running. Jobs still running after stale_after seconds
+        are considered abandoned by their worker and are claimed again, up to max_attempts.
+
+        :return: UpdateJob or None
+        """
+        while True:
+            job = (
+                cls.query.filter(
+                    or_(
+                        cls.status == 'queued',
+                        and_(
+                            cls.status == 'running',
+                            cls.started < func.now() - timedelta(seconds=stale_after),
+                        ),
+                    )
+                )
+                .order_by(cls.created)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if job is None:
+                _sa.session.commit()
+                return None
+            if job.attempts >= max_attempts:
+                job.fail('job abandoned by its worker')
+                continue
+            job.status = 'running'
+            job.started = func.now()
+            job.attempts += 1
+            job.save()
+            return job
+
+    def finish(self, matches):
+        self.status = 'finished'
+        self.matches = matches
+        self.descriptions = None
+        self.finished = func.now()
+        self.save()
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.error = error
+        self.descriptions = None
+        self.finished = func.now()
+        self.save()
 
 
 class HawkUsers(BaseModel):
@@ -152,9 +318,19 @@ class HawkUsers(BaseModel):
         result = query.first()
         return result[0] if result else None
 
+    @classmethod
+    def get_client_credentials(cls, client_id):
+        """
+        :return: (key, scope) or None
+        """
+        query = _sa.session.query(cls.key, cls.scope).filter(cls.id == client_id)
+        result = query.first()
+        return tuple(result) if result else None
+
     @classmethod
     def add_user(cls, client_id, client_key, client_scope, description):
         cls.get_or_create(
             id=client_id,
             defaults={'key': client_key, 'scope': client_scope, 'description': description},
         )
+        app.hawk_credentials.invalidate(client_id)
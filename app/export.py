@@ -0,0 +1,84 @@
+"""
+Bulk export of the mapping tables with COPY ... TO STDOUT, see `flask dev export` and the
+/api/v1/company/export/ endpoint
+
+The rows of the selected mapping tables are exported as:
+
+    field, value, prev_match_id, match_id, source, datetime
+
+in no particular order, either as CSV with a header line or as NDJSON, one JSON object per
+line. NDJSON is produced by COPY in CSV mode with a quote and delimiter that can't appear in
+the output of row_to_json, so that the JSON is written as is.
+"""
+
+from datetime import datetime
+
+from app.algorithm.sql_statements import _field_to_mapping_table
+from app.db import db_utils
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+FIELDS = [field for field, _ in _field_to_mapping_table]
+
+
+def export_statement(fields=None, export_format='csv', since=None, until=None, sources=None):
+    """
+    :param
+        fields: list of fields whose mapping tables are exported, all if None
+        since, until: only rows with since <= datetime < until, as 'YYYY-MM-DD HH:MM:SS'
+        sources: only rows from these sources
+    :return: COPY ... TO STDOUT statement
+    :raises ValueError: on an unknown field or format, or an invalid datetime
+    """
+    fields = fields or FIELDS
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise ValueError(f"unknown fields: {', '.join(unknown)}")
+    if export_format not in FORMATS:
+        raise ValueError(f"format needs to be one of {', '.join(FORMATS)}")
+    conditions = []
+    if since:
+        conditions.append(f'datetime >= {_literal(_checked_datetime(since))}::timestamp')
+    if until:
+        conditions.append(f'datetime < {_literal(_checked_datetime(until))}::timestamp')
+    if sources:
+        conditions.append(f"source in ({', '.join(_literal(source) for source in sources)})")
+    where = f"where {' and '.join(conditions)}" if conditions else ''
+    rows = ' union all '.join(
+        f"""
+        select '{field}' as field, {field} as value, prev_match_id, match_id, source, datetime
+        from {mt} {where}
+        """
+        for field, mt in _field_to_mapping_table
+        if field in fields
+    )
+    if export_format == 'csv':
+        return f'COPY ({rows}) TO STDOUT WITH (FORMAT csv, HEADER)'
+    return f"""
+        COPY (select row_to_json(e) from ({rows}) e)
+        TO STDOUT WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')
+    """
+
+
+def export_chunks(*args, **kwargs):
+    """
+    Same arguments as export_statement
+
+    :return: generator of bytes, streamed from the database as they are read
+    """
+    return db_utils.copy_to_chunks(export_statement(*args, **kwargs))
+
+
+def _checked_datetime(value):
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'invalid datetime: {value}')
+    return value
+
+
+def _literal(value):
+    # COPY takes no parameters, an escape string literal reads the same whatever the setting
+    # of standard_conforming_strings
+    if '\x00' in value:
+        raise ValueError('invalid character in parameter')
+    return "E'" + value.replace('\\', '\\\\').replace("'", "''") + "'"
@@ -0,0 +1,63 @@
+"""
+Asynchronous updates: update requests are queued in the update_job table and run by
+a separate worker process, see `flask dev worker`
+"""
+
+import logging
+import time
+import uuid
+
+from flask import current_app
+
+from app import metrics
+from app.algorithm import Matcher
+from app.db.models import UpdateJob
+
+
+def enqueue_update(descriptions, match, dnb_match):
+    """
+    :return: id of the queued job
+    """
+    job_id = uuid.uuid4().hex
+    UpdateJob.add_job(job_id, descriptions, match, dnb_match)
+    return job_id
+
+
+def run_next_job():
+    """
+    Runs the oldest queued job, if any
+
+    :return: the job that was run or None
+    """
+    config = current_app.config['jobs']
+    job = UpdateJob.claim_next(config['stale_after'], config['max_attempts'])
+    if job is None:
+        return None
+    metrics.set_labels('worker', job.match, job.dnb_match)
+    try:
+        rows = Matcher().match(
+            job.descriptions, update=True, match=job.match, dnb_match=job.dnb_match
+        )
+    except Exception as e:
+        logging.error(f'update job {job.id} failed: {str(e)}')
+        job.fail(str(e))
+    else:
+        job.finish(
+            [{'id': row[0], 'match_id': row[1], 'similarity': row[2]} for row in rows]
+            if job.match or job.dnb_match
+            else None
+        )
+    return job
+
+
+def run_worker(poll_interval, once=False):
+    """
+    Runs queued jobs one after the other, waiting poll_interval seconds when the queue is empty
+
+    :param once: return once the queue is empty
+    """
+    while True:
+        if run_next_job() is None:
+            if once:
+                return
+            time.sleep(poll_interval)
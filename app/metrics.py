@@ -0,0 +1,115 @@
+"""
+Prometheus metrics of where requests spend their time, served on /metrics when enabled
+
+Observations are labelled with the endpoint and the match and dnb_match flags of the request
+being served, set with start_request(). With several gunicorn workers PROMETHEUS_MULTIPROC_DIR
+has to point to an empty directory so that the metrics of all workers are aggregated, see the
+multiprocess mode of prometheus_client.
+
+While enabled the field passes of update_mappings are sent one at a time, instead of in a
+single round trip, to time them and count their rows.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from prometheus_client import (
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+    Histogram,
+    multiprocess,
+)
+
+LABELS = ('endpoint', 'match', 'dnb_match')
+_ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, float('inf'))
+_BYTE_BUCKETS = tuple(4**i * 1024 for i in range(10)) + (float('inf'),)
+
+stage_seconds = Histogram(
+    'cms_stage_seconds', 'Time spent in a stage of a request', LABELS + ('stage',)
+)
+update_pass_seconds = Histogram(
+    'cms_update_pass_seconds',
+    'Time spent in the update_mappings pass of a field',
+    LABELS + ('field',),
+)
+update_pass_rows_in = Histogram(
+    'cms_update_pass_rows_in',
+    'Descriptions with a value for the field of an update_mappings pass',
+    LABELS + ('field',),
+    buckets=_ROW_BUCKETS,
+)
+update_pass_rows_written = Histogram(
+    'cms_update_pass_rows_written',
+    'Mapping table rows inserted or updated by the update_mappings pass of a field',
+    LABELS + ('field',),
+    buckets=_ROW_BUCKETS,
+)
+request_payload_bytes = Histogram(
+    'cms_request_payload_bytes', 'Size of request bodies', LABELS, buckets=_BYTE_BUCKETS
+)
+
+
+def enabled():
+    return has_app_context() and current_app.config['metrics']['enabled']
+
+
+def start_request(match=False, dnb_match=False):
+    """
+    Sets the labels of the observations made while serving the current request
+    """
+    g.metric_labels = {
+        'endpoint': request.endpoint,
+        'match': str(match).lower(),
+        'dnb_match': str(dnb_match).lower(),
+    }
+    if enabled() and request.content_length is not None:
+        request_payload_bytes.labels(**g.metric_labels).observe(request.content_length)
+
+
+def set_labels(endpoint, match=False, dnb_match=False):
+    """
+    Sets the labels of observations made outside of a request, e.g. by the job worker
+    """
+    g.metric_labels = {
+        'endpoint': endpoint,
+        'match': str(match).lower(),
+        'dnb_match': str(dnb_match).lower(),
+    }
+
+
+def labels():
+    if 'metric_labels' in g:
+        return g.metric_labels
+    endpoint = request.endpoint if has_request_context() else None
+    return {'endpoint': endpoint or '', 'match': '', 'dnb_match': ''}
+
+
+@contextmanager
+def timed(stage):
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def observe(stage, seconds):
+    if enabled():
+        stage_seconds.labels(stage=stage, **labels()).observe(seconds)
+
+
+def exposition():
+    """
+    :return: (body, content type) of the metrics in the Prometheus text format
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,523 @@
+"""
+Full rebuild of the mapping tables from the description log, see `flask dev rebuild`
+
+The logged descriptions are normalised with the current normalisation and grouped into new
+mapping tables. By default the in-memory engine replays them on an empty MappingState in
+order of their datetime, in batches of batch_size descriptions, like updates of the
+descriptions in the order they happened would group them. They can instead be replayed as
+logged, each batch as one update in the order the updates ran, or grouped in the database,
+set-based, as one update of all logged descriptions would group them: each value takes the
+match_id of the most recent description of its priority field. Grouping in the database takes
+a few sorts of the log per field, replays group a few thousand descriptions per second.
+
+The rebuilt groups keep the live match_ids: each takes the one most of its values have in the
+live tables, as long as no other rebuilt group shares more values with it. Other groups get new
+match_ids from match_id_seq, so a match_id is never handed out twice.
+
+The rebuilt tables are written and indexed next to the live ones, as <table>_rebuild. Then,
+with the live tables locked, they replace the live ones and the batches that weren't grouped
+are applied to them as updates: those logged since the grouping started, and those whose
+update hadn't committed yet while lower batch_ids had, so that no update is lost. Matching and
+updates wait for this last step only. Privileges granted on the live tables are not carried
+over.
+
+The tables are only rebuilt if the log covers them: every live mapping row has to have the
+source and datetime of a logged description, otherwise some descriptions were never logged,
+e.g. those of updates from before the log, and their rows would be lost. This is checked
+before the grouping and again, for updates that weren't logged meanwhile, before the swap.
+"""
+
+import itertools
+import time
+from functools import partial
+
+from flask import current_app
+from sqlalchemy import MetaData
+from sqlalchemy.schema import CreateIndex
+
+from app.algorithm.bloom_filter import get_bloom_filters
+from app.algorithm.description_log import LOGGED_COLUMNS
+from app.algorithm.in_memory import (
+    _allocate_match_ids,
+    _load_mapping_rows,
+    InMemoryEngine,
+    MappingState,
+    write_changes,
+)
+from app.algorithm.match_cache import get_match_cache
+from app.algorithm.normaliser import normalise_description
+from app.algorithm.sql_statements import (
+    _copy_value,
+    _description_columns,
+    _field_to_mapping_table,
+    _normalised_description_columns,
+)
+from app.db import db_utils
+from app.db.indexes import MAPPING_MODELS
+from app.db.models import DescriptionLog, LatestDunsByMatchId, MatchGroup, sql_alchemy
+
+REBUILT_MODELS = MAPPING_MODELS + [MatchGroup, LatestDunsByMatchId]
+
+REPLAY_BATCH_SIZE = 1000
+
+_create_staging_table = f"""
+    DROP TABLE IF EXISTS tmp_rebuild;
+    CREATE TEMPORARY TABLE tmp_rebuild (
+        batch_id bigint,
+        position int,
+        {', '.join(
+            f"{column} {'timestamp' if column == 'datetime' else 'text'}"
+            for column in _description_columns
+        )}
+    ) ON COMMIT DROP;
+    DROP SEQUENCE IF EXISTS tmp_rebuild_match_id_seq;
+    CREATE TEMPORARY SEQUENCE tmp_rebuild_match_id_seq;
+"""
+
+
+class _MatchIds:
+    """
+    Hands out match_ids from 1, like tmp_rebuild_match_id_seq, until the live ones are kept
+    """
+
+    def __init__(self):
+        self.last = 0
+
+    def allocate(self, count):
+        ids = list(range(self.last + 1, self.last + count + 1))
+        self.last += count
+        return ids
+
+
+def rebuild_mapping_tables(batch_size=REPLAY_BATCH_SIZE, as_logged=False, in_db=False):
+    """
+    :param
+        batch_size: replay the descriptions in datetime order in batches of batch_size
+        as_logged: replay the logged batches in the order the updates ran instead
+        in_db: group all logged descriptions at once in the database instead
+    :return: dict of statistics, see summary()
+    :raises ValueError: if the description log is empty or doesn't cover the mapping tables
+    """
+    normalise_in_db = current_app.config['matching']['normalisation'] == 'db'
+    stats = {'descriptions': 0, 'batches': 0}
+    start = time.perf_counter()
+    if in_db:
+        with db_utils.pipeline() as pipeline:
+            pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+            last_batch_id = _last_batch_id(pipeline)
+            _check_log_covers(pipeline)
+            _create_rebuilt_tables(pipeline)
+            missed = _group_in_db(pipeline, stats, normalise_in_db, last_batch_id)
+            stats['grouping'] = time.perf_counter() - start
+            _keep_match_ids(pipeline, stats)
+            _complete_rebuilt_tables(pipeline)
+    else:
+        state = MappingState()
+        match_ids = _MatchIds()
+        engine = InMemoryEngine(state, allocate_match_ids=match_ids.allocate)
+        replayed = set()
+        with db_utils.pipeline() as pipeline:
+            pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+            last_batch_id = _last_batch_id(pipeline)
+            _check_log_covers(pipeline)
+            _replay(
+                pipeline,
+                engine,
+                stats,
+                normalise_in_db,
+                until=last_batch_id,
+                batch_size=None if as_logged else batch_size,
+                replayed=replayed,
+            )
+        missed = [i for i in range(1, last_batch_id + 1) if i not in replayed]
+        stats['grouping'] = time.perf_counter() - start
+        with db_utils.pipeline() as pipeline:
+            pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+            _create_rebuilt_tables(pipeline)
+            _copy_mapping_rows(pipeline, state)
+            _keep_match_ids(pipeline, stats)
+            _complete_rebuilt_tables(pipeline)
+        del state, engine
+    stats['writing'] = time.perf_counter() - start - stats['grouping']
+
+    bloom_filters = get_bloom_filters()
+    if bloom_filters:
+        # the filters may only err on the side of known values, the rebuilt values are
+        # added before they go live
+        with db_utils.pipeline() as pipeline:
+            for field, mt in _field_to_mapping_table:
+                for rows in pipeline.stream(f'select {field} from {mt}_rebuild'):
+                    bloom_filters.add({field: (row[0] for row in rows)})
+
+    swap_start = time.perf_counter()
+    with db_utils.pipeline() as pipeline:
+        pipeline.queue("SET LOCAL statement_timeout TO '10h';")
+        tables = ', '.join(model.__tablename__ for model in REBUILT_MODELS)
+        pipeline.queue(f'LOCK TABLE {tables} IN ACCESS EXCLUSIVE MODE;')
+        # updates which weren't logged could have committed meanwhile
+        _check_log_covers(pipeline)
+        _swap_rebuilt_tables(pipeline)
+        # the batches that weren't grouped are applied as updates of the rebuilt tables
+        state = MappingState(loader=partial(_load_mapping_rows, pipeline))
+        engine = InMemoryEngine(state, allocate_match_ids=partial(_allocate_match_ids, pipeline))
+        _replay(pipeline, engine, stats, normalise_in_db, after=last_batch_id, missed=missed)
+        write_changes(pipeline, state)
+        # before the rebuild commits, see bloom_filter.py
+        if bloom_filters:
+            bloom_filters.add(state.changed)
+    stats['swapping'] = time.perf_counter() - swap_start
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows'] = db_utils.execute_query(
+        'select ' + ' + '.join(f'(select count(*) from {mt})' for _, mt in _field_to_mapping_table)
+    )[0][0]
+    cache = get_match_cache()
+    if cache:
+        cache.bump_generation()
+    return stats
+
+
+def summary(stats):
+    """
+    :return: list of report lines
+    """
+    per_second = stats['descriptions'] / stats['seconds'] if stats['seconds'] else 0
+    return [
+        f"descriptions: {stats['descriptions']} in {stats['batches']} batches",
+        f"grouping: {stats['grouping']:.1f}s",
+        f"match_ids: {stats['kept_match_ids']} kept, {stats['new_match_ids']} new",
+        f"writing: {stats['writing']:.1f}s, {stats['rows']} mapping rows",
+        f"swapping: {stats['swapping']:.1f}s",
+        f"total: {stats['seconds']:.1f}s, {per_second:.0f} descriptions/s",
+    ]
+
+
+def _last_batch_id(pipeline):
+    stmt = f'select max(batch_id) from {DescriptionLog.__tablename__}'
+    last_batch_id = pipeline.query(stmt)[0][0]
+    if last_batch_id is None:
+        raise ValueError('the description log is empty')
+    return last_batch_id
+
+
+def _check_log_covers(pipeline):
+    """
+    :raises ValueError: if a live mapping row doesn't have the source and datetime of a logged
+        description
+    """
+    rows = ' union all '.join(
+        f'select source, datetime from {mt}' for _, mt in _field_to_mapping_table
+    )
+    stmt = f"""
+        select count(*) from ({rows}) m
+        where not exists (
+            select from {DescriptionLog.__tablename__} l
+            where l.datetime = m.datetime and l.source is not distinct from m.source
+        )
+    """
+    uncovered = pipeline.query(stmt)[0][0]
+    if uncovered:
+        raise ValueError(
+            f'the description log does not cover {uncovered} mapping rows, '
+            'their descriptions were never logged'
+        )
+
+
+def _logged_descriptions(conditions):
+    return f"""
+        select batch_id, position, null::text as id, {', '.join(LOGGED_COLUMNS)}
+        from {DescriptionLog.__tablename__}
+        where {conditions}
+    """
+
+
+def _replay(
+    pipeline,
+    engine,
+    stats,
+    normalise_in_db,
+    after=0,
+    until=None,
+    missed=(),
+    batch_size=None,
+    replayed=None,
+):
+    """
+    Replays the logged batches with after < batch_id <= until and those in missed
+
+    :param replayed: set the replayed batch_ids are added to
+    """
+    conditions = 'batch_id > :after' + (' and batch_id <= :until' if until is not None else '')
+    conditions = f'({conditions}) or batch_id = any(:missed)'
+    columns = _normalised_description_columns if normalise_in_db else _description_columns
+    stmt = f"""
+        select batch_id, {columns if normalise_in_db else ', '.join(columns)}
+        from ({_logged_descriptions(conditions)}) d
+        order by {'d.datetime, ' if batch_size else ''}d.batch_id, d.position
+    """
+    params = {'after': after, 'until': until, 'missed': list(missed)}
+    rows = itertools.chain.from_iterable(
+        pipeline.stream(stmt, params, batch_size=batch_size or 10000)
+    )
+    if replayed is not None:
+        rows = _collect_batch_ids(rows, replayed)
+    if batch_size:
+        batches = (
+            [row for _, row in batch]
+            for _, batch in itertools.groupby(enumerate(rows), key=lambda r: r[0] // batch_size)
+        )
+    else:
+        batches = (list(batch) for _, batch in itertools.groupby(rows, key=lambda row: row[0]))
+    for batch in batches:
+        descriptions = [dict(zip(_description_columns, row[1:])) for row in batch]
+        if not normalise_in_db:
+            descriptions = [
+                dict(normalise_description(dict(d, datetime=None)), datetime=d['datetime'])
+                for d in descriptions
+            ]
+        engine.update(descriptions)
+        stats['descriptions'] += len(descriptions)
+        stats['batches'] += 1
+
+
+def _collect_batch_ids(rows, batch_ids):
+    for row in rows:
+        batch_ids.add(row[0])
+        yield row
+
+
+def _group_in_db(pipeline, stats, normalise_in_db, until):
+    """
+    Groups the descriptions of the logged batches up to until into the rebuilt mapping tables
+
+    :return: batch_ids up to until which weren't logged yet
+    """
+    pipeline.queue(_create_staging_table)
+    _stage_descriptions(pipeline, normalise_in_db, until)
+    # the passes sort the staged descriptions, without statistics the planner expects a
+    # handful of rows and joins them with nested loops
+    pipeline.queue("SET LOCAL work_mem TO '256MB'; ANALYZE tmp_rebuild;")
+    for position, (_, mt) in enumerate(_field_to_mapping_table):
+        pipeline.queue(_grouping_pass_statement(position))
+        pipeline.queue(f'ANALYZE {mt}_rebuild;')
+    pipeline.queue('DROP SEQUENCE tmp_rebuild_match_id_seq;')
+    stats['descriptions'] = pipeline.query('select count(*) from tmp_rebuild')[0][0]
+    # rolled back updates leave gaps too, they are looked up again and not found
+    stmt = """
+        select g from generate_series(1, :until) g
+        where not exists (select from tmp_rebuild where batch_id = g)
+    """
+    missed = [batch_id for batch_id, in pipeline.query(stmt, {'until': until})]
+    stats['batches'] = until - len(missed)
+    return missed
+
+
+def _stage_descriptions(pipeline, normalise_in_db, until):
+    columns = ['batch_id', 'position'] + _description_columns
+    logged = _logged_descriptions('batch_id <= :until')
+    if normalise_in_db:
+        stmt = f"""
+            INSERT INTO tmp_rebuild ({', '.join(columns)})
+            SELECT batch_id, position, {_normalised_description_columns}
+            FROM ({logged}) d;
+        """
+        pipeline.execute(stmt, {'until': until})
+        return
+    for rows in pipeline.stream(logged, {'until': until}):
+        pipeline.copy_from_rows('tmp_rebuild', columns, (_staged_row(row) for row in rows))
+
+
+def _staged_row(row):
+    normalised = normalise_description(dict(row._mapping, datetime=None))
+    normalised['datetime'] = None if row.datetime is None else str(row.datetime)
+    return (str(row.batch_id), str(row.position)) + tuple(
+        _copy_value(normalised[column]) for column in _description_columns
+    )
+
+
+def _grouping_pass_statement(position):
+    """
+    :return: the statement filling the rebuilt mapping table of the field at position in
+        _field_to_mapping_table from tmp_rebuild, once those of the fields before it are
+        filled, with the rules of the in-memory engine for a single batch on empty tables
+    """
+    field, mt = _field_to_mapping_table[position]
+    to_check = _field_to_mapping_table[:position]
+    # values are only compared for equality, sorting them in the C collation is cheaper
+    key = f'{field} COLLATE "C"'
+    if to_check:
+        # the first priority field a description has decides, the latest such description
+        # gives the match_id
+        first_field = (
+            'case '
+            + ' '.join(f'when d.{f} is not null then {i}' for i, (f, _) in enumerate(to_check))
+            + f' else {position} end'
+        )
+        matched = f"""
+            select distinct on (d.{key}) d.{field},
+                coalesce({', '.join(f'{m}.match_id' for _, m in to_check)}) as match_id
+            from tmp_rebuild d
+            {' '.join(f'left join {m}_rebuild {m} on {m}.{f} = d.{f}' for f, m in to_check)}
+            where d.{field} is not null
+            order by d.{key}, {first_field}, d.datetime desc, d.batch_id, d.position
+        """
+    else:
+        matched = f'select distinct {field}, null::int as match_id from tmp_rebuild'
+    return f"""
+        insert into {mt}_rebuild ({field}, prev_match_id, match_id, source, datetime)
+        select {field}, match_id, match_id, source, datetime
+        from (
+            select
+                latest.{field},
+                coalesce(matched.match_id, nextval('tmp_rebuild_match_id_seq'))::int as match_id,
+                latest.source,
+                latest.datetime
+            from (
+                select distinct on ({key}) {field}, source, datetime
+                from tmp_rebuild
+                where {field} is not null
+                order by {key}, datetime desc, batch_id, position
+            ) latest
+            join ({matched}) matched using ({field})
+            order by latest.datetime, latest.{key} -- new match_ids for the oldest values first
+        ) sq;
+    """
+
+
+def _keep_match_ids(pipeline, stats):
+    """
+    Replaces the match_ids of the rebuilt mapping tables, numbered from 1, with the live
+    match_id each group shares most values with, unless another group shares more values with
+    it, or else with a new one from match_id_seq, handed out to the oldest groups first
+
+    A prev_match_id of a group that was merged away during the replay gets a new match_id as
+    well, so that it still refers to no group.
+    """
+    shared = ' union all '.join(
+        f'select r.match_id as rebuilt, l.match_id as live '
+        f'from {mt}_rebuild r join {mt} l using ({field})'
+        for field, mt in _field_to_mapping_table
+    )
+    rebuilt = ' union all '.join(
+        f'select match_id, true as is_group from {mt}_rebuild '
+        f'union all select prev_match_id, false from {mt}_rebuild'
+        for _, mt in _field_to_mapping_table
+    )
+    pipeline.queue(
+        f"""
+        DROP TABLE IF EXISTS tmp_rebuild_match_ids;
+        CREATE TEMPORARY TABLE tmp_rebuild_match_ids ON COMMIT DROP AS
+        with shared as (
+            select rebuilt, live, count(*) as shared from ({shared}) s group by rebuilt, live
+        ), kept as (
+            select distinct on (rebuilt) rebuilt, live
+            from (
+                select distinct on (live) rebuilt, live, shared
+                from shared
+                order by live, shared desc, rebuilt
+            ) best
+            order by rebuilt, shared desc, live
+        )
+        select
+            rebuilt,
+            is_group,
+            live is not null as kept,
+            coalesce(live, nextval('match_id_seq'))::int as match_id
+        from (
+            select ids.rebuilt, ids.is_group, kept.live
+            from (
+                select match_id as rebuilt, bool_or(is_group) as is_group
+                from ({rebuilt}) r
+                group by match_id
+            ) ids
+            left join kept using (rebuilt)
+            order by ids.rebuilt
+        ) sq;
+        ALTER TABLE tmp_rebuild_match_ids ADD PRIMARY KEY (rebuilt);
+        """
+    )
+    for _, mt in _field_to_mapping_table:
+        pipeline.queue(
+            f"""
+            update {mt}_rebuild t set
+                match_id = ids.match_id,
+                prev_match_id = (
+                    select prev.match_id from tmp_rebuild_match_ids prev
+                    where prev.rebuilt = t.prev_match_id
+                )
+            from tmp_rebuild_match_ids ids
+            where ids.rebuilt = t.match_id;
+            """
+        )
+    stmt = """
+        select count(*) filter (where kept), count(*) filter (where not kept)
+        from tmp_rebuild_match_ids
+        where is_group
+    """
+    stats['kept_match_ids'], stats['new_match_ids'] = pipeline.query(stmt)[0]
+
+
+def _create_rebuilt_tables(pipeline):
+    for model in REBUILT_MODELS:
+        table = model.__tablename__
+        pipeline.queue(
+            f"""
+            DROP TABLE IF EXISTS {table}_rebuild;
+            CREATE TABLE {table}_rebuild (LIKE {table});
+            """
+        )
+
+
+def _copy_mapping_rows(pipeline, state):
+    for field, mt in _field_to_mapping_table:
+        pipeline.copy_from_rows(
+            f'{mt}_rebuild',
+            [field, 'prev_match_id', 'match_id', 'source', 'datetime'],
+            (
+                (value,) + tuple(None if v is None else str(v) for v in row)
+                for value, row in state.rows[field].items()
+            ),
+        )
+
+
+def _complete_rebuilt_tables(pipeline):
+    """
+    Fills the rebuilt group tables from the rebuilt mapping tables and indexes all of them
+    """
+    pipeline.queue(
+        f"""
+        insert into {MatchGroup.__tablename__}_rebuild (field, value, match_id, source, datetime)
+        {' union all '.join(
+            f"select '{field}', {field}, match_id, source, datetime from {mt}_rebuild"
+            for field, mt in _field_to_mapping_table
+        )};
+        insert into {LatestDunsByMatchId.__tablename__}_rebuild (match_id, duns_number, datetime)
+            select distinct on (match_id) match_id, duns_number, datetime
+            from duns_number_mapping_rebuild
+            order by match_id, datetime desc, duns_number;
+        """
+    )
+    for model in REBUILT_MODELS:
+        table = model.__table__
+        rebuilt = table.to_metadata(MetaData(), name=f'{table.name}_rebuild')
+        columns = ', '.join(column.name for column in table.primary_key.columns)
+        pipeline.queue(
+            f'ALTER TABLE {rebuilt.name} ADD CONSTRAINT {rebuilt.name}_pkey '
+            f'PRIMARY KEY ({columns});'
+        )
+        for index in rebuilt.indexes:
+            index.name = f'{index.name}_rebuild'
+            pipeline.queue(f'{CreateIndex(index).compile(dialect=sql_alchemy.engine.dialect)};')
+
+
+def _swap_rebuilt_tables(pipeline):
+    for model in REBUILT_MODELS:
+        table = model.__tablename__
+        pipeline.queue(
+            f"""
+            DROP TABLE {table};
+            ALTER TABLE {table}_rebuild RENAME TO {table};
+            ALTER TABLE {table} RENAME CONSTRAINT {table}_rebuild_pkey TO {table}_pkey;
+            """
+        )
+        for index in model.__table__.indexes:
+            pipeline.queue(f'ALTER INDEX {index.name}_rebuild RENAME TO {index.name};')
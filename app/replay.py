@@ -0,0 +1,130 @@
+"""
+Replays recorded requests against a running instance of the API, see `flask dev replay`
+
+Requests are read from a JSONL file, one request per line:
+
+    {"path": "/api/v1/company/match/", "params": {"dnb_match": "true"}, "body": {...}}
+
+and are signed with hawk credentials just before they are sent. They are sent by a number of
+concurrent workers, either as fast as they can or, with a rate, at fixed intervals. With a
+rate latencies are measured from the time a request was due rather than from the time it
+was sent, so that a slow server doesn't hide its own queueing delay.
+"""
+
+import io
+import json
+import math
+import threading
+import time
+from collections import Counter
+
+import requests
+from mohawk import Sender
+
+DEFAULT_PATH = '/api/v1/company/match/'
+
+
+def load_requests(lines):
+    """
+    :return: list of (path, params, body as bytes)
+    """
+    loaded = []
+    for line in lines:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        loaded.append(
+            (
+                request.get('path', DEFAULT_PATH),
+                request.get('params') or {},
+                json.dumps(request['body']).encode('utf-8'),
+            )
+        )
+    return loaded
+
+
+def replay(base_url, to_send, client_id, client_key, concurrency=1, rate=None, timeout=300):
+    """
+    :param
+        to_send: list of (path, params, body) as returned by load_requests
+        rate: requests per second, as fast as possible if None
+    :return: (seconds, list of (latency in seconds, status code or exception name))
+    """
+    credentials = {'id': client_id, 'key': client_key, 'algorithm': 'sha256'}
+    results = [None] * len(to_send)
+    next_index = iter(range(len(to_send)))
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def work():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            due = start + i / rate if rate else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                finished, outcome = _send(session, base_url, credentials, *to_send[i], timeout)
+            except Exception as e:
+                # one failed request mustn't stop its worker and leave the others unsent
+                finished, outcome = time.perf_counter(), type(e).__name__
+            results[i] = (finished, outcome, due)
+
+    workers = [threading.Thread(target=work) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return elapsed, [(finished - due, outcome) for finished, outcome, due in results]
+
+
+def _send(session, base_url, credentials, path, params, body, timeout):
+    url = requests.Request('POST', base_url.rstrip('/') + path, params=params).prepare().url
+    sender = Sender(
+        credentials,
+        url,
+        'POST',
+        # a file, mohawk formats bytes for its debug log
+        content=io.BytesIO(body),
+        content_type='application/json',
+    )
+    headers = {'Authorization': sender.request_header, 'Content-Type': 'application/json'}
+    try:
+        response = session.post(url, data=body, headers=headers, timeout=timeout)
+        outcome = response.status_code
+    except requests.RequestException as e:
+        outcome = type(e).__name__
+    return time.perf_counter(), outcome
+
+
+def summary(elapsed, results):
+    """
+    :return: lines reporting the throughput, latency percentiles and outcomes of results
+    """
+    latencies = [latency for latency, _ in results]
+    if not latencies:
+        return ['no requests']
+    lines = [
+        f'requests: {len(results)} in {elapsed:.1f}s ({len(results) / elapsed:.1f}/s)',
+        'latency ms: '
+        + '  '.join(
+            f'{name} {percentile(latencies, p) * 1000:.1f}'
+            for name, p in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]
+        ),
+    ]
+    for outcome, count in sorted(Counter(o for _, o in results).items(), key=str):
+        lines.append(f'{outcome}: {count}')
+    return lines
+
+
+def percentile(values, p):
+    """
+    :return: the p-th percentile of values, by the nearest rank
+    """
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(len(values) * p / 100) - 1))]
@@ -0,0 +1,117 @@
+import pytest
+
+from app.algorithm import Matcher
+from app.algorithm.bloom_filter import BloomFilters, get_bloom_filters
+from app.algorithm.normaliser import normalise_description
+from app.commands.dev import bloom_filters
+from app.db import db_utils
+from tests.algorithm.test_match_cache import BrokenRedisMock, RedisMock
+from tests.algorithm.test_matcher import _create_json
+
+
+@pytest.fixture
+def bloom_app(app_with_db, monkeypatch):
+    monkeypatch.setitem(
+        app_with_db.config, 'bloom_filter', {'enabled': True, 'capacity': 1000, 'error_rate': 0.001}
+    )
+    # the filters are only probed with python normalisation
+    monkeypatch.setitem(app_with_db.config['matching'], 'normalisation', 'python')
+    monkeypatch.setattr(app_with_db, 'cache', RedisMock(), raising=False)
+    return app_with_db
+
+
+def test_bloom_filters_know_added_values():
+    filters = BloomFilters(RedisMock(), capacity=1000, error_rate=0.001)
+    filters.client.set(filters.key('postcode') + ':ready', 1)
+    added = {f'pc{i}' for i in range(100)}
+    filters.add({'postcode': added})
+
+    known = filters.known_values({'postcode': added | {f'other{i}' for i in range(100)}})
+
+    assert known['postcode'] >= added
+    assert len(known['postcode'] - added) <= 1
+
+
+def test_bloom_filters_are_unused_until_built():
+    filters = BloomFilters(RedisMock(), capacity=1000, error_rate=0.001)
+
+    assert filters.known_values({'postcode': {'pc1'}}) == {'postcode': {'pc1'}}
+    assert BloomFilters(BrokenRedisMock(), 1000, 0.001).known_values({'postcode': {'pc1'}}) is None
+
+
+@pytest.mark.parametrize('dnb_match', (False, True))
+def test_match_with_bloom_filters(bloom_app, monkeypatch, dnb_match):
+    Matcher().match(
+        _create_json(
+            [
+                ('inc', 'ch1', 'dun1', 'name1', 'a@email.com'),
+                ('inc', None, 'dun2', 'name2', None, 'cdms2', 'pc2'),
+            ]
+        )
+    )
+    with db_utils.pipeline() as pipeline:
+        get_bloom_filters().build(pipeline)
+    descriptions = _create_json(
+        [
+            ('inc', 'ch1', 'dun3', 'name3'),
+            ('inc', None, None, 'name4', 'b@email.com', 'cdms2'),
+            ('inc', 'ch5', 'dun5'),
+            ('inc', None, 'dun2'),
+        ]
+    )
+    with_filters = Matcher().match(descriptions, update=False, dnb_match=dnb_match)
+    monkeypatch.setitem(bloom_app.config['bloom_filter'], 'enabled', False)
+    without_filters = Matcher().match(descriptions, update=False, dnb_match=dnb_match)
+
+    assert with_filters == without_filters
+
+
+def test_unknown_descriptions_are_answered_without_db(bloom_app, monkeypatch):
+    Matcher().match(_create_json([('inc', 'ch1', 'dun1', 'name1')]))
+    with db_utils.pipeline() as pipeline:
+        get_bloom_filters().build(pipeline)
+    monkeypatch.setattr(db_utils, 'pipeline', None)
+
+    matches = Matcher().match(_create_json([('inc', 'ch2', 'dun2')]), update=False)
+
+    assert matches == [('1', None, '000000')]
+
+
+def test_update_adds_values_to_bloom_filters(bloom_app):
+    with db_utils.pipeline() as pipeline:
+        get_bloom_filters().build(pipeline)
+    Matcher().match(_create_json([('inc', 'ch1', 'dun1', 'name1')]))
+
+    matches = Matcher().match(_create_json([('inc', None, 'dun1')]), update=False)
+
+    assert matches == [('1', 1, '010000')]
+
+
+def test_bloom_filters_hold_the_values_of_the_mapping_tables(bloom_app, monkeypatch):
+    monkeypatch.setitem(bloom_app.config['matching'], 'normalisation', 'db')
+    # a python normaliser which disagrees with the one of the database
+    monkeypatch.setattr(
+        'app.algorithm.normalise_description',
+        lambda d: dict(normalise_description(d), company_name='different'),
+    )
+    with db_utils.pipeline() as pipeline:
+        get_bloom_filters().build(pipeline)
+    Matcher().match(_create_json([('inc', None, None, 'Acme\u2003Holdings Ltd')]))
+
+    known = get_bloom_filters().known_values({'company_name': {'acmeholdings', 'different'}})
+    assert known == {'company_name': {'acmeholdings'}}
+
+    # with db normalisation the filters aren't probed with python normalised values
+    matches = Matcher().match(_create_json([('inc', None, None, 'Acme Holdings')]), update=False)
+    assert matches == [('1', 1, '001000')]
+
+
+def test_bloom_filters_cmd(bloom_app):
+    runner = bloom_app.test_cli_runner()
+
+    result = runner.invoke(bloom_filters)
+    assert 'postcode: not built' in result.output
+
+    result = runner.invoke(bloom_filters, ['--build'])
+    assert 'companies_house_id: ready' in result.output
+    assert 'postcode: ready' in result.output
@@ -0,0 +1,111 @@
+import random
+import string
+import time
+
+from app.algorithm import fuzzy_names
+from app.algorithm.fuzzy_names import FuzzyNames, NameIndex, similarity, trigrams
+from app.commands.dev import fuzzy_names as fuzzy_names_cmd
+from app.db import db_utils
+from tests.algorithm.test_match_cache import RedisMock
+
+
+def test_name_index_finds_near_duplicates():
+    rnd = random.Random(1)
+    names = [
+        ''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(8, 20))) for _ in range(2000)
+    ]
+    index = NameIndex(names)
+    found = 0
+    for name in names[:200]:
+        typo = name[:-1] if rnd.random() < 0.5 else name + 'x'
+        candidates = index.candidates(typo, threshold=0.5)
+        assert all(score >= 0.5 for _, score in candidates)
+        assert candidates == sorted(candidates, key=lambda c: (-c[1], c[0]))
+        if name in [candidate for candidate, _ in candidates]:
+            found += 1
+            assert dict(candidates)[name] == similarity(trigrams(typo), trigrams(name))
+
+    assert found >= 190
+
+
+def test_name_index_candidates():
+    index = NameIndex(['acmeholdingsuk', 'acmeholdings', 'zenithtrading'])
+
+    assert index.candidates('acmeholdingsuk', limit=1) == [('acmeholdingsuk', 1.0)]
+    assert index.candidates('zenith', threshold=0.9) == []
+
+
+def test_name_index_scores_at_most_max_scored(monkeypatch):
+    monkeypatch.setattr(fuzzy_names, 'MAX_SCORED', 3)
+    index = NameIndex([f'acmeholdings{i}' for i in range(10)] + ['acmeholdings'] * 10)
+
+    assert len(index.candidates('acmeholdings', threshold=0, limit=100)) == 3
+
+
+def test_name_index_candidates_deadline():
+    index = NameIndex(['acmeholdingsuk', 'acmeholdings'])
+
+    assert index.candidates('acmeholdings', limit=1, deadline=time.perf_counter() + 60) == [
+        ('acmeholdings', 1.0)
+    ]
+    assert index.candidates('acmeholdings', deadline=time.perf_counter() - 1) is None
+
+
+def test_name_index_loads_what_it_dumps():
+    index = NameIndex(['acmeholdingsuk', 'acmeholdings', 'zenithtrading'])
+
+    loaded = NameIndex.loads(index.dumps())
+
+    assert len(loaded) == 3
+    assert loaded.candidates('acmeholdingsuk') == index.candidates('acmeholdingsuk')
+
+
+def test_fuzzy_names_are_loaded_in_the_background(app_with_db, monkeypatch):
+    monkeypatch.setattr(app_with_db, 'cache', RedisMock(), raising=False)
+    _add_names(['acmeholdings'])
+    names = FuzzyNames()
+    with app_with_db.app_context():
+        names.refresh()
+        assert names.index is None
+
+        FuzzyNames().build()
+        assert names.current(refresh_interval=3600) is None
+        for _ in range(100):
+            if names.index is not None:
+                break
+            time.sleep(0.05)
+
+        assert names.current(refresh_interval=3600) is names.index
+        assert names.index.candidates('acmeholdings') == [('acmeholdings', 1.0)]
+
+        # only an index built since is loaded again
+        loaded = names.index
+        names.refresh()
+        assert names.index is loaded
+        _add_names(['zenithtrading'])
+        FuzzyNames().build()
+        names.refresh()
+        assert len(names.index) == 2
+
+
+def test_fuzzy_names_cmd(app_with_db, monkeypatch):
+    monkeypatch.setattr(app_with_db, 'cache', RedisMock(), raising=False)
+    monkeypatch.setitem(app_with_db.config['fuzzy_name'], 'enabled', True)
+    _add_names(['acmeholdings', 'zenithtrading'])
+    runner = app_with_db.test_cli_runner()
+
+    result = runner.invoke(fuzzy_names_cmd)
+    assert 'fuzzy name index: not built' in result.output
+
+    result = runner.invoke(fuzzy_names_cmd, ['--build'])
+    assert 'fuzzy name index: 2 names, built at ' in result.output
+
+
+def _add_names(names):
+    db_utils.execute_statement(
+        """
+        insert into company_name_mapping (company_name, prev_match_id, match_id, source, datetime)
+        select name, 1, 1, 'dnb', '2019-01-01' from unnest(cast(:names as text[])) name
+        """,
+        {'names': names},
+    )
@@ -0,0 +1,128 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.algorithm import Matcher
+from app.algorithm.in_memory import DisjointSet
+from app.algorithm.sql_statements import _field_to_mapping_table
+from app.db import db_utils
+from tests.algorithm.test_matcher import (
+    _create_json,
+    expected_group_table_rows,
+    group_table_rows,
+)
+
+"""
+
+Batches use the short description format of test_matcher.py
+
+"""
+
+
+@pytest.mark.parametrize(
+    'batches',
+    (
+        # conflicting data within a batch
+        [
+            [
+                ('inc', 'ch1', 'dun1', 'name1'),
+                ('inc', None, 'dun1', 'name2'),
+                ('inc', 'ch2', 'dun1', 'name1'),
+            ],
+        ],
+        # higher priority field keeps preference when data is missing
+        [
+            [('2019-01-01 00:00:00', 'ch1', 'dun1', 'name1')],
+            [('2019-01-02 00:00:00', None, 'dun2', 'name1')],
+            [('2019-01-03 00:00:00', 'ch1', 'dun1', 'name1')],
+        ],
+        # regrouping of existing values through prev_match_ids
+        [
+            [('2019-01-01 00:00:00', None, 'dun1', 'name1')],
+            [('2019-01-02 00:00:00', 'ch2', None, 'name1')],
+            [('2019-01-03 00:00:00', 'ch2', 'dun1', 'name1', 'a@email.com')],
+            [('2019-01-04 00:00:00', 'ch3', 'dun1', None, 'b@email.com', 'cdms1', 'pc1')],
+        ],
+        # batch and sequential updates
+        [
+            [
+                ('inc', 'ch1', 'dun1', 'name1'),
+                ('inc', 'ch1', 'dun2', None),
+                ('inc', 'ch2', 'dun2', None),
+                ('inc', None, 'dun2', 'name2'),
+                ('inc', None, 'dun3', 'name1'),
+            ],
+            [('2020-01-05 00:00:00', 'ch2', 'dun3', 'name3', 'c@email.com')],
+        ],
+    ),
+)
+def test_in_memory_engine_matches_sql_engine(app_with_db, monkeypatch, batches):
+    batches = [_create_json(batch) for batch in batches]
+    _assert_same_results(app_with_db, monkeypatch, batches)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_in_memory_engine_matches_sql_engine_random(app_with_db, monkeypatch, seed):
+    rnd = random.Random(seed)
+    batches = []
+    timestamps = rnd.sample(range(10000), 60)
+    for i in range(6):
+        batch = []
+        for j in range(10):
+            timestamp = datetime(2019, 1, 1) + timedelta(hours=timestamps[i * 10 + j])
+            batch.append(
+                {
+                    'id': str(j),
+                    'source': rnd.choice(['dit.datahub', 'companies_house']),
+                    'datetime': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                    **{
+                        field: f'{field[:3]}{rnd.randint(1, 6)}'
+                        for field, _ in _field_to_mapping_table
+                        if rnd.random() < 0.5
+                    },
+                }
+            )
+        for description in batch:
+            if 'contact_email' in description:
+                description['contact_email'] = f'name@{description["contact_email"]}.com'
+            if 'company_name' not in description and len(description) == 3:
+                description['company_name'] = 'name'
+        batches.append(batch)
+    _assert_same_results(app_with_db, monkeypatch, batches)
+
+
+def test_disjoint_set():
+    ds = DisjointSet(merge=lambda a, b: a + b)
+    for item in 'abcde':
+        ds.add(item, [item])
+    ds.union('a', 'b')
+    ds.union('c', 'd')
+    ds.union('b', 'd')
+
+    assert ds.find('c') == ds.find('a')
+    assert sorted(ds.payload('d')) == ['a', 'b', 'c', 'd']
+    assert ds.payload('e') == ['e']
+    assert ds._parent['d'] == ds.find('a')  # path compressed
+
+
+def _assert_same_results(app, monkeypatch, batches):
+    results = {}
+    for engine in ('sql', 'memory'):
+        monkeypatch.setitem(app.config['matching'], 'engine', engine)
+        app.db.drop_all()
+        app.db.create_all()
+        matches = [Matcher().match(batch) for batch in batches]
+        results[engine] = (matches, _mapping_tables())
+        assert group_table_rows() == expected_group_table_rows()
+
+    assert results['memory'] == results['sql']
+
+
+def _mapping_tables():
+    return {
+        field: db_utils.execute_query(
+            f'select {field}, prev_match_id, match_id, source, datetime from {mt} order by 1'
+        )
+        for field, mt in _field_to_mapping_table
+    }
@@ -0,0 +1,162 @@
+import pytest
+import redis
+
+from app.algorithm import Matcher
+from app.algorithm.match_cache import GENERATION_KEY, stats
+from tests.algorithm.test_matcher import _create_json
+
+
+class RedisMock:
+    def __init__(self):
+        self.cache = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.cache.get(key, None)
+
+    def mget(self, keys):
+        self.calls.append('mget')
+        return [self.cache.get(key, None) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.calls.append('set')
+        self.cache[key] = value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def delete(self, *keys):
+        self.calls.append('delete')
+        for key in keys:
+            self.cache.pop(key, None)
+
+    def incr(self, key):
+        self.calls.append('incr')
+        self.cache[key] = str(int(self.cache.get(key, 0)) + 1).encode('utf-8')
+        return int(self.cache[key])
+
+    def bitop(self, operation, dest, *keys):
+        assert operation == 'OR'
+        bits = bytearray(max(len(self.cache.get(key, b'')) for key in keys))
+        for key in keys:
+            for i, byte in enumerate(self.cache.get(key, b'')):
+                bits[i] |= byte
+        self.cache[dest] = bits
+
+    def execute_command(self, command, key, *args):
+        assert command == 'BITFIELD'
+        bits = self.cache.setdefault(key, bytearray())
+        results = []
+        while args:
+            if args[0] == 'GET':
+                (_, _, offset), args = args[:3], args[3:]
+                byte = bits[offset // 8] if offset // 8 < len(bits) else 0
+                results.append(byte >> (7 - offset % 8) & 1)
+            else:
+                (_, _, offset, _), args = args[:4], args[4:]
+                bits.extend(bytes(max(0, offset // 8 + 1 - len(bits))))
+                results.append(bits[offset // 8] >> (7 - offset % 8) & 1)
+                bits[offset // 8] |= 1 << (7 - offset % 8)
+        return results
+
+    def pipeline(self, transaction=True):
+        return PipelineMock(self)
+
+
+class PipelineMock:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, item):
+        def queue(*args, **kwargs):
+            self.commands.append((item, args, kwargs))
+
+        return queue
+
+    def execute(self):
+        self.client.calls.append('pipeline')
+        return [getattr(self.client, item)(*args, **kwargs) for item, args, kwargs in self.commands]
+
+
+class BrokenRedisMock:
+    def __getattr__(self, item):
+        def fail(*args, **kwargs):
+            raise redis.exceptions.ConnectionError('connection refused')
+
+        return fail
+
+
+@pytest.fixture
+def cached_app(app_with_db, monkeypatch):
+    monkeypatch.setitem(app_with_db.config, 'match_cache', {'enabled': True, 'ttl': 60})
+    monkeypatch.setattr(app_with_db, 'cache', RedisMock(), raising=False)
+    return app_with_db
+
+
+def test_match_is_served_from_cache(cached_app):
+    Matcher().match(
+        _create_json([('inc', 'ch1', 'dun1', 'name1'), ('inc', 'ch2', 'dun2', 'name2')])
+    )
+    descriptions = _create_json([('inc', 'ch1', None, None), ('inc', None, 'dun2', 'name2')])
+    hits = stats.hits
+
+    first = Matcher().match(descriptions, update=False)
+    second = Matcher().match(descriptions, update=False)
+
+    assert first == second == [('1', 1, '100000'), ('2', 2, '011000')]
+    assert stats.hits - hits == 2
+    assert cached_app.cache.calls.count('pipeline') == 1
+
+
+def test_dnb_match_is_cached_separately(cached_app):
+    Matcher().match(_create_json([('inc', 'ch1', 'dun1', 'name1')]))
+    descriptions = _create_json([('inc', 'ch1', None, None)])
+
+    assert Matcher().match(descriptions, update=False) == [('1', 1, '100000')]
+    assert Matcher().match(descriptions, update=False, dnb_match=True) == [('1', 'dun1', '100000')]
+
+
+def test_cached_match_keeps_ids_and_order(cached_app):
+    Matcher().match(_create_json([('inc', 'ch1'), ('inc', 'ch2')]))
+    descriptions = [
+        {'id': 'b', 'source': 'dit.datahub', 'companies_house_id': 'CH2'},
+        {'id': 'a', 'source': 'dit.datahub', 'companies_house_id': 'ch1'},
+        {'id': 'c', 'source': 'dit.datahub', 'companies_house_id': 'ch1'},
+    ]
+    Matcher().match(descriptions[:1], update=False)
+
+    assert Matcher().match(descriptions, update=False) == [
+        ('a', 1, '100000'),
+        ('b', 2, '100000'),
+        ('c', 1, '100000'),
+    ]
+
+
+def test_update_invalidates_cache(cached_app):
+    Matcher().match(_create_json([('2019-01-01 00:00:00', 'ch1', 'dun1')]))
+    descriptions = _create_json([('2019-01-01 00:00:00', None, 'dun1')])
+    assert Matcher().match(descriptions, update=False) == [('1', 1, '010000')]
+
+    Matcher().match(_create_json([('2019-01-02 00:00:00', 'ch2', 'dun1')]))
+
+    assert cached_app.cache.cache[GENERATION_KEY] == b'2'
+    assert Matcher().match(descriptions, update=False) == [('1', 2, '010000')]
+
+
+def test_match_without_cache_server(cached_app, monkeypatch):
+    Matcher().match(_create_json([('inc', 'ch1', 'dun1', 'name1')]))
+    monkeypatch.setattr(cached_app, 'cache', BrokenRedisMock())
+
+    matches = Matcher().match(_create_json([('inc', 'ch1')]), update=False)
+
+    assert matches == [('1', 1, '100000')]
+
+
+@pytest.mark.parametrize('engine', ('sql', 'memory'))
+def test_update_without_changes_keeps_cache(cached_app, monkeypatch, engine):
+    monkeypatch.setitem(cached_app.config['matching'], 'engine', engine)
+    Matcher().match(_create_json([('2019-01-01 00:00:00', 'ch1', 'dun1')]))
+    generation = cached_app.cache.cache[GENERATION_KEY]
+
+    Matcher().match(_create_json([('2019-01-01 00:00:00', 'ch1', 'dun1')]))
+
+    assert cached_app.cache.cache[GENERATION_KEY] == generation
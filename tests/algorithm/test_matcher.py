@@ -3,6 +3,12 @@ from datetime import datetime, timedelta
 import pytest
 
 from app.algorithm import Matcher
+from app.algorithm.sql_statements import (
+    _field_to_mapping_table,
+    backfill_group_tables,
+    mapping_tables_logged,
+)
+from app.db import db_utils
 
 """
 
@@ -324,6 +330,151 @@ def test_sequential_matcher_batch_vs_sequential(app_with_db):
     )
 
 
+@pytest.mark.parametrize('loader', ('copy', 'json'))
+@pytest.mark.parametrize('normalisation', ('db', 'python'))
+def test_updates_are_logged_as_received(app_with_db, monkeypatch, loader, normalisation):
+    monkeypatch.setitem(app_with_db.config['matching'], 'tmp_table_loader', loader)
+    monkeypatch.setitem(app_with_db.config['matching'], 'normalisation', normalisation)
+    matcher = Matcher()
+    description = {'id': '1', 'source': 'dit.datahub', 'datetime': '2019-01-01'}
+    matcher.match([dict(description, company_name='Name Ltd'), dict(description, id='2')])
+    matcher.match([dict(description, companies_house_id='CH1')], match=False)
+    list(matcher.match_stream([dict(description, duns_number=123)], batch_size=1))
+    matcher.match([dict(description, company_name='Other')], update=False)
+    monkeypatch.setitem(app_with_db.config['matching'], 'description_log', False)
+    matcher.match([dict(description, company_name='Not logged')])
+
+    rows = db_utils.execute_query(
+        """
+        select batch_id, position, source, datetime, companies_house_id, duns_number, company_name
+        from description_log order by batch_id, position
+        """
+    )
+    assert rows == [
+        (1, 0, 'dit.datahub', datetime(2019, 1, 1), None, None, 'Name Ltd'),
+        (1, 1, 'dit.datahub', datetime(2019, 1, 1), None, None, None),
+        (2, 0, 'dit.datahub', datetime(2019, 1, 1), 'CH1', None, None),
+        (3, 0, 'dit.datahub', datetime(2019, 1, 1), None, '123', None),
+    ]
+    with db_utils.pipeline() as pipeline:
+        # non-string values are logged and stored as their JSON text
+        assert pipeline.query("select duns_number from duns_number_mapping") == [('123',)]
+
+
+def test_update_keeps_mapping_tables_logged(app_with_db):
+    _assert_matches(
+        descriptions=[('2019-01-01 00:00:00', 'ch1', 'dun1', 'name1')],
+        expected_matches=[('1', 1, '111000')],
+    )
+    with db_utils.pipeline() as pipeline:
+        assert all(mapping_tables_logged(pipeline).values())
+
+
+def test_update_keeps_group_tables_in_sync(app_with_db):
+    for descriptions in [
+        [('2019-01-01 00:00:00', None, 'dun1', 'name1')],
+        [('2019-01-02 00:00:00', 'ch2', None, 'name1', 'a@email.com')],
+        [('2019-01-03 00:00:00', 'ch2', 'dun1', 'name1')],
+        [('2019-01-04 00:00:00', 'ch3', 'dun1', None, 'b@email.com', 'cdms1', 'pc1')],
+        [('2019-01-05 00:00:00', 'ch2', 'dun2', 'name1')],
+    ]:
+        Matcher().match(_create_json(descriptions))
+        assert group_table_rows() == expected_group_table_rows()
+
+    assert db_utils.execute_query(
+        "select field, value from match_group where match_id = 3 order by 1, 2"
+    ) == [
+        ('cdms_ref', '1'),
+        ('companies_house_id', 'ch3'),
+        ('contact_email', 'email.com'),
+        ('duns_number', 'dun1'),
+        ('postcode', 'pc1'),
+    ]
+
+
+def test_backfill_group_tables(app_with_db):
+    descriptions = [('inc', 'ch1', 'dun1', 'name1'), ('inc', 'ch2', 'dun2', 'name2')]
+    Matcher().match(_create_json(descriptions))
+    expected = expected_group_table_rows()
+    db_utils.execute_statement(
+        "delete from match_group where field = 'duns_number';"
+        "update match_group set match_id = 10 where value = 'ch2';"
+        "insert into match_group values ('postcode', 'gone', 1, 'dit.datahub', now());"
+        "update latest_duns_by_match_id set duns_number = 'dun3' where match_id = 1;"
+        "delete from latest_duns_by_match_id where match_id = 2;"
+        "insert into latest_duns_by_match_id values (10, 'dun10', now());"
+    )
+
+    with db_utils.pipeline() as pipeline:
+        backfill_group_tables(pipeline)
+
+    assert group_table_rows() == expected
+
+
+def test_dnb_match_uses_latest_duns_of_group(app_with_db):
+    _assert_matches(
+        descriptions=[
+            ('2019-01-01 00:00:00', 'ch1', 'dun1'),
+            ('2019-01-03 00:00:00', 'ch1', 'dun2'),
+            ('2019-01-02 00:00:00', 'ch1', 'dun3'),
+        ],
+        expected_matches=[
+            ('1', 'dun1', '110000'),
+            ('2', 'dun2', '110000'),
+            ('3', 'dun3', '110000'),
+        ],
+        match=False,
+        dnb_match=True,
+    )
+    _assert_matches(
+        descriptions=[('2019-01-04 00:00:00', 'ch1'), ('2019-01-04 00:00:00', 'ch2')],
+        expected_matches=[('1', 'dun2', '100000'), ('2', None, '000000')],
+        update=False,
+        dnb_match=True,
+    )
+    # dun2 moves to a new group, the latest duns_number of the first is now dun3
+    _assert_matches(
+        descriptions=[('2019-01-05 00:00:00', 'ch2', 'dun2'), ('2019-01-06 00:00:00', 'ch1')],
+        expected_matches=[('1', 'dun2', '110000'), ('2', 'dun3', '100000')],
+        match=False,
+        dnb_match=True,
+    )
+
+
+def group_table_rows():
+    """
+    :return: rows of match_group and latest_duns_by_match_id
+    """
+    return (
+        db_utils.execute_query(
+            'select field, value, match_id, source, datetime from match_group order by 1, 2'
+        ),
+        db_utils.execute_query(
+            'select match_id, duns_number, datetime from latest_duns_by_match_id order by 1'
+        ),
+    )
+
+
+def expected_group_table_rows():
+    """
+    :return: rows of match_group and latest_duns_by_match_id derived from the mapping tables
+    """
+    match_group = db_utils.execute_query(
+        ' union all '.join(
+            f"select '{field}', {field}, match_id, source, datetime from {mt}"
+            for field, mt in _field_to_mapping_table
+        )
+        + ' order by 1, 2'
+    )
+    latest_duns = db_utils.execute_query(
+        """
+        select distinct on (match_id) match_id, duns_number, datetime from duns_number_mapping
+        order by match_id, datetime desc, duns_number
+        """
+    )
+    return match_group, latest_duns
+
+
 def _assert_matches(descriptions, expected_matches, update=True, match=True, dnb_match=False):
     matcher = Matcher()
     json_data = _create_json(descriptions)
@@ -0,0 +1,178 @@
+import pytest
+
+from app.algorithm.normaliser import (
+    normalise_description,
+    normalise_descriptions,
+    simplify_company_name,
+)
+from app.algorithm.sql_statements import json_to_tmp_table
+from app.db import db_utils
+
+COMPANY_NAMES = [
+    'Acme',
+    'The Acme Company Ltd',
+    'ACME LIMITED.',
+    'Acme Holdings Ltd.',
+    'Acme (UK) PLC',
+    'Acme LLP',
+    'Acme llc.',
+    'Acme & Sons Co. Ltd',
+    'Acme and Sons Co Ltd',
+    'Acme company limited',
+    'Acme : Holdings',
+    'Acme  :Holdings',
+    'Acme[1]; Widgets, "Gadgets"',
+    "O''Reilly Media",
+    "O'Reilly Media",
+    'Acme *closed* Ltd',
+    'Acme * not * really *',
+    'Acme - duplicate',
+    'Acme-Widgets',
+    'Acme / Widgets',
+    'Acme Widgets (duplicate)',
+    'Acme_duplicate',
+    'Acme.duplicate record',
+    'Acme dupilcate',
+    'Acme dupicate',
+    'Acme dissolved 2010',
+    'Acme *DO NOT USE*',
+    'do not use 12345678',
+    'Acme in liquidation',
+    'Acme (in liquidation)',
+    'Acme *in liquidation',
+    'Acme ceased trading',
+    'Acme trading as Widgets',
+    'Acme t/a Widgets',
+    'Acme acquired by Widgets',
+    'Acme please use 12345',
+    'Acme 12345 Ltd',
+    'Acme 1234 Ltd',
+    '12345',
+    'ltd',
+    'The ',
+    '   ',
+    '...',
+    '-',
+    'Acme\nLimited',
+    'Acme\tcompany ltd',
+    'Acme\n\nduplicate',
+    'Ünïcödé Gmbh & Co',
+    'Société Générale',
+    'Acme co',
+    'Acme co.uk',
+    'Acme Company',
+    'the the company',
+    'Acme    Widgets   Ltd   ',
+    # white space and case beyond ASCII, postgres and python classify them differently
+    'Acme\u2003Holdings Ltd',
+    'Acme\u3000Widgets\u2028duplicate',
+    'Acme\u00a0Holdings\u202fLtd',
+    'Acme\u2007Widgets\x85Ltd\x1c',
+    'İstanbul Holding',
+    'ΟΔΟΣ ΑΣ',
+    'Acme \u0131n liquidation',
+    'Acme diſsolved',
+    'Acme \u212aLtd',
+    'Acme \u0661\u0662\u0663\u0664\u0665',
+]
+
+SOURCES = ['dit.datahub', 'companies_house', None]
+
+
+def _descriptions():
+    descriptions = []
+    for source in SOURCES:
+        for name in COMPANY_NAMES:
+            descriptions.append(
+                {
+                    'id': str(len(descriptions)),
+                    'source': source,
+                    'datetime': '2019-01-01 00:00:00',
+                    'company_name': name,
+                }
+            )
+    descriptions.extend(
+        [
+            {
+                'id': 'other1',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-01',
+                'companies_house_id': 'NotRegis',
+                'duns_number': ' 123 ',
+                'contact_email': 'John.Smith@Example.COM',
+                'cdms_ref': 'ORG-12a34',
+                'postcode': 'Sw1A 1aa',
+            },
+            {
+                'id': 'other2',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-01',
+                'companies_house_id': 'SC012345',
+                'contact_email': 'no-at-sign',
+                'cdms_ref': 'none',
+            },
+            {
+                'id': 'other3',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-01',
+                'companies_house_id': '',
+                'contact_email': 'a@b@c',
+            },
+            {
+                'id': 'other4',
+                'source': 'companies_house',
+                'datetime': '2019-01-01',
+                'companies_house_id': 'İ0012345',
+                'contact_email': 'Info@ΣΑΣ.İo',
+                'cdms_ref': '12\u0663',
+                'postcode': 'SW1A\u00a01AA',
+            },
+        ]
+    )
+    return descriptions
+
+
+def test_normaliser_matches_sql_expressions(app_with_db):
+    descriptions = _descriptions()
+    with db_utils.pipeline() as pipeline:
+        json_to_tmp_table(pipeline, descriptions)
+        rows = pipeline.query('select * from tmp')
+    expected = {row.id: dict(row._mapping) for row in rows}
+
+    for description in descriptions:
+        normalised = normalise_description(description)
+        normalised.pop('datetime')
+        expected_description = expected[description['id']]
+        expected_description.pop('datetime')
+        assert normalised == expected_description, description
+
+
+def test_app_side_normalisation_loads_same_tmp_table(app_with_db):
+    descriptions = _descriptions()
+    with db_utils.pipeline() as pipeline:
+        json_to_tmp_table(pipeline, descriptions)
+        expected = pipeline.query('select * from tmp order by id')
+    with db_utils.pipeline() as pipeline:
+        json_to_tmp_table(
+            pipeline, list(normalise_descriptions(descriptions)), normalise_in_db=False
+        )
+        result = pipeline.query('select * from tmp order by id')
+
+    assert result == expected
+
+
+@pytest.mark.parametrize('processes', (1, 2))
+def test_normalise_descriptions_keeps_order(processes):
+    descriptions = _descriptions()
+
+    result = list(normalise_descriptions(descriptions, processes=processes, chunksize=7))
+
+    assert result == [normalise_description(description) for description in descriptions]
+
+
+def test_company_name_cache():
+    simplify_company_name.cache_clear()
+    simplify_company_name('Acme Ltd')
+    simplify_company_name('Acme Ltd')
+
+    assert simplify_company_name.cache_info().hits == 1
@@ -0,0 +1,47 @@
+import pytest
+
+from app.algorithm import Matcher
+from app.algorithm.profiler import profile, report, split_statements
+from app.algorithm.sql_statements import _field_to_mapping_table
+from tests.algorithm.test_matcher import _create_json
+
+
+def test_split_statements():
+    sql = """
+        SET LOCAL a TO ';';
+        -- a comment; with a semicolon
+        select 'it''s; quoted' /* ; */ from tmp;
+        insert into t values (1)
+    """
+
+    assert split_statements(sql) == [
+        "SET LOCAL a TO ';'",
+        "-- a comment; with a semicolon\n        select 'it''s; quoted' /* ; */ from tmp",
+        'insert into t values (1)',
+    ]
+
+
+@pytest.mark.parametrize('loader', ('copy', 'json'))
+@pytest.mark.parametrize('metrics_enabled', (False, True))
+def test_profile(app_with_db, monkeypatch, loader, metrics_enabled):
+    monkeypatch.setitem(app_with_db.config['matching'], 'tmp_table_loader', loader)
+    monkeypatch.setitem(app_with_db.config, 'metrics', {'enabled': metrics_enabled})
+    descriptions = _create_json([('inc', 'ch1', 'dun1', 'name1'), ('inc', 'ch2', 'dun1', None)])
+
+    plans = profile(descriptions)
+
+    assert [plan.name for plan in plans] == (
+        ['load: tmp']
+        + [f'update_mappings: {table}' for _, table in _field_to_mapping_table]
+        + [
+            'update_mappings: match_group',
+            'update_mappings: latest_duns_by_match_id',
+            'update_mappings: delete',
+        ]
+        + ['match_ids: select']
+    )
+    assert all(plan.execution_time >= 0 for plan in plans)
+    assert 'slowest plan nodes (exclusive time):' in report(plans, top=5)
+    # rolled back
+    matches = Matcher().match(descriptions, update=False)
+    assert [match[1] for match in matches] == [None, None]
@@ -0,0 +1,100 @@
+import pytest
+
+from app.algorithm.sql_statements import (
+    _description_columns,
+    copy_to_tmp_table,
+    json_to_tmp_table,
+)
+from app.db import db_utils
+
+DESCRIPTIONS = [
+    {
+        'id': '1',
+        'source': 'dit.datahub',
+        'datetime': '2019-01-01 00:00:00',
+        'companies_house_id': 'CH000001',
+        'duns_number': 'dun1',
+        'company_name': 'The Name (Holdings) Ltd',
+        'contact_email': 'John@Example.com',
+        'cdms_ref': 'ORG-12 34',
+        'postcode': 'SW1A 1AA',
+    },
+    {
+        'id': '2',
+        'source': 'companies_house',
+        'datetime': '2019-01-02T10:00:00',
+        'company_name': 'tab\tnew\nline\\back\rslash',
+        'postcode': 'N/A',
+    },
+    {
+        'id': '3',
+        'source': 'dit.export_wins',
+        'datetime': '2019-01-03 00:00:00',
+        'companies_house_id': 'n/a',
+        'company_name': 'Ünïcödé & Söns — dissolved',
+        'contact_email': None,
+    },
+    {'id': '4', 'datetime': '2019-01-04 00:00:00', 'duns_number': '\\N'},
+]
+
+
+@pytest.mark.parametrize('copy_format', ('text', 'binary'))
+def test_copy_loader_matches_json_loader(app_with_db, copy_format):
+    with db_utils.pipeline() as pipeline:
+        json_to_tmp_table(pipeline, DESCRIPTIONS)
+        expected = pipeline.query('select * from tmp order by id')
+
+    with db_utils.pipeline() as pipeline:
+        copy_to_tmp_table(pipeline, DESCRIPTIONS, copy_format=copy_format)
+        result = pipeline.query('select * from tmp order by id')
+
+    assert result == expected
+    assert len(result) == len(DESCRIPTIONS)
+
+
+def test_copy_loader_invalid_format(app_with_db):
+    with pytest.raises(ValueError):
+        with db_utils.pipeline() as pipeline:
+            copy_to_tmp_table(pipeline, DESCRIPTIONS, copy_format='csv')
+
+
+@pytest.mark.parametrize('normalise_in_db', (True, False))
+def test_loaders_keep_raw_descriptions(app_with_db, normalise_in_db):
+    with db_utils.pipeline() as pipeline:
+        json_to_tmp_table(pipeline, DESCRIPTIONS)
+        expected = pipeline.query('select * from tmp order by id')
+
+    data = DESCRIPTIONS
+    if not normalise_in_db:
+        with db_utils.pipeline() as pipeline:
+            json_to_tmp_table(pipeline, DESCRIPTIONS)
+            normalised = pipeline.query(f"select {', '.join(_description_columns)} from tmp")
+        by_id = {row[0]: dict(zip(_description_columns, map(_text, row))) for row in normalised}
+        data = [(d, by_id[d['id']]) for d in DESCRIPTIONS]
+
+    raw = {}
+    for loader, kwargs in ((json_to_tmp_table, {}), (copy_to_tmp_table, {'copy_format': 'binary'})):
+        with db_utils.pipeline() as pipeline:
+            loader(pipeline, data, normalise_in_db=normalise_in_db, keep_raw=True, **kwargs)
+            assert pipeline.query('select * from tmp order by id') == expected
+            raw[loader] = pipeline.query(
+                f"select position, {', '.join(_description_columns)} from tmp_raw order by id"
+            )
+
+    assert raw[json_to_tmp_table] == raw[copy_to_tmp_table]
+    assert raw[copy_to_tmp_table][1] == (
+        '1',
+        '2',
+        'companies_house',
+        '2019-01-02T10:00:00',
+        None,
+        None,
+        'tab\tnew\nline\\back\rslash',
+        None,
+        None,
+        'N/A',
+    )
+
+
+def _text(value):
+    return str(value) if value is not None else None
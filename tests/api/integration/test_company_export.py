@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+
+import pytest
+
+from app.algorithm import Matcher
+
+
+@pytest.fixture(autouse=True)
+def setup_function(app_with_db):
+    app_with_db.config['access_control']['hawk_enabled'] = False
+    Matcher().match(
+        [
+            {
+                'id': '1',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-01 00:00:00',
+                'companies_house_id': '11111111',
+                'company_name': 'Apple Ltd',
+            },
+            {
+                'id': '2',
+                'source': 'dnb',
+                'datetime': '2019-01-02 00:00:00',
+                'companies_house_id': '22222222',
+                'duns_number': '123456789',
+            },
+        ]
+    )
+
+
+def test_export_csv(test_client):
+    res = test_client.get('/api/v1/company/export/')
+
+    assert res.status_code == 200
+    assert res.mimetype == 'text/csv'
+    assert res.is_streamed
+    rows = list(csv.reader(io.StringIO(res.get_data(as_text=True))))
+    assert rows[0] == ['field', 'value', 'prev_match_id', 'match_id', 'source', 'datetime']
+    assert sorted(rows[1:]) == [
+        ['companies_house_id', '11111111', '1', '1', 'dit.datahub', '2019-01-01 00:00:00'],
+        ['companies_house_id', '22222222', '2', '2', 'dnb', '2019-01-02 00:00:00'],
+        ['company_name', 'apple', '1', '1', 'dit.datahub', '2019-01-01 00:00:00'],
+        ['duns_number', '123456789', '2', '2', 'dnb', '2019-01-02 00:00:00'],
+    ]
+
+
+def test_export_ndjson_with_filters(test_client):
+    res = test_client.get(
+        '/api/v1/company/export/?format=ndjson&fields=companies_house_id,duns_number'
+        '&since=2019-01-02&source=dnb,companies_house'
+    )
+
+    assert res.status_code == 200
+    assert res.mimetype == 'application/x-ndjson'
+    lines = res.get_data(as_text=True).splitlines()
+    assert sorted(json.loads(line)['value'] for line in lines) == ['123456789', '22222222']
+    assert json.loads(lines[0])['datetime'] == '2019-01-02T00:00:00'
+
+
+def test_export_until(test_client):
+    res = test_client.get('/api/v1/company/export/?fields=company_name&until=2019-01-01%2000:00:01')
+
+    assert res.get_data(as_text=True).splitlines()[1:] == [
+        'company_name,apple,1,1,dit.datahub,2019-01-01 00:00:00'
+    ]
+
+
+@pytest.mark.parametrize(
+    'query,error',
+    (
+        ('fields=name', 'unknown fields: name'),
+        ('format=xml', 'format needs to be one of csv, ndjson'),
+        ('since=yesterday', 'invalid datetime: yesterday'),
+    ),
+)
+def test_export_invalid_parameters(test_client, query, error):
+    res = test_client.get(f'/api/v1/company/export/?{query}')
+
+    assert res.status_code == 400
+    assert json.loads(res.get_data()) == {'error': error}
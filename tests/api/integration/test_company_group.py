@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from app.algorithm import Matcher
+
+
+@pytest.fixture(autouse=True)
+def setup_function(app_with_db):
+    app_with_db.config['access_control']['hawk_enabled'] = False
+    Matcher().match(
+        [
+            {
+                'id': '1',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-01 00:00:00',
+                'companies_house_id': '11111111',
+                'company_name': 'Apple Ltd',
+            },
+            {
+                'id': '2',
+                'source': 'dnb',
+                'datetime': '2019-01-02 00:00:00',
+                'companies_house_id': '11111111',
+                'duns_number': '123456789',
+            },
+            {
+                'id': '3',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-03 00:00:00',
+                'companies_house_id': '22222222',
+            },
+        ]
+    )
+
+
+def test_match_group(test_client):
+    res = test_client.get('/api/v1/company/group/1/')
+
+    assert res.status_code == 200
+    assert json.loads(res.get_data()) == {
+        'match_id': 1,
+        'members': [
+            {
+                'field': 'company_name',
+                'value': 'apple',
+                'source': 'dit.datahub',
+                'datetime': '2019-01-01T00:00:00',
+            },
+            {
+                'field': 'companies_house_id',
+                'value': '11111111',
+                'source': 'dnb',
+                'datetime': '2019-01-02T00:00:00',
+            },
+            {
+                'field': 'duns_number',
+                'value': '123456789',
+                'source': 'dnb',
+                'datetime': '2019-01-02T00:00:00',
+            },
+        ],
+    }
+
+
+def test_match_group_not_found(test_client):
+    res = test_client.get('/api/v1/company/group/3/')
+
+    assert res.status_code == 404
+    assert json.loads(res.get_data()) == {}
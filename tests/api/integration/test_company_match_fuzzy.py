@@ -0,0 +1,154 @@
+import time
+
+import pytest
+
+from app.algorithm.fuzzy_names import fuzzy_names
+from app.db.models import CompanyNameMapping
+from tests.algorithm.test_match_cache import RedisMock
+from tests.api.support.utils import assert_search_api_response
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_function(app, add_mapping_db):
+    app.config['access_control']['hawk_enabled'] = False
+    add_mapping_db(
+        [
+            {
+                'company_name': name,
+                'prev_match_id': match_id,
+                'match_id': match_id,
+                'source': 'companies_house.companies',
+                'datetime': '2019-01-02 00:00:00',
+            }
+            for name, match_id in [
+                ('acmeholdingsuk', 1),
+                ('acmeholdings', 2),
+                ('acmeholdingsgroup', 2),
+                ('zenithtrading', 3),
+            ]
+        ],
+        CompanyNameMapping,
+    )
+    cache, app.cache = app.cache, RedisMock()
+    with app.app_context():
+        fuzzy_names.build()
+        fuzzy_names.refresh()
+    app.cache = cache
+
+
+@pytest.fixture
+def fuzzy_app(app, monkeypatch):
+    monkeypatch.setitem(
+        app.config,
+        'fuzzy_name',
+        {
+            'enabled': True,
+            'refresh_interval': 3600,
+            'threshold': 0.5,
+            'max_candidates': 5,
+            'budget_ms': 1000,
+        },
+    )
+    return app
+
+
+@pytest.mark.parametrize(
+    'params,body,expected_response',
+    (
+        #   Test candidates of near duplicate names, per match_id
+        (
+            'fuzzy_name=true',
+            {
+                'descriptions': [
+                    {'id': '1', 'company_name': 'Acme Holding UK Limited'},
+                    {'id': '2', 'company_name': 'Zenith Trading Ltd'},
+                    {'id': '3', 'company_name': 'Unrelated Widgets'},
+                    {'id': '4', 'companies_house_id': '1rr31111'},
+                ],
+            },
+            (
+                200,
+                {
+                    'matches': [
+                        {
+                            'id': '1',
+                            'match_id': None,
+                            'similarity': '000000',
+                            'candidates': [
+                                {'match_id': 1, 'score': 0.688},
+                                {'match_id': 2, 'score': 0.667},
+                            ],
+                        },
+                        {
+                            'id': '2',
+                            'match_id': 3,
+                            'similarity': '001000',
+                            'candidates': [{'match_id': 3, 'score': 1.0}],
+                        },
+                        {'id': '3', 'match_id': None, 'similarity': '000000', 'candidates': []},
+                        {'id': '4', 'match_id': None, 'similarity': '000000', 'candidates': []},
+                    ]
+                },
+            ),
+        ),
+        #   Test invalid fuzzy_name
+        (
+            'fuzzy_name=yes',
+            {'descriptions': [{'id': '1', 'company_name': 'acme'}]},
+            (400, {'error': 'invalid fuzzy_name parameter. needs to be true or false'}),
+        ),
+        #   Test fuzzy_name with dnb_match
+        (
+            'fuzzy_name=true&dnb_match=true',
+            {'descriptions': [{'id': '1', 'company_name': 'acme'}]},
+            (400, {'error': 'fuzzy_name and dnb_match cannot both be true'}),
+        ),
+    ),
+)
+def test_match_fuzzy_name(params, body, expected_response, fuzzy_app):
+    with fuzzy_app.test_client() as app_context:
+        assert_search_api_response(
+            app_context=app_context,
+            api='http://localhost:80/api/v1/company/match/',
+            params=params,
+            body=body,
+            expected_response=expected_response,
+        )
+
+
+def test_match_fuzzy_name_not_enabled(app):
+    with app.test_client() as app_context:
+        assert_search_api_response(
+            app_context=app_context,
+            api='http://localhost:80/api/v1/company/match/',
+            params='fuzzy_name=true',
+            body={'descriptions': [{'id': '1', 'company_name': 'acme'}]},
+            expected_response=(400, {'error': 'fuzzy_name matching is not enabled'}),
+        )
+
+
+def test_match_fuzzy_name_over_budget(fuzzy_app, monkeypatch):
+    monkeypatch.setitem(fuzzy_app.config['fuzzy_name'], 'budget_ms', -1)
+    with fuzzy_app.test_client() as app_context:
+        assert_search_api_response(
+            app_context=app_context,
+            api='http://localhost:80/api/v1/company/match/',
+            params='fuzzy_name=true',
+            body={'descriptions': [{'id': '1', 'company_name': 'acme holdings'}]},
+            expected_response=(
+                200,
+                {
+                    'matches': [
+                        {'id': '1', 'match_id': 2, 'similarity': '001000', 'candidates': None}
+                    ]
+                },
+            ),
+        )
+
+
+def test_match_fuzzy_name_match_ids_count_against_budget(fuzzy_app):
+    with fuzzy_app.app_context():
+        assert fuzzy_names._match_ids({'acmeholdings'}, time.perf_counter() + 60) == {
+            'acmeholdings': 2
+        }
+        assert fuzzy_names._match_ids({'acmeholdings'}, time.perf_counter() - 1) is None
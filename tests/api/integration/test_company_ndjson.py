@@ -0,0 +1,136 @@
+import json
+
+import pytest
+
+from app.algorithm import Matcher
+from app.algorithm.bloom_filter import get_bloom_filters
+from app.api.utils import encode_match_line
+from app.db import db_utils
+from app.db.models import sql_alchemy
+from tests.algorithm.test_match_cache import RedisMock
+
+
+@pytest.fixture(autouse=True)
+def setup_function(app_with_db):
+    app_with_db.config['access_control']['hawk_enabled'] = False
+
+
+DESCRIPTIONS = [
+    {
+        'id': '1',
+        'datetime': '2010-01-01 00:00:00',
+        'source': 'dit.datahub',
+        'companies_house_id': '11111111',
+        'company_name': 'a',
+    },
+    {
+        'id': '2',
+        'datetime': '2010-01-02 00:00:00',
+        'source': 'dit.datahub',
+        'companies_house_id': '22222222',
+        'company_name': 'b',
+    },
+    {
+        'id': '3',
+        'datetime': '2010-01-03 00:00:00',
+        'source': 'dit.datahub',
+        'companies_house_id': '11111111',
+        'company_name': 'b',
+    },
+]
+
+
+@pytest.mark.parametrize('params', ('', 'dnb_match=true'))
+def test_ndjson_update_and_match(app_with_db, test_client, params):
+    res = _post_ndjson(test_client, '/api/v1/company/update/', DESCRIPTIONS, params)
+    assert res.status_code == 200
+    assert res.is_streamed
+    assert res.mimetype == 'application/x-ndjson'
+    ndjson_matches = _read_ndjson(res)
+
+    res = test_client.post(
+        f'/api/v1/company/match/?{params}',
+        data=json.dumps({'descriptions': DESCRIPTIONS}),
+        content_type='application/json',
+    )
+    assert ndjson_matches == json.loads(res.get_data())['matches']
+
+    res = _post_ndjson(test_client, '/api/v1/company/match/', DESCRIPTIONS, params)
+    assert _read_ndjson(res) == ndjson_matches
+    assert sql_alchemy.engine.pool.checkedout() == 0
+
+
+def test_ndjson_update_without_match(app_with_db, test_client):
+    res = _post_ndjson(test_client, '/api/v1/company/update/', DESCRIPTIONS, 'match=false')
+    assert res.status_code == 204
+
+    res = _post_ndjson(test_client, '/api/v1/company/match/', DESCRIPTIONS[:1])
+    assert _read_ndjson(res) == [{'id': '1', 'match_id': 2, 'similarity': '101000'}]
+
+
+@pytest.mark.parametrize(
+    'lines,expected_error',
+    (
+        (
+            [json.dumps(DESCRIPTIONS[0]), json.dumps({'id': '2', 'datetime': '2010-01-01'})],
+            {
+                'error': "'source' is a required property",
+                'source': {'path': '/descriptions/1'},
+            },
+        ),
+        (
+            [json.dumps(dict(DESCRIPTIONS[0], companies_house_id='1'))],
+            {'error': "'1' is too short", 'source': {'path': '/descriptions/0/companies_house_id'}},
+        ),
+        (['{"id": "1"'], {'error': 'Unable to read JSON payload'}),
+    ),
+)
+def test_ndjson_update_invalid_description(app_with_db, test_client, lines, expected_error):
+    res = test_client.post(
+        '/api/v1/company/update/',
+        data='\n'.join(lines) + '\n',
+        content_type='application/x-ndjson',
+    )
+
+    assert res.status_code == 400
+    assert json.loads(res.get_data())['error'] == expected_error['error']
+    res = _post_ndjson(test_client, '/api/v1/company/match/', DESCRIPTIONS[:1])
+    assert _read_ndjson(res) == [{'id': '1', 'match_id': None, 'similarity': '000000'}]
+
+
+def _post_ndjson(test_client, endpoint, descriptions, params=''):
+    return test_client.post(
+        f'{endpoint}?{params}',
+        data=''.join(json.dumps(d) + '\n' for d in descriptions),
+        content_type='application/x-ndjson',
+    )
+
+
+def _read_ndjson(res):
+    return [json.loads(line) for line in res.get_data().decode('utf-8').splitlines()]
+
+
+@pytest.mark.parametrize('params', ('', 'dnb_match=true'))
+def test_ndjson_match_with_cache_and_bloom_filters(app_with_db, test_client, monkeypatch, params):
+    _post_ndjson(test_client, '/api/v1/company/update/', DESCRIPTIONS, 'match=false')
+    res = _post_ndjson(test_client, '/api/v1/company/match/', DESCRIPTIONS, params)
+    expected = _read_ndjson(res)
+    monkeypatch.setitem(app_with_db.config, 'match_cache', {'enabled': True, 'ttl': 60})
+    monkeypatch.setitem(
+        app_with_db.config, 'bloom_filter', {'enabled': True, 'capacity': 1000, 'error_rate': 0.001}
+    )
+    monkeypatch.setattr(app_with_db, 'cache', RedisMock(), raising=False)
+    with db_utils.pipeline() as pipeline:
+        get_bloom_filters().build(pipeline)
+
+    for _ in range(2):
+        res = _post_ndjson(test_client, '/api/v1/company/match/', DESCRIPTIONS, params)
+        assert res.is_streamed
+        assert _read_ndjson(res) == expected
+
+    # requests larger than a batch are matched in the database
+    matches = Matcher().match_stream(
+        iter(DESCRIPTIONS), update=False, dnb_match=params != '', batch_size=2
+    )
+    assert [json.loads(encode_match_line(match)) for match in matches] == expected
+    assert sql_alchemy.engine.pool.checkedout() == 0
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+from app.db.models import UpdateJob
+from app.jobs import run_next_job
+
+
+@pytest.fixture(autouse=True)
+def setup_function(app_with_db):
+    app_with_db.config['access_control']['hawk_enabled'] = False
+
+
+BODY = {
+    'descriptions': [
+        {
+            'id': '1',
+            'datetime': '2010-01-01 00:00:00',
+            'source': 'dit.datahub',
+            'companies_house_id': '11111111',
+            'company_name': 'a',
+        },
+        {
+            'id': '2',
+            'datetime': '2010-01-02 00:00:00',
+            'source': 'dit.datahub',
+            'companies_house_id': '11111111',
+            'company_name': 'b',
+        },
+    ],
+}
+
+
+def test_async_update(app_with_db, test_client):
+    res = _post(test_client, BODY)
+    assert res.status_code == 202
+    job_id = json.loads(res.get_data())['job_id']
+    assert res.headers['Location'].endswith(f'/api/v1/company/update/jobs/{job_id}/')
+
+    job = _get_job(test_client, job_id)
+    assert job['status'] == 'queued'
+    assert job['started'] is None
+
+    assert run_next_job().id == job_id
+    assert run_next_job() is None
+
+    job = _get_job(test_client, job_id)
+    assert job['status'] == 'finished'
+    assert job['matches'] == [
+        {'id': '1', 'match_id': 1, 'similarity': '101000'},
+        {'id': '2', 'match_id': 1, 'similarity': '101000'},
+    ]
+    assert UpdateJob.get_job(job_id).descriptions is None
+
+
+def test_async_update_without_match(app_with_db, test_client):
+    job_id = json.loads(_post(test_client, BODY, 'match=false').get_data())['job_id']
+    run_next_job()
+
+    job = _get_job(test_client, job_id)
+    assert job['status'] == 'finished'
+    assert 'matches' not in job
+
+
+def test_async_update_invalid_parameters(app_with_db, test_client):
+    res = _post(test_client, BODY, 'match=true&dnb_match=true')
+
+    assert res.status_code == 400
+    assert UpdateJob.query.count() == 0
+
+
+def test_jobs_run_in_order(app_with_db, test_client):
+    job_ids = [json.loads(_post(test_client, BODY).get_data())['job_id'] for _ in range(3)]
+
+    assert [run_next_job().id for _ in range(3)] == job_ids
+
+
+def test_failed_job(app_with_db, test_client, monkeypatch):
+    job_id = json.loads(_post(test_client, BODY).get_data())['job_id']
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('failed')
+
+    monkeypatch.setattr('app.jobs.Matcher.match', fail)
+    run_next_job()
+
+    job = _get_job(test_client, job_id)
+    assert job['status'] == 'failed'
+    assert 'matches' not in job
+
+
+def test_abandoned_job_is_claimed_again(app_with_db, test_client, monkeypatch):
+    job_id = json.loads(_post(test_client, BODY).get_data())['job_id']
+    monkeypatch.setitem(app_with_db.config['jobs'], 'stale_after', 0)
+    monkeypatch.setitem(app_with_db.config['jobs'], 'max_attempts', 2)
+
+    UpdateJob.claim_next(stale_after=3600, max_attempts=2)
+    assert run_next_job().id == job_id
+    assert _get_job(test_client, job_id)['status'] == 'finished'
+
+    job_id = json.loads(_post(test_client, BODY).get_data())['job_id']
+    UpdateJob.claim_next(stale_after=3600, max_attempts=2)
+    UpdateJob.claim_next(stale_after=0, max_attempts=2)
+    assert run_next_job() is None
+    assert _get_job(test_client, job_id)['status'] == 'failed'
+
+
+def test_unknown_job(app_with_db, test_client):
+    res = test_client.get('/api/v1/company/update/jobs/unknown/')
+
+    assert res.status_code == 404
+
+
+def _post(test_client, body, params=''):
+    return test_client.post(
+        f'/api/v1/company/update/async/?{params}',
+        data=json.dumps(body),
+        content_type='application/json',
+    )
+
+
+def _get_job(test_client, job_id):
+    res = test_client.get(f'/api/v1/company/update/jobs/{job_id}/')
+    assert res.status_code == 200
+    return json.loads(res.get_data())
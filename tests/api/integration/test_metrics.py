@@ -0,0 +1,54 @@
+import json
+
+import pytest
+from prometheus_client.parser import text_string_to_metric_families
+
+from tests.api.integration.test_company_update_async import BODY
+
+
+@pytest.fixture(autouse=True)
+def setup_function(app_with_db, monkeypatch):
+    app_with_db.config['access_control']['hawk_enabled'] = False
+    monkeypatch.setitem(app_with_db.config, 'metrics', {'enabled': True})
+
+
+def test_metrics_disabled(app_with_db, test_client, monkeypatch):
+    monkeypatch.setitem(app_with_db.config, 'metrics', {'enabled': False})
+
+    assert test_client.get('/metrics').status_code == 404
+
+
+def test_update_metrics(test_client):
+    before = _samples(test_client)
+    res = test_client.post(
+        '/api/v1/company/update/', data=json.dumps(BODY), content_type='application/json'
+    )
+    assert json.loads(res.get_data())['matches'] == [
+        {'id': '1', 'match_id': 1, 'similarity': '101000'},
+        {'id': '2', 'match_id': 1, 'similarity': '101000'},
+    ]
+    after = _samples(test_client)
+
+    def observed(name, **labels):
+        labels = dict({'endpoint': 'api.update', 'match': 'true', 'dnb_match': 'false'}, **labels)
+        key = (name, tuple(sorted(labels.items())))
+        return after.get(key, 0) - before.get(key, 0)
+
+    for stage in ['pool_checkout', 'validation', 'load', 'update_mappings', 'match_ids']:
+        assert observed('cms_stage_seconds_count', stage=stage) >= 1
+    assert observed('cms_request_payload_bytes_sum') == len(json.dumps(BODY))
+    assert observed('cms_update_pass_rows_in_sum', field='companies_house_id') == 2
+    assert observed('cms_update_pass_rows_in_sum', field='duns_number') == 0
+    assert observed('cms_update_pass_rows_written_sum', field='companies_house_id') == 1
+    assert observed('cms_update_pass_rows_written_sum', field='company_name') == 2
+    assert observed('cms_update_pass_seconds_count', field='company_name') == 1
+
+
+def _samples(test_client):
+    res = test_client.get('/metrics')
+    assert res.status_code == 200
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in text_string_to_metric_families(res.get_data(as_text=True))
+        for sample in family.samples
+    }
@@ -1,8 +1,9 @@
 import pytest
 from flask import make_response
 from mohawk import Sender
-from mohawk.util import utc_now
+from mohawk.util import calculate_payload_hash, utc_now
 
+from app.api.access_control import _payload
 from app.api.views import ac, api, json_error
 from app.db.models import HawkUsers
 
@@ -18,8 +19,11 @@ def mock_endpoint():
 class CacheMock:
     cache = {}
 
-    def set(self, key, value, ex):
+    def set(self, key, value, ex, nx=False):
+        if nx and key in self.cache:
+            return None
         self.cache[key] = value
+        return True
 
     def get(self, key):
         return self.cache.get(key, None)
@@ -174,10 +178,31 @@ class TestAuthentication:
             response = c.get('/test/', headers={'Authorization': sender.request_header})
             assert not response.headers.get('Server-Authorization')
 
+    def test_streamed_response_header(self):
+        content = '{"id": "1", "companies_house_id": "11111111"}\n'
+        sender = Sender(
+            credentials={'id': 'iss1', 'key': 'secret1', 'algorithm': 'sha256'},
+            url='http://localhost:80/api/v1/company/match/',
+            method='POST',
+            content=content,
+            content_type='application/x-ndjson',
+        )
+        with self.app.test_client() as c:
+            response = c.post(
+                '/api/v1/company/match/',
+                data=content,
+                content_type='application/x-ndjson',
+                headers={'Authorization': sender.request_header},
+            )
+            assert response.status_code == 200
+            assert response.get_data() == b'{"id":"1","match_id":null,"similarity":"000000"}\n'
+            assert not response.headers.get('Server-Authorization')
+
     def test_endpoints_secured(self):
         urls = [
             '/api/v1/company/match/',
             '/api/v1/company/update/',
+            '/api/v1/company/update/async/',
         ]
         with self.app.test_client() as c:
             for url in urls:
@@ -259,3 +284,10 @@ class TestAuthorization:
             response = c.get('/test/', headers={'Authorization': sender.request_header})
             assert response.status_code == 200
             assert response.get_data() == b'OK'
+
+
+@pytest.mark.parametrize('content', (b'', b'OK', '{"a": "é"}'.encode('utf-8') * 1000))
+def test_payload_hash(content):
+    assert calculate_payload_hash(_payload(content), 'sha256', 'application/json') == (
+        calculate_payload_hash(content, 'sha256', 'application/json')
+    )
@@ -0,0 +1,97 @@
+from app.api.credentials import CredentialsCache
+from tests.algorithm.test_match_cache import BrokenRedisMock, RedisMock
+
+
+class LoaderMock:
+    def __init__(self):
+        self.users = {'a': ('key_a', ['*']), 'b': ('key_b', ['match'])}
+        self.calls = []
+
+    def __call__(self, client_id):
+        self.calls.append(client_id)
+        return self.users.get(client_id)
+
+
+class ClockMock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_credentials_cache_hit_skips_loader():
+    loader = LoaderMock()
+    cache = CredentialsCache(loader, RedisMock(), maxsize=10, ttl=60)
+
+    assert cache.get('a') == ('key_a', ['*'])
+    assert cache.get('a') == ('key_a', ['*'])
+    assert cache.get('unknown') is None
+    assert cache.get('unknown') is None
+    assert loader.calls == ['a', 'unknown']
+
+
+def test_credentials_cache_ttl():
+    loader = LoaderMock()
+    clock = ClockMock()
+    cache = CredentialsCache(loader, RedisMock(), maxsize=10, ttl=60, clock=clock)
+
+    cache.get('a')
+    clock.now = 59
+    cache.get('a')
+    clock.now = 60
+    cache.get('a')
+    assert loader.calls == ['a', 'a']
+
+
+def test_credentials_cache_maxsize():
+    loader = LoaderMock()
+    cache = CredentialsCache(loader, RedisMock(), maxsize=1, ttl=60)
+
+    cache.get('a')
+    cache.get('b')
+    cache.get('b')
+    cache.get('a')
+    assert loader.calls == ['a', 'b', 'a']
+
+
+def test_credentials_cache_invalidate_other_workers():
+    loader = LoaderMock()
+    client = RedisMock()
+    clock = ClockMock()
+    cache = CredentialsCache(loader, client, maxsize=10, ttl=60, poll_interval=5, clock=clock)
+    other_cache = CredentialsCache(loader, client, maxsize=10, ttl=60, clock=clock)
+
+    cache.get('a')
+    loader.users['a'] = ('new_key', ['*'])
+    other_cache.invalidate('a')
+    assert cache.get('a') == ('key_a', ['*'])
+    clock.now = 5
+    assert cache.get('a') == ('new_key', ['*'])
+    assert cache.get('a') == ('new_key', ['*'])
+    assert loader.calls == ['a', 'a']
+
+
+def test_credentials_cache_polls_generation():
+    client = RedisMock()
+    clock = ClockMock()
+    cache = CredentialsCache(LoaderMock(), client, maxsize=10, ttl=60, poll_interval=5, clock=clock)
+
+    for now in range(10):
+        clock.now = now
+        cache.get('a')
+    assert client.calls == ['get', 'get']
+    cache.invalidate()
+    cache.get('a')
+    assert client.calls == ['get', 'get', 'incr', 'get']
+
+
+def test_credentials_cache_redis_unavailable():
+    loader = LoaderMock()
+    cache = CredentialsCache(loader, BrokenRedisMock(), maxsize=10, ttl=60)
+
+    assert cache.get('a') == ('key_a', ['*'])
+    assert cache.get('a') == ('key_a', ['*'])
+    cache.invalidate('a')
+    assert cache.get('a') == ('key_a', ['*'])
+    assert loader.calls == ['a', 'a']
@@ -0,0 +1,53 @@
+from app.api.nonces import NonceStore, stats
+from tests.algorithm.test_match_cache import BrokenRedisMock, RedisMock
+from tests.api.unit.test_credentials import ClockMock
+
+
+class NxRedisMock(RedisMock):
+    def set(self, key, value, ex=None, nx=False):
+        self.calls.append('set')
+        if nx and key in self.cache:
+            return None
+        self.cache[key] = value
+        return True
+
+
+def test_nonce_store_single_round_trip():
+    client = NxRedisMock()
+    store = NonceStore(ttl=300, maxsize=10)
+
+    assert store.seen(client, 'a') is False
+    assert store.seen(client, 'a') is True
+    assert store.seen(client, 'b') is False
+    assert client.calls == ['set', 'set', 'set']
+
+
+def test_nonce_store_falls_back_to_local_window():
+    clock = ClockMock()
+    store = NonceStore(ttl=300, maxsize=10, clock=clock)
+    fallbacks = stats.fallbacks
+
+    assert store.seen(BrokenRedisMock(), 'a') is False
+    assert store.seen(BrokenRedisMock(), 'a') is True
+    assert stats.fallbacks == fallbacks + 2
+    # nonces seen while redis was unavailable are still rejected once it is back
+    assert store.seen(NxRedisMock(), 'a') is True
+    clock.now = 300
+    assert store.seen(BrokenRedisMock(), 'a') is False
+
+
+def test_nonce_store_local_window_is_bounded():
+    store = NonceStore(ttl=300, maxsize=2)
+
+    for key in ['a', 'b', 'c']:
+        assert store.seen(BrokenRedisMock(), key) is False
+    assert list(store._window) == ['b', 'c']
+    assert store.seen(BrokenRedisMock(), 'a') is False
+
+
+def test_nonce_store_counts_redis_latency():
+    calls = stats.redis_calls
+    NonceStore(ttl=300, maxsize=10).seen(NxRedisMock(), 'a')
+
+    assert stats.redis_calls == calls + 1
+    assert stats.mean_redis_latency > 0
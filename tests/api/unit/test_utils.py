@@ -0,0 +1,24 @@
+import json
+
+from flask import jsonify
+
+from app.api.utils import encode_match_line, matches_response
+
+
+def test_matches_response_is_encoded_like_jsonify(app):
+    rows = [('1', 1, '110000'), ('2', None, '000000'), ('3', 'dun1', '010000')]
+
+    response = matches_response(rows)
+    expected = jsonify(
+        {'matches': [{'id': row[0], 'match_id': row[1], 'similarity': row[2]} for row in rows]}
+    )
+
+    assert response.mimetype == 'application/json'
+    assert response.get_data() == expected.get_data()
+
+
+def test_encode_match_line():
+    line = encode_match_line(('é', 1, '110000'))
+
+    assert line.endswith(b'\n')
+    assert json.loads(line) == {'id': 'é', 'match_id': 1, 'similarity': '110000'}
@@ -0,0 +1,104 @@
+import random
+
+import pytest
+from jsonschema import FormatChecker, validate
+from jsonschema.exceptions import ValidationError
+
+from app.api.schema import COMPANY_MATCH_BODY, COMPANY_UPDATE_BODY
+from app.api.utils import schema_validation_error_path
+from app.api.validation import SchemaValidator
+
+VALUES = [
+    None,
+    1,
+    1.5,
+    True,
+    '',
+    'a',
+    '12345678',
+    '123456789',
+    'a@b.com',
+    'a@b',
+    '@b.c',
+    [],
+    ['a'],
+    {},
+    {'a': 'b'},
+]
+
+FIELDS = [
+    'id',
+    'source',
+    'datetime',
+    'company_name',
+    'companies_house_id',
+    'duns_number',
+    'contact_email',
+    'postcode',
+    'cdms_ref',
+    'other',
+]
+
+
+@pytest.mark.parametrize('schema', (COMPANY_MATCH_BODY, COMPANY_UPDATE_BODY))
+@pytest.mark.parametrize('seed', range(5))
+def test_schema_validator_matches_jsonschema(schema, seed):
+    rnd = random.Random(seed)
+    validator = SchemaValidator(schema)
+    for _ in range(500):
+        instance = _random_body(rnd)
+        assert _error(validator.validate, instance) == _error(
+            lambda data: validate(data, schema, format_checker=FormatChecker()), instance
+        )
+
+
+def test_schema_validator_valid_body():
+    validator = SchemaValidator(COMPANY_UPDATE_BODY)
+    body = {
+        'descriptions': [
+            {'id': '1', 'source': 'dit.datahub', 'datetime': '2019-01-01', 'postcode': 'SW1'},
+            {'id': '2', 'source': 'dit.datahub', 'datetime': '2019-01-01', 'cdms_ref': '1'},
+        ]
+    }
+
+    assert validator.is_valid(body)
+    validator.validate(body)
+
+
+def test_schema_validator_unsupported_keyword():
+    with pytest.raises(ValueError):
+        SchemaValidator({'type': 'object', 'additionalProperties': False})
+
+
+def _error(validate_func, instance):
+    try:
+        validate_func(instance)
+    except ValidationError as e:
+        return e.message, schema_validation_error_path(e)
+    return None
+
+
+def _random_body(rnd):
+    roll = rnd.random()
+    if roll < 0.05:
+        return rnd.choice(VALUES)
+    if roll < 0.1:
+        return {'other': []}
+    descriptions = [_random_description(rnd) for _ in range(rnd.randint(0, 4))]
+    if rnd.random() < 0.05:
+        descriptions.append(rnd.choice(VALUES))
+    return {'descriptions': descriptions}
+
+
+def _random_description(rnd):
+    description = {}
+    for field in FIELDS:
+        roll = rnd.random()
+        if roll < 0.15:
+            description[field] = rnd.choice(VALUES)
+        elif roll < 0.6 and field != 'other':
+            description[field] = {
+                'companies_house_id': '12345678',
+                'contact_email': 'a@b.com',
+            }.get(field, 'value')
+    return description
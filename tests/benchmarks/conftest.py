@@ -0,0 +1,6 @@
+import os
+
+# benchmarks are slow and only meaningful against a dedicated database,
+# so they only run on request: BENCHMARK=1 make benchmark
+if not bool(int(os.environ.get('BENCHMARK', '0'))):
+    collect_ignore_glob = ['test_*.py']
@@ -0,0 +1,149 @@
+"""
+Synthetic company descriptions for benchmarks
+
+Descriptions are drawn from companies whose identifiers are derived from their index, so
+that any number of descriptions can be generated without keeping the companies in memory.
+Each description either introduces a new company or, with probability overlap, describes one
+already described, until it has been described group_size times. Descriptions of the same
+company carry a random subset of its identifiers and variations of its name that normalise
+to the same value, as they would when coming from different sources.
+"""
+
+import random
+from array import array
+from datetime import datetime, timedelta
+
+_WORDS = [
+    'acme', 'global', 'british', 'northern', 'atlantic', 'green', 'blue', 'royal',
+    'digital', 'systems', 'foods', 'energy', 'trading', 'engineering', 'logistics',
+    'partners', 'capital', 'solutions', 'marine', 'textiles', 'pharma', 'motors',
+]  # fmt: skip
+_SUFFIXES = ['ltd', 'limited', 'plc', 'llp', 'holdings ltd', 'uk limited']
+_SHARED_DOMAINS = ['gmail.com', 'hotmail.co.uk', 'outlook.com', 'yahoo.co.uk', 'btinternet.com']
+_DIT_SOURCES = ['dit.datahub', 'dit.export_wins', 'dit.cdms']
+_OTHER_SOURCES = ['dnb', 'companies_house', 'hmrc.exporters']
+_POSTCODE_AREAS = ['SW', 'EC', 'M', 'B', 'LS', 'G', 'EH', 'CF', 'BS', 'NE']
+
+# chance of a description carrying each field, before the source specific adjustments
+_FIELD_RATES = {
+    'companies_house_id': 0.6,
+    'duns_number': 0.4,
+    'company_name': 0.95,
+    'contact_email': 0.5,
+    'cdms_ref': 0.3,
+    'postcode': 0.7,
+}
+
+
+class DescriptionGenerator:
+    def __init__(
+        self,
+        seed=0,
+        overlap=0.3,
+        group_size=5,
+        shared_email_domains=0.2,
+        dit_sources=0.6,
+    ):
+        """
+        :param
+            overlap: share of descriptions of an already described company
+            group_size: maximum number of descriptions of a company
+            shared_email_domains: share of companies using a public email domain
+            dit_sources: share of descriptions from a dit.* source
+        """
+        self.seed = seed
+        self.overlap = overlap
+        self.group_size = group_size
+        self.shared_email_domains = shared_email_domains
+        self.dit_sources = dit_sources
+        self._rnd = random.Random(seed)
+        self._companies = 0
+        self._described = array('I')
+        self._open = []
+        self._timestamp = datetime(2015, 1, 1)
+        self._ids = 0
+
+    def descriptions(self, count):
+        """
+        :return: generator of count descriptions, continuing where the previous call stopped
+        """
+        for _ in range(count):
+            yield self._description(self._next_company())
+
+    def _next_company(self):
+        if self._open and self._rnd.random() < self.overlap:
+            i = self._rnd.randrange(len(self._open))
+            company = self._open[i]
+        else:
+            company = self._companies
+            self._companies += 1
+            self._described.append(0)
+            self._open.append(company)
+            i = len(self._open) - 1
+        self._described[company] += 1
+        if self._described[company] >= self.group_size:
+            self._open[i] = self._open[-1]
+            self._open.pop()
+        return company
+
+    def _description(self, company):
+        rnd = self._rnd
+        attributes = self._company(company)
+        dit = rnd.random() < self.dit_sources
+        self._ids += 1
+        self._timestamp += timedelta(seconds=rnd.randint(1, 600))
+        description = {
+            'id': str(self._ids),
+            'source': rnd.choice(_DIT_SOURCES if dit else _OTHER_SOURCES),
+            'datetime': self._timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        for field, rate in _FIELD_RATES.items():
+            if field == 'cdms_ref' and not dit:
+                continue
+            if rnd.random() < rate:
+                description[field] = attributes[field]
+        if 'company_name' in description:
+            description['company_name'] = _name_variant(rnd, description['company_name'])
+        if 'contact_email' in description:
+            local = rnd.choice(['info', 'sales', 'export', 'finance', f'user{rnd.randint(1, 99)}'])
+            description['contact_email'] = f"{local}@{description['contact_email']}"
+        return description
+
+    def _company(self, company):
+        rnd = random.Random(self.seed * 1000003 + company)
+        words = rnd.sample(_WORDS, rnd.randint(1, 3)) + [_letters(company)]
+        if rnd.random() < self.shared_email_domains:
+            domain = rnd.choice(_SHARED_DOMAINS)
+        else:
+            domain = f"{''.join(words)}.co.uk"
+        area = rnd.choice(_POSTCODE_AREAS)
+        return {
+            'companies_house_id': f'{company:08d}'[-8:],
+            'duns_number': f'{company + 100000000:09d}'[-9:],
+            'company_name': f"{' '.join(words)} {rnd.choice(_SUFFIXES)}",
+            'contact_email': domain,
+            'cdms_ref': f'ORG-{company}',
+            'postcode': f'{area}{rnd.randint(1, 99)} {rnd.randint(1, 9)}{rnd.choice("ABDEFGH")}Z',
+        }
+
+
+def _letters(number):
+    # the name simplification drops numbers of 5 digits or more and what follows them,
+    # which would merge the names of different companies
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters += 'bcdfghjklmnpqrstvwxzaeiouy'[digit]
+        if not number:
+            return letters
+
+
+def _name_variant(rnd, name):
+    roll = rnd.random()
+    if roll < 0.2:
+        return name.upper()
+    if roll < 0.3:
+        return f'The {name.title()}'
+    if roll < 0.4:
+        return name.replace(' ', '  ')
+    return name.title()
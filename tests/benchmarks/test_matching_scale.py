@@ -0,0 +1,96 @@
+import os
+import time
+
+from app.algorithm import Matcher
+from app.algorithm.sql_statements import _field_to_mapping_table
+from app.db import db_utils
+from app.replay import percentile
+from tests.benchmarks.synthetic import DescriptionGenerator
+from tests.benchmarks.utils import benchmark_size, report
+
+SIZES = [int(s) for s in os.environ.get('BENCHMARK_SCALE_ROWS', '1000,100000,1000000').split(',')]
+REQUESTS = benchmark_size('BENCHMARK_SCALE_REQUESTS', 50)
+BATCH = benchmark_size('BENCHMARK_SCALE_BATCH', 100)
+PRELOAD_BATCH = benchmark_size('BENCHMARK_SCALE_PRELOAD_BATCH', 50000)
+
+MODES = [
+    ('match', {'update': False, 'match': True, 'dnb_match': False}),
+    ('update', {'update': True, 'match': True, 'dnb_match': False}),
+    ('dnb_match', {'update': False, 'match': False, 'dnb_match': True}),
+]
+
+
+def test_matching_scale(app_with_db):
+    generator = DescriptionGenerator(seed=1)
+    matcher = Matcher()
+    preloaded = 0
+    latency_rows = []
+    growth_rows = []
+    for size in sorted(SIZES):
+        start = time.perf_counter()
+        while preloaded < size:
+            count = min(PRELOAD_BATCH, size - preloaded)
+            matcher.match(generator.descriptions(count), update=True, match=False)
+            preloaded += count
+        preload_seconds = time.perf_counter() - start
+        rows_before, bytes_before = _table_stats()
+        growth_rows.append(
+            [size, 'preload', f'{preload_seconds:.1f}', rows_before, f'{bytes_before / 2**20:.1f}']
+        )
+
+        for mode, kwargs in MODES:
+            latencies = []
+            for _ in range(REQUESTS):
+                descriptions = list(generator.descriptions(BATCH))
+                start = time.perf_counter()
+                matcher.match(descriptions, **kwargs)
+                latencies.append(time.perf_counter() - start)
+            elapsed = sum(latencies)
+            if mode == 'update':
+                update_seconds = elapsed
+            latency_rows.append(
+                [
+                    size,
+                    mode,
+                    f'{REQUESTS / elapsed:.1f}',
+                    f'{int(REQUESTS * BATCH / elapsed)}',
+                    f'{percentile(latencies, 50) * 1000:.1f}',
+                    f'{percentile(latencies, 99) * 1000:.1f}',
+                ]
+            )
+        rows_after, bytes_after = _table_stats()
+        growth_rows.append(
+            [
+                size,
+                f'{REQUESTS} updates',
+                f'{update_seconds:.1f}',
+                f'+{rows_after - rows_before}',
+                f'+{(bytes_after - bytes_before) / 2**20:.1f}',
+            ]
+        )
+
+    report(
+        f'matching latency ({BATCH} descriptions per request)',
+        ['preloaded', 'mode', 'requests/s', 'descriptions/s', 'p50 ms', 'p99 ms'],
+        latency_rows,
+    )
+    report(
+        'mapping table growth',
+        ['preloaded', 'after', 'seconds', 'rows', 'MiB'],
+        growth_rows,
+    )
+
+
+def _table_stats():
+    """
+    :return: (rows, bytes including indexes) of all mapping tables
+    """
+    tables = [table for _, table in _field_to_mapping_table]
+    with db_utils.pipeline() as pipeline:
+        rows = pipeline.query(
+            ' union all '.join(
+                f"select count(*), pg_total_relation_size('{table}') from {table}"
+                for table in tables
+            )
+        )
+    return sum(row[0] for row in rows), sum(row[1] for row in rows)
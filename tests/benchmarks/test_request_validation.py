@@ -0,0 +1,27 @@
+from jsonschema import FormatChecker, validate
+
+from app.api.schema import COMPANY_UPDATE_BODY, COMPANY_UPDATE_VALIDATOR
+from tests.benchmarks.test_tmp_table_loading import _descriptions
+from tests.benchmarks.utils import benchmark_size, measure, report
+
+DESCRIPTIONS = benchmark_size('BENCHMARK_VALIDATION_DESCRIPTIONS', 100000)
+
+
+def test_request_validation():
+    body = {'descriptions': _descriptions(DESCRIPTIONS)}
+    validators = [
+        (
+            'jsonschema.validate',
+            lambda: validate(body, COMPANY_UPDATE_BODY, format_checker=FormatChecker()),
+        ),
+        ('SchemaValidator', lambda: COMPANY_UPDATE_VALIDATOR.validate(body)),
+    ]
+    results = []
+    for name, run in validators:
+        elapsed, peak, _ = measure(run)
+        results.append([name, f'{elapsed:.3f}', f'{int(DESCRIPTIONS / elapsed)}'])
+    report(
+        f'request validation ({DESCRIPTIONS} descriptions)',
+        ['validator', 'seconds', 'descriptions/s'],
+        results,
+    )
@@ -0,0 +1,38 @@
+from flask import jsonify
+from mohawk.util import calculate_payload_hash
+
+from app.api.access_control import _payload
+from app.api.utils import matches_response
+from tests.benchmarks.utils import benchmark_size, measure, report
+
+MATCHES = benchmark_size('BENCHMARK_RESPONSE_MATCHES', 10000)
+
+
+def test_response_encoding(app):
+    rows = [(str(i), i // 3, '110000') for i in range(MATCHES)]
+    encoders = [
+        ('dict loop + jsonify', _jsonify_response, bytes),
+        ('matches_response', matches_response, bytes),
+        ('matches_response + file payload', matches_response, _payload),
+    ]
+    results = []
+    for name, encode, payload in encoders:
+        elapsed, peak, _ = measure(_encode_and_hash, encode, payload, rows)
+        results.append([name, f'{elapsed * 1000:.1f}', f'{peak / 2**20:.1f}'])
+    report(
+        f'response encoding and hawk payload hash ({MATCHES} matches)',
+        ['encoder', 'ms', 'peak MiB'],
+        results,
+    )
+
+
+def _jsonify_response(rows):
+    result = {'matches': []}
+    for row in rows:
+        result['matches'].append({'id': row[0], 'match_id': row[1], 'similarity': row[2]})
+    return jsonify(result)
+
+
+def _encode_and_hash(encode, payload, rows):
+    response = encode(rows)
+    return calculate_payload_hash(payload(response.get_data()), 'sha256', response.mimetype)
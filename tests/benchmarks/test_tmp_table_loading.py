@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+from app.algorithm.sql_statements import copy_to_tmp_table, json_to_tmp_table
+from app.db import db_utils
+from tests.benchmarks.utils import benchmark_size, measure, report
+
+ROWS = benchmark_size('BENCHMARK_LOADER_ROWS', 100000)
+
+
+def test_tmp_table_loaders(app_with_db):
+    descriptions = _descriptions(ROWS)
+    loaders = [
+        ('json_populate_recordset', json_to_tmp_table, {}),
+        ('copy text', copy_to_tmp_table, {'copy_format': 'text'}),
+        ('copy binary', copy_to_tmp_table, {'copy_format': 'binary'}),
+    ]
+    results = []
+    for name, load, kwargs in loaders:
+        with db_utils.pipeline() as pipeline:
+            elapsed, peak, _ = measure(_load_and_flush, load, pipeline, descriptions, **kwargs)
+        results.append([name, f'{elapsed:.2f}', f'{int(ROWS / elapsed)}', f'{peak / 2**20:.1f}'])
+    report(
+        f'tmp table loading ({ROWS} descriptions)',
+        ['loader', 'seconds', 'rows/s', 'peak MiB'],
+        results,
+    )
+
+
+def _load_and_flush(load, pipeline, descriptions, **kwargs):
+    load(pipeline, descriptions, **kwargs)
+    pipeline.flush()
+
+
+def _descriptions(count):
+    timestamp = datetime(2019, 1, 1)
+    return [
+        {
+            'id': str(i),
+            'source': 'dit.datahub' if i % 2 else 'companies_house',
+            'datetime': (timestamp + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S'),
+            'companies_house_id': f'{i:08d}',
+            'duns_number': f'{i:09d}',
+            'company_name': f'Company {i} Holdings Limited',
+            'contact_email': f'contact@company{i}.com',
+            'cdms_ref': f'ORG-{i}',
+            'postcode': f'SW{i % 20} {i % 9}AA',
+        }
+        for i in range(count)
+    ]
@@ -0,0 +1,30 @@
+import os
+import time
+import tracemalloc
+
+
+def benchmark_size(name, default):
+    return int(os.environ.get(name, default))
+
+
+def measure(func, *args, **kwargs):
+    """
+    :return: (seconds, peak python memory in bytes, result of func)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def report(title, header, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    lines = [f'\n{title}']
+    for row in [header] + rows:
+        lines.append('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
+    print('\n'.join(lines))
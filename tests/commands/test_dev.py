@@ -1,8 +1,37 @@
+import csv
+import json
+import threading
+import time
 from unittest import mock
 
 import pytest
+from werkzeug.serving import make_server
 
-from app.commands.dev import add_hawk_user, db
+from app.algorithm import Matcher
+from app.algorithm.sql_statements import (
+    _description_columns,
+    _field_to_mapping_table,
+    _updated_tables,
+)
+from app.commands.dev import (
+    add_hawk_user,
+    bulk_ingest,
+    db,
+    export,
+    group_tables,
+    import_file,
+    profile,
+    rebuild,
+    replay,
+    worker,
+)
+from app.db import db_utils
+from app.db.indexes import index_status
+from app.db.models import HawkUsers, LatestDunsByMatchId, MatchGroup, UpdateJob
+from app.jobs import enqueue_update
+from app.rebuild import _complete_rebuilt_tables
+from app.replay import percentile, replay as replay_requests, summary as replay_summary
+from tests.benchmarks.synthetic import DescriptionGenerator
 
 
 class TestDevCommand:
@@ -99,3 +128,407 @@ class TestDevCommand:
 
         if expected_msg:
             assert result.output.startswith('Usage: db [OPTIONS]')
+
+    def test_bulk_ingest_cmd_help(self, app_with_db):
+        runner = app_with_db.test_cli_runner()
+        result = runner.invoke(bulk_ingest)
+        assert 'Switch the mapping tables between unlogged' in result.output
+        assert 'company_name_mapping: logged' in result.output
+        assert result.exit_code == 0
+
+    def test_bulk_ingest_cmd(self, app_with_db):
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(bulk_ingest, ['--start'])
+        assert result.output.count(': unlogged') == 8
+        Matcher().match(
+            [{'id': '1', 'source': 'dit.datahub', 'datetime': '2019-01-01', 'duns_number': 'd1'}]
+        )
+
+        result = runner.invoke(bulk_ingest, ['--finish'])
+        assert result.output.count(': logged') == 8
+
+    def test_group_tables_cmd(self, app_with_db):
+        Matcher().match(
+            [{'id': '1', 'source': 'dit.datahub', 'datetime': '2019-01-01', 'duns_number': 'd1'}]
+        )
+        # as on a database created before the group tables
+        MatchGroup.__table__.drop(app_with_db.db.engine)
+        LatestDunsByMatchId.__table__.drop(app_with_db.db.engine)
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(group_tables, ['--backfill'])
+
+        assert result.output == 'match_group: 1 rows\nlatest_duns_by_match_id: 1 rows\n'
+        assert [(m.field, m.value) for m in MatchGroup.get_members(1)] == [('duns_number', 'd1')]
+
+    def test_export_cmd(self, app_with_db, tmpdir):
+        Matcher().match(
+            [
+                {'id': '1', 'source': 'dit.datahub', 'datetime': '2019-01-01', 'duns_number': 'd1'},
+                {'id': '2', 'source': 'dnb', 'datetime': '2019-01-02', 'duns_number': 'd2'},
+            ]
+        )
+        output = tmpdir.join('export.ndjson')
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(export, [str(output), '--format', 'ndjson', '--source', 'dnb'])
+
+        assert result.exit_code == 0
+        assert [json.loads(line) for line in output.readlines()] == [
+            {
+                'field': 'duns_number',
+                'value': 'd2',
+                'prev_match_id': 2,
+                'match_id': 2,
+                'source': 'dnb',
+                'datetime': '2019-01-02T00:00:00',
+            }
+        ]
+
+        result = runner.invoke(export, [str(output), '--fields', 'duns'])
+        assert result.exit_code == 2
+        assert 'unknown fields: duns' in result.output
+
+    def test_worker_cmd_runs_queued_jobs(self, app_with_db):
+        job_id = enqueue_update(
+            [{'id': '1', 'datetime': '2019-01-01', 'source': 'dit.datahub', 'cdms_ref': '1'}],
+            match=True,
+            dnb_match=False,
+        )
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(worker, ['--once'])
+
+        assert result.exit_code == 0
+        assert UpdateJob.get_job(job_id).status == 'finished'
+
+    def test_profile_cmd(self, app_with_db, tmpdir):
+        payload = tmpdir.join('payload.json')
+        description = {'id': '1', 'datetime': '2019-01-01', 'source': 'dit', 'cdms_ref': '1'}
+        payload.write(json.dumps({'descriptions': [description]}))
+        plans = tmpdir.join('plans.json')
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(profile, [str(payload), '--top', '3', '--plans', str(plans)])
+
+        assert result.exit_code == 0
+        assert 'update_mappings: cdms_ref_mapping' in result.output
+        assert len(json.loads(plans.read())) == 11
+
+    def test_replay_cmd(self, app_with_db, tmpdir, monkeypatch):
+        monkeypatch.setitem(app_with_db.config['access_control'], 'hawk_enabled', True)
+        HawkUsers.add_user('replay', 'secret', ['match', 'update'], 'replay test')
+        description = {'id': '1', 'datetime': '2019-01-01', 'source': 'dit', 'cdms_ref': '1'}
+        requests_file = tmpdir.join('requests.jsonl')
+        requests_file.write(
+            json.dumps({'path': '/api/v1/company/update/', 'body': {'descriptions': [description]}})
+            + '\n'
+            + json.dumps(
+                {'params': {'dnb_match': 'true'}, 'body': {'descriptions': [description]}}
+            )
+            + '\n'
+            + json.dumps({'path': '/api/v1/company/update/', 'body': {'descriptions': [{}]}})
+            + '\n'
+        )
+        server = make_server('localhost', 0, app_with_db, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        runner = app_with_db.test_cli_runner()
+        try:
+            result = runner.invoke(
+                replay,
+                [
+                    str(requests_file),
+                    '--url',
+                    f'http://localhost:{server.server_port}',
+                    '--client_id',
+                    'replay',
+                    '--client_key',
+                    'secret',
+                    '--concurrency',
+                    '2',
+                    '--repeat',
+                    '2',
+                ],
+            )
+        finally:
+            server.shutdown()
+            thread.join()
+
+        assert result.exit_code == 0
+        assert result.output.startswith('requests: 6 in ')
+        assert '200: 4\n400: 2\n' in result.output
+
+    def test_replay_records_failed_requests(self, monkeypatch):
+        def send(session, base_url, credentials, path, params, body, timeout):
+            if body == b'fail':
+                raise ValueError('broken request')
+            return time.perf_counter(), 200
+
+        monkeypatch.setattr('app.replay._send', send)
+        to_send = [('/', {}, b'ok'), ('/', {}, b'fail'), ('/', {}, b'ok')]
+
+        elapsed, results = replay_requests('http://localhost', to_send, 'id', 'key')
+
+        assert [outcome for _, outcome in results] == [200, 'ValueError', 200]
+        assert all(latency >= 0 for latency, _ in results)
+        assert 'ValueError: 1' in replay_summary(elapsed, results)
+
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 112))
+
+        assert percentile(values, 95) == 106
+        assert percentile(values, 50) == 56
+        assert percentile(values, 100) == 111
+        assert percentile([3, 1, 2, 4], 50) == 2
+
+    @pytest.mark.parametrize('import_format', ['csv', 'ndjson'])
+    def test_import_cmd_matches_sequential_updates(self, app_with_db, tmpdir, import_format):
+        descriptions = list(DescriptionGenerator(seed=3, overlap=0.5).descriptions(400))
+        existing, imported = descriptions[:100], descriptions[100:]
+        batch_size = 25
+
+        def update_sequentially(descriptions):
+            for i in range(0, len(descriptions), batch_size):
+                Matcher().match(descriptions[i : i + batch_size], match=False)
+
+        update_sequentially(existing)
+        update_sequentially(imported)
+        expected = _updated_table_rows()
+        app_with_db.db.drop_all()
+        app_with_db.db.create_all()
+        update_sequentially(existing)
+        input_file = tmpdir.join(f'descriptions.{import_format}')
+        with open(input_file, 'w', newline='') as f:
+            if import_format == 'csv':
+                writer = csv.DictWriter(f, _description_columns)
+                writer.writeheader()
+                writer.writerows(imported)
+            else:
+                f.writelines(json.dumps(d) + '\n' for d in imported)
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(
+            import_file,
+            [str(input_file), '--format', import_format, '--batch_size', str(batch_size)],
+        )
+
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith('descriptions: 300 in 12 batches\n')
+        assert _updated_table_rows() == expected
+
+    def test_import_cmd_rejects_invalid_description(self, app_with_db, tmpdir):
+        input_file = tmpdir.join('descriptions.ndjson')
+        input_file.write(
+            json.dumps({'id': '1', 'datetime': '2019-01-01', 'source': 'dit', 'cdms_ref': '1'})
+            + '\n\n'
+            + json.dumps({'id': '2', 'datetime': '2019-01-01', 'cdms_ref': '2'})
+            + '\n'
+        )
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(import_file, [str(input_file), '--format', 'ndjson', '--unlogged'])
+
+        assert result.exit_code == 1
+        assert "line 3: 'source' is a required property" in result.output
+        assert _updated_table_rows() == {table: [] for table in _updated_tables}
+
+    def test_rebuild_cmd(self, app_with_db, tmpdir):
+        descriptions = list(DescriptionGenerator(seed=5, overlap=0.5).descriptions(300))
+        for i in range(0, 100, 25):
+            Matcher().match(descriptions[i : i + 25], match=False)
+        input_file = tmpdir.join('descriptions.ndjson')
+        input_file.write(''.join(json.dumps(d) + '\n' for d in descriptions[100:]))
+        runner = app_with_db.test_cli_runner()
+        runner.invoke(import_file, [str(input_file), '--format', 'ndjson', '--batch_size', '25'])
+        expected = _updated_table_rows()
+        db_utils.execute_statement(
+            'update company_name_mapping set prev_match_id = prev_match_id + 1000; '
+            'delete from match_group;'
+        )
+
+        result = runner.invoke(rebuild, ['--as_logged', '--yes'])
+
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith('descriptions: 300 in 12 batches\n')
+        assert ' kept, 0 new\n' in result.output
+        assert _without_dead_prev_match_ids(_updated_table_rows()) == (
+            _without_dead_prev_match_ids(expected)
+        )
+        assert set(index_status().values()) == {'valid'}
+
+        # the synthetic descriptions are logged in datetime order
+        result = runner.invoke(rebuild, ['--batch_size', '25', '--yes'])
+        assert result.exit_code == 0, result.output
+        assert _without_dead_prev_match_ids(_updated_table_rows()) == (
+            _without_dead_prev_match_ids(expected)
+        )
+
+        # match_ids aren't handed out twice
+        last_match_id = max(row[2] for row in expected['match_group'])
+        new = {'id': '1', 'source': 'dnb', 'datetime': '2030-01-01', 'duns_number': 'new'}
+        [(_, match_id, _)] = Matcher().match([new])
+        assert match_id > last_match_id
+
+    @pytest.mark.parametrize('normalisation', ['db', 'python'])
+    def test_rebuild_cmd_groups_in_db_like_one_batch(self, app_with_db, normalisation):
+        app_with_db.config['matching']['normalisation'] = normalisation
+        descriptions = list(DescriptionGenerator(seed=7, overlap=0.5).descriptions(300))
+        for i in range(0, 300, 50):
+            Matcher().match(descriptions[i : i + 50], match=False)
+        runner = app_with_db.test_cli_runner()
+        runner.invoke(rebuild, ['--batch_size', '300', '--yes'])
+        expected = _updated_table_rows()
+
+        result = runner.invoke(rebuild, ['--in_db', '--yes'])
+
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith('descriptions: 300 in 6 batches\n')
+        assert _updated_table_rows() == expected
+        assert set(index_status().values()) == {'valid'}
+
+        result = runner.invoke(rebuild, ['--as_logged', '--in_db', '--yes'])
+        assert result.exit_code == 2
+        assert 'mutually exclusive' in result.output
+
+    @pytest.mark.parametrize('args', [[], ['--as_logged'], ['--batch_size', '1'], ['--in_db']])
+    def test_rebuild_cmd_includes_updates_logged_meanwhile(self, app_with_db, monkeypatch, args):
+        description = {'id': '1', 'source': 'dnb', 'datetime': '2019-01-01', 'duns_number': 'd1'}
+        Matcher().match([description])
+
+        def complete_during_update(pipeline):
+            _complete_rebuilt_tables(pipeline)
+            Matcher().match([dict(description, datetime='2019-01-02', company_name='name1')])
+
+        monkeypatch.setattr('app.rebuild._complete_rebuilt_tables', complete_during_update)
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(rebuild, args + ['--yes'])
+
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith('descriptions: 2 in 2 batches\n')
+        assert db_utils.execute_query(
+            'select field, value, match_id from match_group order by 1, 2'
+        ) == [('company_name', 'name1', 1), ('duns_number', 'd1', 1)]
+
+    @pytest.mark.parametrize('args', [[], ['--as_logged'], ['--batch_size', '1'], ['--in_db']])
+    def test_rebuild_cmd_includes_lower_batches_committed_meanwhile(
+        self, app_with_db, monkeypatch, args
+    ):
+        description = {'id': '1', 'source': 'dnb', 'datetime': '2019-01-01', 'duns_number': 'd1'}
+        Matcher().match([description])
+        # an update which took its batch_id before the next one but commits after the grouping
+        batch_id = db_utils.execute_query("select nextval('description_log_batch_seq')")[0][0]
+        Matcher().match([dict(description, datetime='2019-01-03', cdms_ref='1')])
+        late = dict(description, datetime='2019-01-02', company_name='name1')
+
+        def commit_lower_batch(pipeline):
+            _complete_rebuilt_tables(pipeline)
+            db_utils.execute_statement(
+                '''
+                insert into description_log
+                    (batch_id, position, logged_at, source, datetime, company_name, duns_number)
+                values (:batch_id, 0, now() at time zone 'utc', 'dnb', '2019-01-02', 'name1', 'd1')
+                ''',
+                {'batch_id': batch_id},
+            )
+            monkeypatch.setitem(app_with_db.config['matching'], 'description_log', False)
+            Matcher().match([late])
+
+        monkeypatch.setattr('app.rebuild._complete_rebuilt_tables', commit_lower_batch)
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(rebuild, args + ['--yes'])
+
+        assert result.exit_code == 0, result.output
+        assert result.output.startswith('descriptions: 3 in ')
+        assert db_utils.execute_query(
+            'select field, value, match_id from match_group order by 1, 2'
+        ) == [('cdms_ref', '1', 1), ('company_name', 'name1', 1), ('duns_number', 'd1', 1)]
+
+    def test_rebuild_cmd_needs_description_log(self, app_with_db):
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(rebuild, ['--yes'])
+
+        assert result.exit_code == 1
+        assert 'the description log is empty' in result.output
+
+    def test_rebuild_cmd_needs_yes(self, app_with_db):
+        Matcher().match([{'id': '1', 'source': 'dnb', 'datetime': '2019-01-01', 'cdms_ref': '1'}])
+        db_utils.execute_statement('update cdms_ref_mapping set match_id = 5')
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(rebuild)
+
+        assert result.exit_code == 2
+        assert '--yes' in result.output
+        assert db_utils.execute_query('select match_id from cdms_ref_mapping') == [(5,)]
+
+    @pytest.mark.parametrize('args', [[], ['--in_db']])
+    def test_rebuild_cmd_refuses_tables_the_log_does_not_cover(
+        self, app_with_db, monkeypatch, args
+    ):
+        description = {'id': '1', 'source': 'dnb', 'datetime': '2019-01-01', 'duns_number': 'd1'}
+        monkeypatch.setitem(app_with_db.config['matching'], 'description_log', False)
+        Matcher().match([description])
+        monkeypatch.setitem(app_with_db.config['matching'], 'description_log', True)
+        Matcher().match([dict(description, datetime='2019-01-02', duns_number='d2')])
+        expected = _updated_table_rows()
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(rebuild, args + ['--yes'])
+
+        assert result.exit_code == 1
+        assert 'the description log does not cover 1 mapping rows' in result.output
+        assert _updated_table_rows() == expected
+
+    @pytest.mark.parametrize('args', [[], ['--in_db']])
+    def test_rebuild_cmd_keeps_match_ids(self, app_with_db, args):
+        description = {'id': '1', 'source': 'dnb', 'datetime': '2019-01-01'}
+        Matcher().match([dict(description, duns_number='d1', company_name='Name1')])
+        Matcher().match([dict(description, datetime='2019-01-02', cdms_ref='1')])
+        Matcher().match([dict(description, datetime='2019-01-03', duns_number='d2')])
+        # a group which the rebuild splits again
+        db_utils.execute_statement('update cdms_ref_mapping set match_id = 1')
+        runner = app_with_db.test_cli_runner()
+
+        result = runner.invoke(rebuild, args + ['--yes'])
+
+        assert result.exit_code == 0, result.output
+        assert 'match_ids: 2 kept, 1 new\n' in result.output
+        # match_id 2 was handed out before, the split group gets a new one
+        assert db_utils.execute_query(
+            'select field, value, match_id from match_group order by 1, 2'
+        ) == [
+            ('cdms_ref', '1', 4),
+            ('company_name', 'name1', 1),
+            ('duns_number', 'd1', 1),
+            ('duns_number', 'd2', 3),
+        ]
+        new = dict(description, datetime='2019-01-04', duns_number='d3')
+        assert Matcher().match([new]) == [('1', 5, '010000')]
+
+
+def _updated_table_rows():
+    return {
+        table: db_utils.execute_query(f'select * from {table} order by 1, 2')
+        for table in _updated_tables
+    }
+
+
+def _without_dead_prev_match_ids(rows):
+    """
+    :return: rows with the prev_match_ids of groups that no longer exist left out, the
+        rebuild gives them new match_ids
+    """
+    mapping_tables = [mt for _, mt in _field_to_mapping_table]
+    match_ids = {row[2] for mt in mapping_tables for row in rows[mt]}
+    return dict(
+        rows,
+        **{
+            mt: [row[:1] + (row[1] if row[1] in match_ids else None,) + row[2:] for row in rows[mt]]
+            for mt in mapping_tables
+        },
+    )
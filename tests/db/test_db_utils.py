@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy import event
+
+from app.algorithm import Matcher
+from app.algorithm.description_log import ensure_partition
+from app.db import db_utils
+
+
+@pytest.fixture
+def checkouts(app_with_db):
+    counter = []
+
+    def on_checkout(*args):
+        counter.append(1)
+
+    event.listen(app_with_db.db.engine, 'checkout', on_checkout)
+    yield counter
+    event.remove(app_with_db.db.engine, 'checkout', on_checkout)
+
+
+def test_pipeline_sends_queued_statements_with_next_execute(app_with_db):
+    with db_utils.pipeline() as pipeline:
+        pipeline.queue('create temporary table t (x int) on commit drop;')
+        pipeline.queue('insert into t values (1), (2);')
+        assert pipeline.query('select sum(x) from t') == [(3,)]
+
+
+def test_pipeline_rolls_back_on_error(app_with_db):
+    with pytest.raises(RuntimeError):
+        with db_utils.pipeline() as pipeline:
+            pipeline.execute('create table pipeline_test (x int)')
+            raise RuntimeError()
+
+    assert not db_utils.table_exists('public', 'pipeline_test')
+
+
+def test_pipeline_commits_queued_statements_on_exit(app_with_db):
+    with db_utils.pipeline() as pipeline:
+        pipeline.queue('create table pipeline_test (x int);')
+
+    assert db_utils.table_exists('public', 'pipeline_test')
+    db_utils.execute_statement('drop table pipeline_test')
+
+
+def test_copy_to_chunks(app_with_db):
+    stmt = 'COPY (select i from generate_series(1, 10000) i) TO STDOUT'
+
+    chunks = list(db_utils.copy_to_chunks(stmt, chunk_size=1000))
+
+    assert len(chunks) > 10
+    assert b''.join(chunks) == b''.join(f'{i}\n'.encode() for i in range(1, 10001))
+
+
+def test_copy_to_chunks_cancelled_when_closed(app_with_db, checkouts):
+    stmt = 'COPY (select generate_series(1, 100000000)) TO STDOUT'
+    chunks = db_utils.copy_to_chunks(stmt, chunk_size=1000, max_chunks=1)
+
+    assert next(chunks).startswith(b'1\n2\n')
+    chunks.close()
+
+    # the connection went back to the pool usable
+    assert db_utils.execute_query('select 1') == [(1,)]
+    assert len(checkouts) == 2
+
+
+def test_copy_to_chunks_raises_errors(app_with_db):
+    with pytest.raises(Exception, match='division by zero'):
+        list(db_utils.copy_to_chunks('COPY (select 1/0) TO STDOUT'))
+
+
+def test_matcher_uses_single_connection(app_with_db, checkouts):
+    # only the first update of a month creates the partition of the log, on its own connection
+    ensure_partition()
+    checkouts.clear()
+    Matcher().match(
+        [{'id': '1', 'source': 'dit.datahub', 'datetime': '2019-01-01', 'duns_number': 'dun1'}]
+    )
+
+    assert len(checkouts) == 1
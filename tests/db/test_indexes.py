@@ -0,0 +1,41 @@
+from app.db import db_utils
+from app.db.indexes import apply_indexes, declared_indexes, index_status
+
+
+def test_created_tables_have_declared_indexes(app_with_db):
+    status = index_status()
+
+    assert len(status) == len(declared_indexes()) == 11
+    assert set(status.values()) == {'valid'}
+
+
+def test_apply_indexes_migrates_old_layout(app_with_db):
+    with db_utils.pipeline() as pipeline:
+        pipeline.queue('drop index company_name_mapping_match_id_idx;')
+        pipeline.queue(
+            'create index company_name_idx on company_name_mapping using hash (company_name);'
+        )
+        # as left behind by a concurrent build that failed
+        pipeline.queue(
+            "update pg_index set indisvalid = false "
+            "where indexrelid = 'duns_number_mapping_match_id_idx'::regclass;"
+        )
+    status = index_status()
+    assert status['company_name_mapping_match_id_idx'] == 'missing'
+    assert status['duns_number_mapping_match_id_idx'] == 'invalid'
+    assert status['company_name_idx'] == 'obsolete'
+
+    statements = []
+    apply_indexes(echo=statements.append)
+
+    assert statements == [
+        'DROP INDEX CONCURRENTLY IF EXISTS duns_number_mapping_match_id_idx',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS duns_number_mapping_match_id_idx '
+        'ON duns_number_mapping (match_id, datetime desc) INCLUDE (duns_number)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS company_name_mapping_match_id_idx '
+        'ON company_name_mapping (match_id)',
+        'DROP INDEX CONCURRENTLY IF EXISTS company_name_idx',
+    ]
+    assert set(index_status().values()) == {'valid'}
+    apply_indexes(echo=statements.append)
+    assert len(statements) == 4